@@ -1,6 +1,6 @@
 from fastai.basics import *
 from .transform import *
-from ..music_transformer.dataloader import MusicDataBunch, MusicItemList
+from ..music_transformer.dataloader import MusicDataBunch, MusicItemList, transpose_notes
 # Sequence 2 Sequence Translate
 
 class S2SFileProcessor(PreProcessor):
@@ -45,24 +45,115 @@ class Midi2MultitrackProcessor(PreProcessor):
     
 class S2SPreloader(Callback):
     def __init__(self, dataset:LabelList, bptt:int=512, 
-                 transpose_range=None, **kwargs):
-        self.dataset,self.bptt = dataset,bptt
+                 transpose_range=None, batch_transpose=False, 
+                 bs:int=32, shuffle:bool=False, bucket:bool=False, bucket_size:int=50, pack:bool=False, **kwargs):
+        self.dataset,self.bptt,self._bs,self.shuffle = dataset,bptt,bs,shuffle
         self.vocab = self.dataset.vocab
         self.transpose_range = transpose_range
+        # batch_transpose: send the transpose offset with each row and leave transposing to `s2s_transpose_tfm`
+        self.batch_transpose = batch_transpose
         self.rand_transpose = partial(rand_transpose_value, rand_range=transpose_range) if transpose_range is not None else None
+        # bucket: batch pairs of similar length (sorted within chunks of `bucket_size` batches) and pad to the batch max only
+        self.bucket,self.bucket_size = bucket,bucket_size
+        # pack: concatenate several pairs into each row with segment ids. Use with `packed_melody_chord_tfm`
+        self.pack = pack
+        if self.bucket or self.pack: self.on_epoch_begin()
+        
+    def on_epoch_begin(self, **kwargs):
+        if self.pack: self.rows = self.pack_rows()
+        elif self.bucket: self.order,self.pad_lens = self.bucket_batches()
+    
+    def on_epoch_end(self, **kwargs): self.on_epoch_begin()
+
+    @property
+    def bs(self): return self._bs
+    @bs.setter
+    def bs(self, bs):
+        "Bucketed batches and packed rows are laid out for the batch size. Set by fastai's `DeviceDataLoader.batch_size`"
+        self._bs = bs
+        if self.bucket or self.pack: self.on_epoch_begin()
+    
+    def item_lengths(self):
+        "Length of each pair (longest track), capped at the padded length"
+        return np.array([min(max(len(m[0]), len(c[0])), self.bptt+1) for m,c in self.dataset.x.items], dtype=np.int64)
+        
+    def bucket_batches(self):
+        "Item order for this epoch and the padded length of each position. Every `bs` consecutive positions form one batch"
+        # Distributed: one batch of bs*num_distrib per step. `OurDistributedSampler` gives each rank every num_distrib'th position
+        n_distrib = num_distrib() or 1
+        bs = self.bs*n_distrib
+        lengths = self.item_lengths()
+        n = len(lengths)
+        idx = np.random.permutation(n) if self.shuffle else np.arange(n)
+        chunk = bs*self.bucket_size if self.shuffle else max(n, 1)
+        idx = np.concatenate([c[np.argsort(lengths[c], kind='stable')] for c in np.split(idx, range(chunk, n, chunk))])
+        batches = [idx[i:i+bs] for i in range(0, n, bs)]
+        if self.shuffle:
+            # shuffle full batches, a smaller last batch has to stay last
+            nfull = n // bs
+            batches = [batches[i] for i in np.random.permutation(nfull)] + batches[nfull:]
+        # The sampler pads the positions to a multiple of num_distrib from the start. Repeat last batch items instead
+        if batches and len(batches[-1]) % n_distrib: batches[-1] = np.resize(batches[-1], math.ceil(len(batches[-1])/n_distrib)*n_distrib)
+        # model sees pad_len-1 tokens after the next word offset. Round that to a multiple of 8
+        pad_lens = [min(math.ceil((lengths[b].max()-1)/8)*8, self.bptt)+1 for b in batches]
+        return idx[:0] if n == 0 else np.concatenate(batches), np.repeat(pad_lens, [len(b) for b in batches])
+        
+    def pack_rows(self):
+        "Items of each packed row of bptt+1 tokens. First fit decreasing within chunks of `bs*bucket_size` pairs"
+        self.lengths = lengths = self.item_lengths()
+        n = len(lengths)
+        idx = np.random.permutation(n) if self.shuffle else np.arange(n)
+        rows = []
+        for chunk in np.split(idx, range(self.bs*self.bucket_size, n, self.bs*self.bucket_size)):
+            chunk = chunk[np.argsort(-lengths[chunk], kind='stable')]
+            space,chunk_rows = np.full(len(chunk), -1),[]
+            for i in chunk:
+                fits = space >= lengths[i]
+                r = fits.argmax() if fits.any() else len(chunk_rows)
+                if r == len(chunk_rows): 
+                    chunk_rows.append([])
+                    space[r] = self.bptt+1
+                chunk_rows[r].append(i)
+                space[r] -= lengths[i]
+            rows += chunk_rows
+        if self.shuffle: rows = [rows[i] for i in np.random.permutation(len(rows))]
+        return rows
         
     def __getitem__(self, k:int):
+        if self.pack: return self.packed_row(k)
+        pad_len = self.bptt+1
+        if self.bucket: k,pad_len = self.order[k],self.pad_lens[k]
         item,empty_label = self.dataset[k]
         
-        if self.rand_transpose is not None:
-            val = self.rand_transpose()
-            item = item.transpose(val)
-        item = item.pad_to(self.bptt+1)
+        val = self.rand_transpose() if self.rand_transpose is not None else 0
+        if val and not self.batch_transpose: item = item.transpose(val)
+        item = item.pad_to(pad_len)
         ((m_x, m_pos), (c_x, c_pos)) = item.to_idx()
+        if self.batch_transpose: return m_x, m_pos, c_x, c_pos, val
         return m_x, m_pos, c_x, c_pos
     
+    def packed_row(self, k:int):
+        "Concatenated pairs of row `k` and their segment ids (1,2,..). Each pair starts at the same offset in both tracks"
+        # A pair of length n keeps n-1 inputs. Its last token is only a target - segment 0 like the row padding
+        row = np.full((4, self.bptt+1), self.vocab.pad_idx, dtype=np.int64)
+        row[[1,3]] = 0
+        seg = np.zeros(self.bptt+1, dtype=np.int64)
+        val = self.rand_transpose() if self.rand_transpose is not None else 0
+        start = 0
+        for s,i in enumerate(self.rows[k]):
+            item,empty_label = self.dataset[i]
+            if self.rand_transpose is not None and not self.batch_transpose: item = item.transpose(self.rand_transpose())
+            n = self.lengths[i]
+            ((m_x, m_pos), (c_x, c_pos)) = item.pad_to(n).to_idx()
+            row[:, start:start+n] = m_x, m_pos, c_x, c_pos
+            seg[start:start+n-1] = s+1
+            start += n
+        if self.batch_transpose: return (*row, seg, val)
+        return (*row, seg)
+    
     def __len__(self):
-        return len(self.dataset)
+        if self.pack: return len(self.rows)
+        return len(self.order) if self.bucket else len(self.dataset)
 
 def rand_transpose_value(rand_range=(0,24), p=0.5):
     if np.random.rand() < p: return np.random.randint(*rand_range)-rand_range[1]//2
@@ -116,6 +207,11 @@ def mask_lm_tfm(b, mask_range, mask_idx, pad_idx, mask_p):
     y_dict = { 'msk': y_msk, 'lm': y_lm }
     return x_dict, y_dict
 
+def s2s_transpose_tfm(b, vocab):
+    "Batch transform for `S2SPreloader(batch_transpose=True)`. Applies the per-row transpose offsets - goes before `melody_chord_tfm`"
+    m,m_pos,c,c_pos,*seg,values = b
+    return (transpose_notes(m, values, vocab.note_range), m_pos, transpose_notes(c, values, vocab.note_range), c_pos, *seg)
+
 def melody_chord_tfm(b):
     m,m_pos,c,c_pos = b
     
@@ -144,3 +240,12 @@ def melody_chord_tfm(b):
         'c2m': y_m, 'm2c': y_c
     }
     return x_dict, y_dict
+
+def packed_melody_chord_tfm(b, vocab):
+    "`melody_chord_tfm` for `S2SPreloader(pack=True)`. Adds segment ids and ignores targets outside of a pair"
+    m,m_pos,c,c_pos,seg = b
+    x_dict,y_dict = melody_chord_tfm((m,m_pos,c,c_pos))
+    seg = seg[:,:-1]
+    for task in ('c2m', 'm2c'): x_dict[task]['enc_seg'] = x_dict[task]['dec_seg'] = seg
+    y_dict = { task: y.masked_fill(seg == 0, vocab.pad_idx) for task,y in y_dict.items() }
+    return x_dict, y_dict
@@ -1,15 +1,18 @@
 from fastai.basics import *
+import hashlib
+import threading
+from collections import OrderedDict
 from ..vocab import *
-from ..utils.top_k_top_p import top_k_top_p
 from ..utils.midifile import is_empty_midi
+from ..utils.quantize import quantize_model
 from ..music_transformer.transform import *
-from ..music_transformer.learner import filter_invalid_indexes
+from ..music_transformer.learner import LogitsProcessor, BeamSearch
 from .model import get_multitask_model
 from .dataloader import *
 
 def multitask_model_learner(data:DataBunch, config:dict=None, drop_mult:float=1., 
-                            pretrained_path:PathOrStr=None, **learn_kwargs) -> 'LanguageLearner':
-    "Create a `Learner` with a language model from `data` and `arch`."
+                            pretrained_path:PathOrStr=None, quantize:bool=False, **learn_kwargs) -> 'LanguageLearner':
+    "Create a `Learner` with a language model from `data` and `arch`. `quantize` gives a dynamic int8 model for CPU inference"
     vocab = data.vocab
     vocab_size = len(vocab)
 
@@ -24,11 +27,16 @@ def multitask_model_learner(data:DataBunch, config:dict=None, drop_mult:float=1.
     
     if pretrained_path: 
         get_model(model).load_state_dict(state['model'], strict=False)
-        if not hasattr(learn, 'opt'): learn.create_opt(defaults.lr, learn.wd)
+        if not hasattr(learn, 'opt') and not quantize: learn.create_opt(defaults.lr, learn.wd)
         try:    learn.opt.load_state_dict(state['opt'])
         except: pass
         del state
         gc.collect()
+
+    if quantize:
+        learn.model = quantize_model(learn.model) # inference only - no optimizer state
+        learn.data.device = torch.device('cpu') # int8 kernels are CPU only
+        for dl in learn.data.dls: dl.device = learn.data.device
         
     return learn
 
@@ -44,6 +52,13 @@ class MultitaskLearner(Learner):
             gc.collect()
         return out_path
 
+    def export_script(self, path:PathOrStr, max_seq_len:int=1024, freeze:bool=True):
+        "Save a frozen TorchScript version of the model and the vocab to `path`. Generate with `MultitaskScriptRunner.load(path)`"
+        from .script import ScriptMultiTransformer, script_model, save_script # script.py imports this module
+        model = script_model(ScriptMultiTransformer(self.model.eval(), max_seq_len=max_seq_len), freeze=freeze, preserved_attrs=('init_state', 'encode', 's2s_step'))
+        save_script(model, path, self.data.vocab, model='multitask', max_seq_len=max_seq_len)
+        return path
+
     def predict_nw(self, item:MusicItem, n_words:int=128,
                      temperatures:float=(1.0,1.0), min_bars=4,
                      top_k=30, top_p=0.6):
@@ -51,9 +66,8 @@ class MultitaskLearner(Learner):
         self.model.reset()
         new_idx = []
         vocab = self.data.vocab
-        x, pos = item.to_tensor(), item.get_pos_tensor()
+        x, pos = item.to_tensor(self.data.device), item.get_pos_tensor(self.data.device)
         last_pos = pos[-1] if len(pos) else 0
-        y = torch.tensor([0])
 
         start_pos = last_pos
 
@@ -61,38 +75,19 @@ class MultitaskLearner(Learner):
         bar_len = SAMPLE_FREQ * 4 # assuming 4/4 time
         vocab = self.data.vocab
 
-        repeat_count = 0
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p)
 
+        self.model.eval()
         for i in progress_bar(range(n_words), leave=True):
-            batch = { 'lm': { 'x': x[None], 'pos': pos[None] } }, y
-            logits = self.pred_batch(batch=batch)['lm'][-1][-1]
+            with torch.no_grad():
+                hidden = self.model.decoder(x[None], pos[None])[:,-1]
 
             prev_idx = new_idx[-1] if len(new_idx) else vocab.pad_idx
+            logits = processor.head_logits(self.model.head, hidden, [prev_idx])
 
-            # Temperature
-            # Use first temperatures value if last prediction was duration
-            temperature = temperatures[0] if vocab.is_duration_or_pad(prev_idx) else temperatures[1]
-            repeat_penalty = max(0, np.log((repeat_count+1)/4)/5) * temperature
-            temperature += repeat_penalty
-            if temperature != 1.: logits = logits / temperature
-                
-
-            # Filter
             # bar = 16 beats
-            filter_value = -float('Inf')
-            if ((last_pos - start_pos) // 16) <= min_bars: logits[vocab.bos_idx] = filter_value
-
-            logits = filter_invalid_indexes(logits, prev_idx, vocab, filter_value=filter_value)
-            logits = top_k_top_p(logits, top_k=top_k, top_p=top_p, filter_value=filter_value)
-            
-            # Sample
-            probs = F.softmax(logits, dim=-1)
-            idx = torch.multinomial(probs, 1).item()
-
-            # Update repeat count
-            num_choices = len(probs.nonzero().view(-1))
-            if num_choices <= 2: repeat_count += 1
-            else: repeat_count = repeat_count // 2
+            filter_bos = ((last_pos - start_pos) // 16) <= min_bars
+            idx = processor.sample(logits, [prev_idx], filter_bos=[filter_bos]).item()
 
             if prev_idx==vocab.sep_idx: 
                 duration = idx - vocab.dur_range[0]
@@ -116,17 +111,40 @@ class MultitaskLearner(Learner):
         full = item.append(pred)
         return pred, full
 
+    def beam_search_nw(self, item:MusicItem, n_words:int=128, top_k:int=10, beam_sz:int=10, temperature:float=1.,
+                       min_bars=4):
+        "Return the `n_words` that come after `item` using beam search on the decoder"
+        self.model.reset()
+        self.model.eval()
+        vocab = self.data.vocab
+        x, pos = item.to_tensor(self.data.device), item.get_pos_tensor(self.data.device)
+        def step(x, pos):
+            with torch.no_grad():
+                return self.model.head.decoder(self.model.decoder(x, pos)[:,-1]) # head on the last position only
+
+        start_pos = pos[-1] if len(pos) else 0
+        search = BeamSearch(vocab, step, self.model.select_hidden, beam_sz=beam_sz, top_k=top_k, min_bars=min_bars)
+        new_idx = search(step(x[None], pos[None]), start_pos, n_words, temperature=temperature)
+
+        pred = vocab.to_music_item(np.array(new_idx))
+        full = item.append(pred)
+        return pred, full
+
     def predict_mask(self, masked_item:MusicItem,
                     temperatures:float=(1.0,1.0),
-                    top_k=20, top_p=0.8):
-        x = masked_item.to_tensor()
-        pos = masked_item.get_pos_tensor()
-        y = torch.tensor([0])
+                    top_k=20, top_p=0.8, iterations:int=None):
+        "Fill the mask tokens of `masked_item`. One forward per mask token, or mask-predict with a fixed number of `iterations`"
+        if iterations is not None: 
+            return self.mask_predict(masked_item, iterations=iterations, temperatures=temperatures, top_k=top_k, top_p=top_p)
+        x = masked_item.to_tensor(self.data.device)
+        pos = masked_item.get_pos_tensor(self.data.device)
+        self.model.eval()
         vocab = self.data.vocab
         self.model.reset()
         mask_idxs = (x == vocab.mask_idx).nonzero().view(-1)
 
-        repeat_count = 0
+        # Don't allow any special tokens (as we are only removing notes and durations)
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p, filter_special=True)
 
         for midx in progress_bar(mask_idxs, leave=True):
             prev_idx = x[midx-1]
@@ -135,44 +153,66 @@ class MultitaskLearner(Learner):
             # pos = torch.tensor(-position_enc(xb[0].cpu().numpy()), device=xb.device)[None]
     
             # Next Word
-            logits = self.pred_batch(batch=({ 'msk': { 'x': x[None], 'pos': pos[None] } }, y) )['msk'][0][midx]
-
-            # Temperature
-            # Use first temperatures value if last prediction was duration
-            temperature = temperatures[0] if vocab.is_duration_or_pad(prev_idx) else temperatures[1]
-            repeat_penalty = max(0, np.log((repeat_count+1)/4)/5) * temperature
-            temperature += repeat_penalty
-            if temperature != 1.: logits = logits / temperature
-
-            # Filter
-            filter_value = -float('Inf')
-            special_idxs = [vocab.bos_idx, vocab.sep_idx, vocab.stoi[EOS]]
-            logits[special_idxs] = filter_value # Don't allow any special tokens (as we are only removing notes and durations)
-            logits = filter_invalid_indexes(logits, prev_idx, vocab, filter_value=filter_value)
-            logits = top_k_top_p(logits, top_k=top_k, top_p=top_p, filter_value=filter_value)
-
-            # Sampling
-            probs = F.softmax(logits, dim=-1)
-            idx = torch.multinomial(probs, 1).item()
-
-            # Update repeat count
-            num_choices = len(probs.nonzero().view(-1))
-            if num_choices <= 2: repeat_count += 1
-            else: repeat_count = repeat_count // 2
+            with torch.no_grad():
+                hidden = self.model.encoder(x[None], pos[None])[0, midx][None]
+            logits = processor.head_logits(self.model.head, hidden, prev_idx)
+            idx = processor.sample(logits, prev_idx).item()
 
             x[midx] = idx
 
         return vocab.to_music_item(x.cpu().numpy())
 
+    def mask_predict(self, masked_item:MusicItem, iterations:int=4,
+                     temperatures:float=(1.0,1.0), top_k=20, top_p=0.8):
+        "Fill all mask tokens in parallel, then re-mask and re-predict the least confident ones. Costs `iterations` forwards"
+        if iterations < 1: raise ValueError(f'Mask-predict needs at least 1 iteration, got {iterations}')
+        x = masked_item.to_tensor(self.data.device)
+        pos = masked_item.get_pos_tensor(self.data.device)
+        self.model.eval()
+        vocab = self.data.vocab
+        self.model.reset()
+        mask_idxs = (x == vocab.mask_idx).nonzero().view(-1)
+        n_masks = len(mask_idxs)
+        iterations = min(iterations, n_masks) # more would re-predict nothing
+
+        # Masks are either all notes or all durations, so the previous token is never masked
+        prev_idx = x[mask_idxs-1]
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p, filter_special=True)
+        confidence = torch.zeros(n_masks, device=x.device)
+        remask = torch.ones(n_masks, dtype=torch.bool, device=x.device)
+
+        for i in progress_bar(range(iterations), leave=True):
+            with torch.no_grad():
+                # Full vocab (confidence is the unfiltered probability), but only at the masked positions
+                logits = self.model.head.decoder(self.model.encoder(x[None], pos[None])[0, mask_idxs])
+            probs = F.softmax(processor(logits, prev_idx), dim=-1)
+            idx = torch.multinomial(probs, 1)[:,0]
+            x[mask_idxs[remask]] = idx[remask]
+            confidence[remask] = F.softmax(logits, dim=-1).gather(1, idx[:,None])[remask,0]
+
+            # Linear decay - re-predict fewer tokens each iteration. The last pass leaves no masks
+            n_remask = n_masks * (iterations-1-i) // iterations
+            if i == iterations-1 or n_remask == 0: break
+            remask = torch.zeros_like(remask)
+            remask[confidence.topk(n_remask, largest=False).indices] = True
+            x[mask_idxs[remask]] = vocab.mask_idx
+
+        return vocab.to_music_item(x.cpu().numpy())
+
+    def encode_input(self, input_item:MusicItem, encoder_cache:'EncoderCache'=None):
+        "Input tensors and encoder output of `input_item`. Looked up in `encoder_cache` if one is passed"
+        inp, inp_pos = input_item.to_tensor(self.data.device), input_item.get_pos_tensor(self.data.device)
+        if encoder_cache is not None: return inp, inp_pos, encoder_cache(self.model.encoder, inp[None], inp_pos[None])
+        with torch.no_grad():
+            return inp, inp_pos, self.model.encoder(inp[None], inp_pos[None])
+
     def predict_s2s(self, input_item:MusicItem, target_item:MusicItem, n_words:int=256,
                         temperatures:float=(1.0,1.0), top_k=30, top_p=0.8,
-                        use_memory=True):
+                        use_memory=True, encoder_cache:'EncoderCache'=None):
         vocab = self.data.vocab
         
         # Input doesn't change. We can reuse the encoder output on each prediction
-        with torch.no_grad():
-            inp, inp_pos = input_item.to_tensor(), input_item.get_pos_tensor()
-            x_enc = self.model.encoder(inp[None], inp_pos[None])
+        inp, inp_pos, x_enc = self.encode_input(input_item, encoder_cache)
         
         # target
         targ = target_item.data.tolist()
@@ -180,7 +220,7 @@ class MultitaskLearner(Learner):
         last_pos = targ_pos[-1]
         self.model.reset()
 
-        repeat_count = 0
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p)
 
         max_pos = input_item.position[-1] + SAMPLE_FREQ * 4 # Only predict until both tracks/parts have the same length
         x, pos = inp.new_tensor(targ), inp_pos.new_tensor(targ_pos)
@@ -188,30 +228,11 @@ class MultitaskLearner(Learner):
         for i in progress_bar(range(n_words), leave=True):
             # Predict
             with torch.no_grad():
-                dec = self.model.decoder(x[None], pos[None], x_enc)
-                logits = self.model.head(dec)[-1, -1]
+                hidden = self.model.decoder(x[None], pos[None], x_enc)[:,-1]
 
-            # Temperature
-            # Use first temperatures value if last prediction was duration
             prev_idx = targ[-1] if len(targ) else vocab.pad_idx
-            temperature = temperatures[0] if vocab.is_duration_or_pad(prev_idx) else temperatures[1]
-            repeat_penalty = max(0, np.log((repeat_count+1)/4)/5) * temperature
-            temperature += repeat_penalty
-            if temperature != 1.: logits = logits / temperature
-                
-            # Filter
-            filter_value = -float('Inf')
-            logits = filter_invalid_indexes(logits, prev_idx, vocab, filter_value=filter_value)
-            logits = top_k_top_p(logits, top_k=top_k, top_p=top_p, filter_value=filter_value)
-
-            # Sample
-            probs = F.softmax(logits, dim=-1)
-            idx = torch.multinomial(probs, 1).item()
-
-            # Update repeat count
-            num_choices = len(probs.nonzero().view(-1))
-            if num_choices <= 2: repeat_count += 1
-            else: repeat_count = repeat_count // 2
+            logits = processor.head_logits(self.model.head, hidden, [prev_idx])
+            idx = processor.sample(logits, [prev_idx]).item()
 
             if idx == vocab.bos_idx | idx == vocab.stoi[EOS]: 
                 print('Predicting BOS/EOS')
@@ -236,19 +257,94 @@ class MultitaskLearner(Learner):
                 x, pos = inp.new_tensor(targ), inp_pos.new_tensor(targ_pos)
 
         return vocab.to_music_item(np.array(targ))
+
+    def beam_search_s2s(self, input_item:MusicItem, target_item:MusicItem, n_words:int=256,
+                        top_k:int=10, beam_sz:int=10, temperature:float=1., encoder_cache:'EncoderCache'=None):
+        "Predict the counter-part of `input_item` after `target_item` using beam search"
+        self.model.eval()
+        vocab = self.data.vocab
+
+        # Input doesn't change. Each beam reuses the same encoder output
+        inp, inp_pos, x_enc = self.encode_input(input_item, encoder_cache)
+        self.model.reset()
+
+        x, pos = inp.new_tensor(target_item.data), inp_pos.new_tensor(target_item.position)
+        def step(x, pos):
+            with torch.no_grad():
+                return self.model.head.decoder(self.model.decoder(x, pos, x_enc.expand(x.shape[0], -1, -1))[:,-1])
+
+        max_pos = input_item.position[-1] + SAMPLE_FREQ * 4 # Only predict until both tracks/parts have the same length
+        search = BeamSearch(vocab, step, self.model.select_hidden, beam_sz=beam_sz, top_k=top_k, 
+                            max_pos=max_pos, end_idxs=[vocab.bos_idx, vocab.stoi[EOS]])
+        new_idx = search(step(x[None], pos[None]), pos[-1], n_words, temperature=temperature)
+        return vocab.to_music_item(np.concatenate([target_item.data, np.array(new_idx, dtype=target_item.data.dtype)]))
     
 # High level prediction functions from midi file
 def nw_predict_from_midi(learn, midi=None, n_words=400, 
                       temperatures=(1.0,1.0), top_k=30, top_p=0.6, seed_len=None, **kwargs):
     vocab = learn.data.vocab
-    seed = MusicItem.from_file(midi, vocab) if not is_empty_midi(midi) else MusicItem.empty(vocab)
-    if seed_len is not None: seed = seed.trim_to_beat(seed_len)
+    # only encodes the windows needed for the seed
+    seed = MusicItem.from_windows(iter_item_windows(midi, vocab), vocab, to_beat=seed_len) if not is_empty_midi(midi) else MusicItem.empty(vocab)
         
     pred, full = learn.predict_nw(seed, n_words=n_words, temperatures=temperatures, top_k=top_k, top_p=top_p, **kwargs)
     return full
 
+class EncoderCache():
+    "LRU cache of seq2seq encoder outputs, keyed by the input tokens/positions and the encoder weights. Holds at most `max_bytes`"
+    def __init__(self, max_bytes:int=64*2**20):
+        self.max_bytes = max_bytes
+        self.cache = OrderedDict()
+        self.nbytes,self.hits,self.misses = 0,0,0
+        self.lock = threading.Lock() # the api serves requests from several threads
+
+    def key(self, encoder, x, pos):
+        # Parameter versions change with every in-place update (training, load_state_dict)
+        model_key = (id(encoder), encoder.training, tuple((p.data_ptr(), p._version) for p in encoder.parameters()))
+        h = hashlib.sha1(x.cpu().numpy().tobytes())
+        h.update(pos.cpu().numpy().tobytes())
+        return model_key, str(x.device), tuple(x.shape), h.hexdigest()
+
+    def __call__(self, encoder, x, pos):
+        "Encoder output of `x`, `pos`. Only runs `encoder` on a miss"
+        key = self.key(encoder, x, pos)
+        with self.lock:
+            if key in self.cache:
+                self.hits += 1
+                self.cache.move_to_end(key)
+                return self.cache[key]
+            self.misses += 1
+        # Encode without the lock - concurrent misses on the same input just encode twice
+        with torch.no_grad(): out = encoder(x, pos)
+        self.add(key, out)
+        return out
+
+    def add(self, key, out):
+        size = out.element_size() * out.nelement()
+        if size > self.max_bytes: return
+        with self.lock:
+            if key in self.cache: return
+            self.cache[key] = out
+            self.nbytes += size
+            while self.nbytes > self.max_bytes:
+                _,old = self.cache.popitem(last=False)
+                self.nbytes -= old.element_size() * old.nelement()
+
+    def clear(self):
+        with self.lock:
+            self.cache.clear()
+            self.nbytes = 0
+
+    @property
+    def stats(self):
+        with self.lock: return { 'hits': self.hits, 'misses': self.misses, 'entries': len(self.cache), 'nbytes': self.nbytes }
+
+    def __repr__(self): return f'{self.__class__.__name__} {self.stats}'
+
+s2s_encoder_cache = EncoderCache() # shared by s2s_predict_from_midi calls
+
 def s2s_predict_from_midi(learn, midi=None, n_words=200, 
-                      temperatures=(1.0,1.0), top_k=24, top_p=0.7, seed_len=None, pred_melody=True, **kwargs):
+                      temperatures=(1.0,1.0), top_k=24, top_p=0.7, seed_len=None, pred_melody=True, 
+                      encoder_cache=s2s_encoder_cache, **kwargs):
     multitrack_item = MultitrackItem.from_file(midi, learn.data.vocab)
     melody, chords = multitrack_item.melody, multitrack_item.chords
     inp, targ = (chords, melody) if pred_melody else (melody, chords)
@@ -257,14 +353,15 @@ def s2s_predict_from_midi(learn, midi=None, n_words=200,
     if seed_len is not None: targ = targ.trim_to_beat(seed_len)
     targ = targ.remove_eos()
         
-    pred = learn.predict_s2s(inp, targ, n_words=n_words, temperatures=temperatures, top_k=top_k, top_p=top_p, **kwargs)
+    pred = learn.predict_s2s(inp, targ, n_words=n_words, temperatures=temperatures, top_k=top_k, top_p=top_p, 
+                             encoder_cache=encoder_cache, **kwargs)
     
     part_order = (pred, inp) if pred_melody else (inp, pred)
     return MultitrackItem(*part_order)
 
 def mask_predict_from_midi(learn, midi=None, predict_notes=True,
                            temperatures=(1.0,1.0), top_k=30, top_p=0.7, section=None, **kwargs):
-    item = MusicItem.from_file(midi, learn.data.vocab)
+    item = MusicItem.from_file(midi, learn.data.vocab, fast=True)
     masked_item = item.mask_pitch(section) if predict_notes else item.mask_duration(section)
     pred = learn.predict_mask(masked_item, temperatures=temperatures, top_k=top_k, top_p=top_p, **kwargs)
     return pred
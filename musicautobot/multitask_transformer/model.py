@@ -36,16 +36,25 @@ class MultiTransformer(nn.Module):
         if lm is not None:
             outputs['lm'] = self.head(self.decoder(lm['x'], lm['pos']))
         
+        if c2m is not None and m2c is not None and same_shapes(c2m, m2c):
+            # Both tasks share weights and padded shapes - stack them for one encoder and one decoder pass
+            self.reset()
+            s2s = { k: torch.cat([c2m[k], m2c[k]]) for k in c2m.keys() }
+            s2s_enc = self.encoder(s2s['enc'], s2s['enc_pos'], lm_seg=s2s.get('enc_seg'))
+            s2s_dec = self.decoder(s2s['dec'], s2s['dec_pos'], s2s_enc, lm_seg=s2s.get('dec_seg'), msk_seg=s2s.get('enc_seg'))
+            outputs['c2m'], outputs['m2c'] = self.head(s2s_dec).split(c2m['enc'].shape[0])
+            return outputs
+        
         if c2m is not None:
             self.reset()
-            c2m_enc = self.encoder(c2m['enc'], c2m['enc_pos'])
-            c2m_dec = self.decoder(c2m['dec'], c2m['dec_pos'], c2m_enc)
+            c2m_enc = self.encoder(c2m['enc'], c2m['enc_pos'], lm_seg=c2m.get('enc_seg'))
+            c2m_dec = self.decoder(c2m['dec'], c2m['dec_pos'], c2m_enc, lm_seg=c2m.get('dec_seg'), msk_seg=c2m.get('enc_seg'))
             outputs['c2m'] = self.head(c2m_dec)
             
         if m2c is not None:
             self.reset()
-            m2c_enc = self.encoder(m2c['enc'], m2c['enc_pos'])
-            m2c_dec = self.decoder(m2c['dec'], m2c['dec_pos'], m2c_enc)
+            m2c_enc = self.encoder(m2c['enc'], m2c['enc_pos'], lm_seg=m2c.get('enc_seg'))
+            m2c_dec = self.decoder(m2c['dec'], m2c['dec_pos'], m2c_enc, lm_seg=m2c.get('dec_seg'), msk_seg=m2c.get('enc_seg'))
             outputs['m2c'] = self.head(m2c_dec)
             
         return outputs
@@ -54,12 +63,25 @@ class MultiTransformer(nn.Module):
     def reset(self):
         for module in self.children(): 
             reset_children(module)
+
+    def select_hidden(self, idxs):
+        "Reorder the decoder memory along the batch - beam search/batched generation"
+        for module in self.children():
+            select_hidden_children(module, idxs)
+        
+def same_shapes(a:dict, b:dict):
+    return a.keys() == b.keys() and all(a[k].shape == b[k].shape for k in a.keys())
         
 def reset_children(mod):
     if hasattr(mod, 'reset'): mod.reset()
     for module in mod.children(): 
         reset_children(module)
 
+def select_hidden_children(mod, idxs):
+    if hasattr(mod, 'select_hidden'): mod.select_hidden(idxs)
+    for module in mod.children(): 
+        select_hidden_children(module, idxs)
+
  # COMPONENTS
 class TransformerEmbedding(nn.Module):
     "Embedding + positional encoding + dropout"
@@ -88,8 +110,7 @@ class TransformerEmbedding(nn.Module):
     def relative_pos_enc(self, emb):
 #         return torch.arange(640-1, -1, -1).float().cuda()
         seq_len = emb.shape[1] + self.mem_len
-        pos = torch.arange(seq_len-1, -1, -1, device=emb.device, dtype=emb.dtype) # backwards (txl pos encoding)
-        return self.pos_enc(pos)
+        return cached_relative_enc(self.pos_enc, seq_len, emb.device, emb.dtype) # backwards (txl pos encoding)
 
 class MTLinearDecoder(nn.Module):
     "To go on top of a RNNCore module and create a Language Model."
@@ -130,7 +151,7 @@ class MTEncoder(nn.Module):
         nn.init.normal_(self.u, 0., 0.02)
         nn.init.normal_(self.v, 0., 0.02)
         
-    def forward(self, x_lm, lm_pos, msk_emb=None):
+    def forward(self, x_lm, lm_pos, msk_emb=None, lm_seg=None, msk_seg=None):
         bs,lm_len = x_lm.size()
         
         lm_emb = self.embed(x_lm, lm_pos)
@@ -145,9 +166,15 @@ class MTEncoder(nn.Module):
                                        max_size=self.mask_steps, p=self.mask_p, is_eval=not self.training)
         else:
             lm_mask = None
+            
+        # Packed rows (segment ids) - keep attention inside each segment
+        msk_mask = None
+        if lm_seg is not None:
+            lm_mask = segment_mask(lm_seg, lm_seg, lm_mask)
+            if msk_seg is not None: msk_mask = segment_mask(lm_seg, msk_seg)
         
         for i, layer in enumerate(self.layers):
-            lm_emb = layer(lm_emb, msk_emb, lm_mask=lm_mask,
+            lm_emb = layer(lm_emb, msk_emb, lm_mask=lm_mask, msk_mask=msk_mask,
                         r=pos_enc, g_u=self.u, g_v=self.v)
         return lm_emb
 
@@ -158,7 +185,8 @@ class MTEncoderBlock(nn.Module):
                  bias:bool=True, scale:bool=True, double_drop:bool=True, mem_len:int=512, mha2_mem_len=0, **kwargs):
         super().__init__()
         attn_cls = MemMultiHeadRelativeAttentionKV
-        self.mha1 = attn_cls(n_heads, d_model, d_head, resid_p=resid_p, attn_p=attn_p, bias=bias, scale=scale, mem_len=mem_len, r_mask=False)
+        self.mha1 = attn_cls(n_heads, d_model, d_head, resid_p=resid_p, attn_p=attn_p, bias=bias, scale=scale, mem_len=mem_len, r_mask=False,
+                             fused_qkv=True)
         self.mha2 = attn_cls(n_heads, d_model, d_head, resid_p=resid_p, attn_p=attn_p, bias=bias, scale=scale, mem_len=mha2_mem_len, r_mask=True)
         self.ff   = feed_forward(d_model, d_inner, ff_p=ff_p, double_drop=double_drop)
     
@@ -176,18 +204,74 @@ class MTEncoderBlock(nn.Module):
 
 # Attn
 
+def param_key(mod:nn.Module):
+    "Changes whenever a parameter of `mod` is replaced or updated in place"
+    return tuple((p.data_ptr(), p._version) for p in mod.parameters())
+
+class KVMemory():
+    "Preallocated memory of the last `mem_len` steps. Written in place at a moving head, so memory + new steps is always one contiguous view"
+    def __init__(self, mem_len:int):
+        self.mem_len = mem_len
+        self.reset()
+
+    def reset(self):
+        self.buf,self.spare = None,None
+        self.head,self.len = 0,0
+
+    def alloc(self, x, x_cap):
+        # Room for 2*mem_len + x_cap steps: the live window only moves back to the front once every ~mem_len steps
+        buf = x.new_empty(x.shape[0], 2*self.mem_len + x_cap, *x.shape[2:])
+        if self.len: buf[:, :self.len] = self.buf[:, self.head-self.len:self.head]
+        self.buf,self.spare,self.head,self.x_cap = buf,None,self.len,x_cap
+
+    def append(self, x):
+        "Add `x` (bs, x_len, ...) to the memory. Returns the previous memory followed by `x`"
+        if self.mem_len == 0: return x
+        bs,x_len = x.shape[:2]
+        if self.buf is None or (self.buf.shape[0] != bs): # reset if wrong batch size
+            self.reset()
+            self.alloc(x, x_len)
+            self.write(x[:, -self.mem_len:])
+            return x
+        with torch.no_grad():
+            if x_len > self.x_cap: self.alloc(x, x_len)
+            elif self.head + x_len > self.buf.shape[1]:
+                self.buf[:, :self.len] = self.buf[:, self.head-self.len:self.head]
+                self.head = self.len
+            n_mem = self.len
+            self.write(x)
+        return self.buf[:, self.head-x_len-n_mem:self.head]
+
+    def write(self, x):
+        with torch.no_grad(): self.buf[:, self.head:self.head+x.shape[1]] = x
+        self.head += x.shape[1]
+        self.len = min(self.len + x.shape[1], self.mem_len)
+
+    def select(self, idxs):
+        "Reorder the rows of the memory - beam search/batched generation"
+        if self.buf is None: return
+        if len(idxs) != self.buf.shape[0]: self.buf,self.spare = self.buf.index_select(0, idxs),None
+        else:
+            if self.spare is None: self.spare = torch.empty_like(self.buf)
+            torch.index_select(self.buf, 0, idxs, out=self.spare)
+            self.buf,self.spare = self.spare,self.buf
+
 class MemMultiHeadRelativeAttentionKV(nn.Module):
     "Attention Layer monster - relative positioning, keeps track of own memory, separate kv weights to support sequence2sequence decoding."
+    "`fused_qkv` projects q, k and v with a single linear layer - self attention only (q, k, v are the same input)"
     def __init__(self, n_heads:int, d_model:int, d_head:int=None, resid_p:float=0., attn_p:float=0., bias:bool=True,
-                 scale:bool=True, mem_len:int=512, r_mask=True):
+                 scale:bool=True, mem_len:int=512, r_mask=True, fused_qkv=False):
         super().__init__()
         d_head = ifnone(d_head, d_model//n_heads)
         self.n_heads,self.d_head,self.scale = n_heads,d_head,scale
         
         assert(d_model == d_head * n_heads)
-        self.q_wgt = nn.Linear(d_model, n_heads * d_head, bias=bias)
-        self.k_wgt = nn.Linear(d_model, n_heads * d_head, bias=bias)
-        self.v_wgt = nn.Linear(d_model, n_heads * d_head, bias=bias)
+        self.fused_qkv = fused_qkv
+        if fused_qkv: self.qkv_wgt = nn.Linear(d_model, 3 * n_heads * d_head, bias=bias)
+        else:
+            self.q_wgt = nn.Linear(d_model, n_heads * d_head, bias=bias)
+            self.k_wgt = nn.Linear(d_model, n_heads * d_head, bias=bias)
+            self.v_wgt = nn.Linear(d_model, n_heads * d_head, bias=bias)
         
         self.drop_att,self.drop_res = nn.Dropout(attn_p),nn.Dropout(resid_p)
         self.ln = nn.LayerNorm(d_model)
@@ -195,8 +279,10 @@ class MemMultiHeadRelativeAttentionKV(nn.Module):
         self.r_mask = r_mask
 
         self.mem_len = mem_len
-        self.prev_k = None
-        self.prev_v = None
+        self.k_mem = KVMemory(mem_len)
+        self.v_mem = KVMemory(mem_len)
+        self.mem_projected = False
+        self.kv_cache,self.r_cache = None,None
         
     def forward(self, q:Tensor, k:Tensor=None, v:Tensor=None, 
                 r:Tensor=None, g_u:Tensor=None, g_v:Tensor=None, 
@@ -205,44 +291,89 @@ class MemMultiHeadRelativeAttentionKV(nn.Module):
         if v is None: v = q
         return self.ln(q + self.drop_res(self._apply_attention(q, k, v, r, g_u, g_v, mask=mask, **kwargs)))
 
-    def mem_k(self, k):
-        if self.mem_len == 0: return k
-        if self.prev_k is None or (self.prev_k.shape[0] != k.shape[0]): # reset if wrong batch size
-            self.prev_k = k[:, -self.mem_len:]
-            return k
-        with torch.no_grad():
-            k_ext = torch.cat([self.prev_k, k], dim=1)
-            self.prev_k = k_ext[:, -self.mem_len:]
-        return k_ext.detach()
+    def mem_k(self, k): return self.k_mem.append(k)
     
-    def mem_v(self, v):
-        if self.mem_len == 0: return v
-        if self.prev_v is None or (self.prev_v.shape[0] != v.shape[0]): # reset if wrong batch size
-            self.prev_v = v[:, -self.mem_len:]
-            return v
-        with torch.no_grad():
-            v_ext = torch.cat([self.prev_v, v], dim=1)
-            self.prev_v = v_ext[:, -self.mem_len:]
-        return v_ext.detach()
+    def mem_v(self, v): return self.v_mem.append(v)
         
     def reset(self):
-        self.prev_v = None
-        self.prev_k = None
+        self.k_mem.reset()
+        self.v_mem.reset()
+        self.mem_projected = False
+        self.kv_cache = None
+
+    def select_hidden(self, idxs):
+        self.k_mem.select(idxs)
+        self.v_mem.select(idxs)
         
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        # Checkpoints saved before fused projections have separate q/k/v weights
+        if self.fused_qkv and prefix+'q_wgt.weight' in state_dict:
+            for p in ['weight', 'bias']:
+                names = [f'{prefix}{n}_wgt.{p}' for n in 'qkv']
+                if names[0] in state_dict: state_dict[f'{prefix}qkv_wgt.{p}'] = torch.cat([state_dict.pop(n) for n in names])
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+
+    def project_qkv(self, x):
+        "Fused self attention projection - one GEMM for q, k and v of the new steps"
+        n = self.n_heads * self.d_head
+        if not self.training:
+            if self.mem_len > 0 and not self.mem_projected:
+                self.reset()
+                self.mem_projected = True
+            wq,wk,wv = self.qkv_wgt(x).split(n, dim=-1)
+            return wq,self.mem_k(wk),self.mem_v(wv)
+        if self.mem_projected: self.reset()
+        x_ext = self.mem_k(x) # raw memory (detached) followed by x - k and v share it
+        if x_ext is x: return self.qkv_wgt(x).split(n, dim=-1)
+        # Keys/values also cover the memory, queries only the new steps
+        wgt,bias = self.qkv_wgt.weight,self.qkv_wgt.bias
+        wq = F.linear(x, wgt[:n], None if bias is None else bias[:n])
+        wk,wv = F.linear(x_ext, wgt[n:], None if bias is None else bias[n:]).split(n, dim=-1)
+        return wq,wk,wv
+
+    def project_kv(self, q, k, v):
+        "Projected keys and values, with memory. At inference the memory keeps projected steps, so only new steps go through k_wgt/v_wgt"
+        if self.training:
+            if self.mem_projected: self.reset()
+            return self.k_wgt(self.mem_k(k)),self.v_wgt(self.mem_v(v))
+        if self.mem_len > 0:
+            if not self.mem_projected: 
+                self.reset()
+                self.mem_projected = True
+            return self.mem_k(self.k_wgt(k)),self.mem_v(self.v_wgt(v))
+        if k is not q: return self.static_kv(k, v)
+        return self.k_wgt(k),self.v_wgt(v)
+
+    def static_kv(self, k, v):
+        # Cross attention - the encoder output stays the same for every decoding step. Holding on to `k`/`v` keeps their storage from being reused
+        key = [(x.data_ptr(), x.shape, x.stride(), x._version) for x in (k, v)] + [param_key(self)]
+        if self.kv_cache is None or self.kv_cache[0] != key:
+            self.kv_cache = (key, self.k_wgt(k), self.v_wgt(v), k, v)
+        return self.kv_cache[1:3]
+
+    def project_r(self, r, seq_len):
+        if self.training: return self.r_attn(r[-seq_len:])
+        # `r` is the backwards relative encoding (see `relative_pos_enc`), so its last rows only depend on their distance
+        key = (r.device, r.dtype, param_key(self.r_attn))
+        if self.r_cache is None or self.r_cache[0] != key or self.r_cache[1].size(0) < seq_len:
+            self.r_cache = (key, self.r_attn(r))
+        return self.r_cache[1][-seq_len:]
+
     def _apply_attention(self, q:Tensor, k:Tensor, v:Tensor, 
                          r:Tensor=None, g_u:Tensor=None, g_v:Tensor=None, 
                          mask:Tensor=None, **kwargs):
         #Notations from the paper: x input, r vector of relative distance between two elements, u et v learnable
         #parameters of the model common between all layers, mask to avoid cheating and mem the previous hidden states.
 #         bs,x_len,seq_len = q.size(0),q.size(1),r.size(0)
-        k = self.mem_k(k)
-        v = self.mem_v(v)
-        bs,x_len,seq_len = q.size(0),q.size(1),k.size(1)
-        wq,wk,wv = self.q_wgt(q),self.k_wgt(k),self.v_wgt(v)
+        if self.fused_qkv: wq,wk,wv = self.project_qkv(q)
+        else:
+            wk,wv = self.project_kv(q, k, v)
+            wq = self.q_wgt(q)
+        bs,x_len,seq_len = q.size(0),q.size(1),wk.size(1)
         wq = wq[:,-x_len:]
         wq,wk,wv = map(lambda x:x.view(bs, x.size(1), self.n_heads, self.d_head), (wq,wk,wv))
         wq,wk,wv = wq.permute(0, 2, 1, 3),wk.permute(0, 2, 3, 1),wv.permute(0, 2, 1, 3)
-        wkr = self.r_attn(r[-seq_len:])
+        wkr = self.project_r(r, seq_len)
         wkr = wkr.view(seq_len, self.n_heads, self.d_head)
         wkr = wkr.permute(1,2,0)
         #### compute attention score (AC is (a) + (c) and BS is (b) + (d) in the paper)
@@ -0,0 +1,138 @@
+"TorchScript export of `MultiTransformer` - next word and seq2seq generation against the exported file"
+from fastai.basics import *
+from torch import Tensor
+from typing import List, Optional, Tuple
+from ..utils.jit import *
+from ..numpy_encode import SAMPLE_FREQ
+from ..vocab import *
+from ..music_transformer.transform import MusicItem
+from ..music_transformer.learner import LogitsProcessor
+from ..music_transformer.script import ScriptRunner, script_model
+
+class ScriptTransformerEmbedding(nn.Module):
+    "`TransformerEmbedding` without in place edits"
+    def __init__(self, embed:nn.Module):
+        super().__init__()
+        self.embed,self.beat_enc,self.bar_enc = embed.embed,embed.beat_enc,embed.bar_enc
+        self.beat_len,self.max_bar_len = embed.beat_len,embed.max_bar_len
+
+    def forward(self, x:Tensor, pos:Tensor)->Tensor:
+        bar_pos = (pos // self.beat_len % self.max_bar_len).clamp(max=self.max_bar_len-1)
+        return self.embed(x) + self.beat_enc(pos % self.beat_len) + self.bar_enc(bar_pos)
+
+class ScriptMTEncoderBlock(nn.Module):
+    "`MTEncoderBlock` - self attention only, or self attention, attention over the encoder output and feed forward"
+    def __init__(self, block:nn.Module, freq:Tensor, max_seq_len:int, causal:bool):
+        super().__init__()
+        mha1,mha2 = block.mha1,block.mha2
+        assert mha1.fused_qkv, 'self attention needs fused q/k/v weights'
+        self.mha1 = ScriptSelfAttention(mha1.qkv_wgt, RelativeProjection(mha1.r_attn, freq, max_seq_len), mha1.ln, None,
+                                        mha1.n_heads, mha1.d_head, mha1.mem_len, r_mask=mha1.r_mask, causal=causal)
+        self.mha2 = ScriptCrossAttention(mha2.q_wgt, mha2.k_wgt, mha2.v_wgt, RelativeProjection(mha2.r_attn, freq, max_seq_len), mha2.ln,
+                                         mha2.n_heads, mha2.d_head, r_mask=mha2.r_mask)
+        self.ff = ScriptFeedForward(block.ff)
+
+    def forward(self, x:Tensor, u:Tensor, v:Tensor, k_mem:Tensor, v_mem:Tensor,
+                enc_k:Optional[Tensor]=None, enc_v:Optional[Tensor]=None)->Tuple[Tensor,Tensor,Tensor]:
+        x,k_mem,v_mem = self.mha1(x, u, v, k_mem, v_mem)
+        if enc_k is None or enc_v is None: return x,k_mem,v_mem
+        return self.ff(self.mha2(x, u, v, enc_k, enc_v)),k_mem,v_mem
+
+class ScriptMultiTransformer(nn.Module):
+    "Inference-only `MultiTransformer`. Decoder memory (projected keys/values per layer) and encoder keys/values are passed in explicitly"
+    def __init__(self, model:nn.Module, max_seq_len:int=1024):
+        super().__init__()
+        encoder,decoder = model.encoder,model.decoder
+        freq = decoder.embed.pos_enc.freq
+        self.embed = ScriptTransformerEmbedding(decoder.embed)
+        self.enc_u,self.enc_v,self.dec_u,self.dec_v = encoder.u,encoder.v,decoder.u,decoder.v
+        self.n_hid = decoder.u.shape[0] * decoder.u.shape[2]
+        self.enc_layers = nn.ModuleList([ScriptMTEncoderBlock(b, freq, max_seq_len, causal=False) for b in encoder.layers])
+        self.dec_layers = nn.ModuleList([ScriptMTEncoderBlock(b, freq, max_seq_len, causal=True) for b in decoder.layers])
+        self.head = model.head.decoder
+
+    @torch.jit.export
+    def init_state(self, bs:int)->Tuple[List[Tensor],List[Tensor]]:
+        "Empty decoder memory for `bs` rows"
+        k_mem = [self.dec_u.new_zeros(bs, 0, self.n_hid) for _ in range(len(self.dec_layers))]
+        v_mem = [self.dec_u.new_zeros(bs, 0, self.n_hid) for _ in range(len(self.dec_layers))]
+        return k_mem,v_mem
+
+    @torch.jit.export
+    def encode(self, x:Tensor, pos:Tensor)->Tuple[List[Tensor],List[Tensor]]:
+        "Encoder pass over `x`, projected to the keys/values of each decoder layer's encoder attention"
+        out = self.embed(x, pos)
+        empty = out.new_zeros(out.size(0), 0, self.n_hid)
+        for layer in self.enc_layers: out,_,_ = layer(out, self.enc_u, self.enc_v, empty, empty)
+        enc_k,enc_v = [],[]
+        for layer in self.dec_layers:
+            k,v = layer.mha2.project_kv(out)
+            enc_k.append(k)
+            enc_v.append(v)
+        return enc_k,enc_v
+
+    @torch.jit.export
+    def s2s_step(self, x:Tensor, pos:Tensor, enc_k:List[Tensor], enc_v:List[Tensor],
+                 k_mem:List[Tensor], v_mem:List[Tensor])->Tuple[Tensor,List[Tensor],List[Tensor]]:
+        "Logits of the last step of the counter-part `x` given the `encode`d input, and the updated memory"
+        inp = self.embed(x, pos)
+        new_k,new_v = [],[]
+        for i,layer in enumerate(self.dec_layers):
+            inp,k,v = layer(inp, self.dec_u, self.dec_v, k_mem[i], v_mem[i], enc_k[i], enc_v[i])
+            new_k.append(k)
+            new_v.append(v)
+        return self.head(inp[:, -1]),new_k,new_v
+
+    def forward(self, x:Tensor, pos:Tensor, k_mem:List[Tensor], v_mem:List[Tensor])->Tuple[Tensor,List[Tensor],List[Tensor]]:
+        "Next word - logits of the last step of `x` (bs,x_len) and the updated memory"
+        inp = self.embed(x, pos)
+        new_k,new_v = [],[]
+        for i,layer in enumerate(self.dec_layers):
+            inp,k,v = layer(inp, self.dec_u, self.dec_v, k_mem[i], v_mem[i])
+            new_k.append(k)
+            new_v.append(v)
+        return self.head(inp[:, -1]),new_k,new_v
+
+class MultitaskScriptRunner(ScriptRunner):
+    "`ScriptRunner` for an exported `MultiTransformer` - next word (`predict_nw`) and seq2seq (`predict_s2s`)"
+    def predict_nw(self, item:MusicItem, **kwargs): return self.predict(item, **kwargs)
+
+    def predict_s2s(self, input_item:MusicItem, target_item:MusicItem, n_words:int=256,
+                    temperatures:float=(1.0,1.0), top_k=30, top_p=0.8):
+        "Predict the counter-part of `input_item` after `target_item`. Same sampling as `MultitaskLearner.predict_s2s`"
+        vocab = self.vocab
+        inp, inp_pos = input_item.to_tensor(self.device), input_item.get_pos_tensor(self.device)
+        with torch.no_grad(): enc_k, enc_v = self.model.encode(inp[None], inp_pos[None])
+
+        targ = target_item.data.tolist()
+        targ_pos = target_item.position.tolist()
+        last_pos = targ_pos[-1]
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p)
+        k_mem, v_mem = self.model.init_state(1)
+
+        max_pos = input_item.position[-1] + SAMPLE_FREQ * 4 # Only predict until both tracks/parts have the same length
+        x, pos = inp.new_tensor(targ), inp_pos.new_tensor(targ_pos)
+
+        for i in progress_bar(range(n_words), leave=True):
+            with torch.no_grad():
+                logits, k_mem, v_mem = self.model.s2s_step(x[None], pos[None], enc_k, enc_v, k_mem, v_mem)
+
+            prev_idx = targ[-1] if len(targ) else vocab.pad_idx
+            idx = processor.sample(logits, [prev_idx]).item()
+
+            if idx == vocab.bos_idx | idx == vocab.stoi[EOS]:
+                print('Predicting BOS/EOS')
+                break
+
+            if prev_idx == vocab.sep_idx:
+                duration = idx - vocab.dur_range[0]
+                last_pos = last_pos + duration
+                if last_pos > max_pos:
+                    print('Predicted past counter-part length. Returning early')
+                    break
+
+            targ_pos.append(last_pos)
+            targ.append(idx)
+            x, pos = inp.new_tensor([targ[-1]]), inp_pos.new_tensor([targ_pos[-1]])
+
+        return vocab.to_music_item(np.array(targ))
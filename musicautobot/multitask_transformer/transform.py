@@ -44,10 +44,12 @@ class MultitrackItem():
     
     def to_stream(self, bpm=120):
         ps = self.melody.to_npenc(), self.chords.to_npenc()
-        ps = [npenc2chordarr(p) for p in ps]
+        ps = npenc2chordarr(list(ps))
         chordarr = chordarr_combine_parts(ps)
         return chordarr2stream(chordarr, bpm=bpm)
 
+    def to_midi_bytes(self, bpm=120):
+        return npenc_parts2midi_bytes((self.melody.to_npenc(), self.chords.to_npenc()), bpm=bpm)
     
     def show(self, format:str=None):
         return self.stream.show(format)
@@ -63,6 +65,4 @@ class MultitrackItem():
 def combine2chordarr(np1, np2, vocab):
     if len(np1.shape) == 1: np1 = idxenc2npenc(np1, vocab)
     if len(np2.shape) == 1: np2 = idxenc2npenc(np2, vocab)
-    p1 = npenc2chordarr(np1)
-    p2 = npenc2chordarr(np2)
-    return chordarr_combine_parts((p1, p2))
+    return chordarr_combine_parts(npenc2chordarr([np1, np2]))
@@ -1,3 +1,4 @@
 from .dataloader import *
 from .model import *
-from .learner import *
\ No newline at end of file
+from .learner import *
+from .script import *
\ No newline at end of file
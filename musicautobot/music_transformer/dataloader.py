@@ -19,9 +19,8 @@ class MusicDataBunch(DataBunch):
         val_bs = ifnone(val_bs, bs)
         datasets = [preloader_cls(ds, shuffle=(i==0), bs=(bs if i==0 else val_bs), bptt=bptt, transpose_range=transpose_range, **kwargs) 
                     for i,ds in enumerate(datasets)]
-        val_bs = bs
         dl_tfms = [partially_apply_vocab(tfm, train_ds.vocab) for tfm in listify(dl_tfms)]
-        dls = [DataLoader(d, b, shuffle=shuffle_dl) for d,b in zip(datasets, (bs,val_bs,val_bs,val_bs)) if d is not None]
+        dls = [preloader_dl(d, b, shuffle_dl) for d,b in zip(datasets, (bs,val_bs,val_bs,val_bs)) if d is not None]
         return cls(*dls, path=path, device=device, dl_tfms=dl_tfms, collate_fn=collate_fn, no_check=no_check)
     
     @classmethod    
@@ -32,6 +31,7 @@ class MusicDataBunch(DataBunch):
     @classmethod
     def from_files(cls, files, path, processors=None, split_pct=0.1, 
                    vocab=None, list_cls=None, **kwargs):
+        if isinstance(files, TokenCorpus): return cls.from_corpus(files, path, split_pct=split_pct, vocab=vocab, **kwargs)
         if vocab is None: vocab = MusicVocab.create()
         if list_cls is None: list_cls = MusicItemList
         src = (list_cls(items=files, path=path, processor=processors, vocab=vocab)
@@ -39,12 +39,26 @@ class MusicDataBunch(DataBunch):
                 .label_const(label_cls=LMLabelList))
         return src.databunch(**kwargs)
 
+    @classmethod
+    def from_corpus(cls, corpus, path=None, split_pct=0.1, vocab=None, **kwargs):
+        "Opens a memory-mapped `TokenCorpus`. Items are read lazily, nothing is copied into memory"
+        if not isinstance(corpus, TokenCorpus): corpus = TokenCorpus(corpus)
+        if vocab is None: vocab = MusicVocab.create()
+        src = MusicItemList.from_corpus(corpus, path=ifnone(path, corpus.path), vocab=vocab)
+        src = src.split_by_idx(corpus.valid_idx) if corpus.valid_idx is not None else src.split_by_rand_pct(split_pct, seed=6)
+        return src.label_const(label_cls=LMLabelList).databunch(**kwargs)
+
     @classmethod
     def empty(cls, path, **kwargs):
         vocab = MusicVocab.create()
         src = MusicItemList([], path=path, vocab=vocab, ignore_empty=True).split_none()
         return src.label_const(label_cls=LMLabelList).databunch()
         
+def preloader_dl(preloader, bs, shuffle=False):
+    "`DataLoader` over a preloader. Bucketed preloaders (see `S2SPreloader.bucket`) lay out whole batches in order and shuffle them themselves"
+    if getattr(preloader, 'bucket', False): shuffle = False
+    return DataLoader(preloader, bs, shuffle=shuffle)
+
 def partially_apply_vocab(tfm, vocab):
     if 'vocab' in inspect.getfullargspec(tfm).args:
         return partial(tfm, vocab=vocab)
@@ -53,21 +67,87 @@ def partially_apply_vocab(tfm, vocab):
 class MusicItemList(ItemList):
     _bunch = MusicDataBunch
     
-    def __init__(self, items:Iterator, vocab:MusicVocab=None, **kwargs):
+    def __init__(self, items:Iterator, vocab:MusicVocab=None, corpus:'TokenCorpus'=None, **kwargs):
         super().__init__(items, **kwargs)
         self.vocab = vocab
-        self.copy_new += ['vocab']
+        self.corpus = corpus
+        self.copy_new += ['vocab', 'corpus']
+
+    @classmethod
+    def from_corpus(cls, corpus, vocab:MusicVocab=None, **kwargs):
+        "Items are indexes into a memory-mapped `TokenCorpus`"
+        if not isinstance(corpus, TokenCorpus): corpus = TokenCorpus(corpus)
+        return cls(np.arange(len(corpus)), vocab=vocab, corpus=corpus, **kwargs)
     
     def get(self, i):
+        if self.corpus is not None: return MusicItem.from_idx(self.corpus[self.items[i]], self.vocab)
         o = super().get(i)
         if is_pos_enc(o): 
             return MusicItem.from_idx(o, self.vocab)
         return MusicItem(o, self.vocab)
 
+    def item_lengths(self):
+        "Number of tokens in each item"
+        if self.corpus is not None: return self.corpus.lengths[self.items]
+        return np.array([len(item) for item in self], dtype=np.int64)
+
 def is_pos_enc(idxenc):
     if len(idxenc.shape) == 2 and idxenc.shape[0] == 2: return True
     return idxenc.dtype == np.object and idxenc.shape == (2,)
 
+class TokenCorpus():
+    "Ragged array of (idx, pos) items. Stored as flat int16 tokens, int32 positions and an offsets index - all memory-mapped"
+    tok_file,pos_file,offsets_file,valid_file = 'tokens.i16','positions.i32','offsets.npy','valid_idx.npy'
+
+    def __init__(self, path:PathOrStr):
+        self.path = Path(path)
+        self.open()
+
+    def open(self):
+        "Maps the corpus files. Nothing is read until items are accessed"
+        self.offsets = np.load(self.path/self.offsets_file, mmap_mode='r')
+        self.tokens = self.map_file(self.tok_file, np.int16)
+        self.positions = self.map_file(self.pos_file, np.int32)
+        valid_path = self.path/self.valid_file
+        self.valid_idx = np.load(valid_path, mmap_mode='r') if valid_path.exists() else None
+
+    def map_file(self, fn, dtype):
+        num_toks = int(self.offsets[-1])
+        if num_toks == 0: return np.zeros(0, dtype=dtype) # np.memmap can't map empty files
+        return np.memmap(self.path/fn, dtype=dtype, mode='r', shape=(num_toks,))
+
+    # Workers and ranks reopen the files instead of pickling the data
+    def __getstate__(self): return {'path': self.path}
+    def __setstate__(self, state):
+        self.path = state['path']
+        self.open()
+
+    def __len__(self): return len(self.offsets)-1
+    def __getitem__(self, i):
+        start,end = self.offsets[i],self.offsets[i+1]
+        return np.asarray(self.tokens[start:end]), np.asarray(self.positions[start:end])
+    def __repr__(self): return f'{self.__class__.__name__} ({len(self)} items, {int(self.offsets[-1])} tokens)\nPath: {self.path}'
+
+    @property
+    def lengths(self): return np.diff(self.offsets)
+
+    @classmethod
+    def create(cls, path:PathOrStr, items:Iterator, valid_idx:Collection[int]=None):
+        "Writes (idx, pos) items to `path` one at a time"
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        offsets = [0]
+        with open(path/cls.tok_file, 'wb') as tok_f, open(path/cls.pos_file, 'wb') as pos_f:
+            for idx,pos in items:
+                idx = np.asarray(idx)
+                assert idx.max(initial=0) <= np.iinfo(np.int16).max, 'Vocab too large for int16 tokens'
+                tok_f.write(np.asarray(idx, dtype=np.int16).tobytes())
+                pos_f.write(np.asarray(pos, dtype=np.int32).tobytes())
+                offsets.append(offsets[-1] + len(idx))
+        np.save(path/cls.offsets_file, np.array(offsets, dtype=np.int64))
+        if valid_idx is not None: np.save(path/cls.valid_file, np.array(valid_idx, dtype=np.int64))
+        return cls(path)
+
 class MusicItemProcessor(PreProcessor):
     "`PreProcessor` that transforms numpy files to indexes for training"
     def process_one(self,item):
@@ -84,9 +164,14 @@ class OpenNPFileProcessor(PreProcessor):
         return np.load(item, allow_pickle=True) if isinstance(item, Path) else item
 
 class Midi2ItemProcessor(PreProcessor):
-    "Skips midi preprocessing step. And encodes midi files to MusicItems"
+    "Skips midi preprocessing step. And encodes midi files to MusicItems. `fast` reads notes without music21, window by window"
+    def __init__(self, ds:Collection=None, fast:bool=False):
+        super().__init__(ds)
+        self.fast = fast
+
     def process_one(self,item):
-        item = MusicItem.from_file(item, vocab=self.vocab)
+        if self.fast: item = MusicItem.from_windows(iter_item_windows(item, self.vocab), self.vocab)
+        else: item = MusicItem.from_file(item, vocab=self.vocab)
         return item.to_idx()
     
     def process(self, ds):
@@ -107,7 +192,7 @@ class MusicPreloader(Callback):
 
     def __init__(self, dataset:LabelList, lengths:Collection[int]=None, bs:int=32, bptt:int=70, backwards:bool=False, 
                  shuffle:bool=False, y_offset:int=1, 
-                 transpose_range=None, transpose_p=0.5,
+                 transpose_range=None, transpose_p=0.5, batch_transpose=False,
                  encode_position=True,
                  **kwargs):
         self.dataset,self.bs,self.bptt,self.shuffle,self.backwards,self.lengths = dataset,bs,bptt,shuffle,backwards,lengths
@@ -117,14 +202,17 @@ class MusicPreloader(Callback):
         self.y_offset = y_offset
         
         self.transpose_range,self.transpose_p = transpose_range,transpose_p
+        # batch_transpose: send per-row transpose offsets with the batch and leave transposing to `batch_transpose_tfm`
+        self.batch_transpose = batch_transpose
         self.encode_position = encode_position
         self.bptt_len = self.bptt
+        self.buffers = None
         
         self.allocate_buffers() # needed for valid_dl on distributed training - otherwise doesn't get initialized on first epoch
 
     def __len__(self): 
         if self.ite_len is None:
-            if self.lengths is None: self.lengths = np.array([len(item) for item in self.dataset.x])
+            if self.lengths is None: self.lengths = self.dataset.x.item_lengths()
             self.totalToks = self.lengths.sum()
             self.ite_len   = self.bs*int( math.ceil( self.totalToks/(self.bptt*self.bs) )) if self.item is None else 1
         return self.ite_len
@@ -134,28 +222,42 @@ class MusicPreloader(Callback):
     def allocate_buffers(self):
         "Create the ragged array that will be filled when we ask for items."
         if self.ite_len is None: len(self)
-        self.idx   = MusicPreloader.CircularIndex(len(self.dataset.x), not self.backwards)
+        self.idx   = MusicPreloader.CircularIndex(len(self.lengths), not self.backwards)
         
         # batch shape = (bs, bptt, 2 - [index, pos]) if encode_position. Else - (bs, bptt)
         buffer_len = (2,) if self.encode_position else ()
         self.batch = np.zeros((self.bs, self.bptt+self.y_offset) + buffer_len, dtype=np.int64)
         self.batch_x, self.batch_y = self.batch[:,0:self.bptt], self.batch[:,self.y_offset:self.bptt+self.y_offset] 
-        #ro: index of the text we're at inside our datasets for the various batches
-        self.ro    = np.zeros(self.bs, dtype=np.int64)
-        #ri: index of the token we're at inside our current text for the various batches
-        self.ri    = np.zeros(self.bs, dtype=np.int)
+        # Built once here, in the parent process - forked workers share the buffers instead of building their own
+        if self.buffers is None: self.buffers = self.corpus_buffers()
+        self.reset_rows()
         
         # allocate random transpose values. Need to allocate this before hand.
         self.transpose_values = self.get_random_transpose_values()
         
     def get_random_transpose_values(self):
         if self.transpose_range is None: return None
-        n = len(self.dataset)
+        n = self.bs if self.batch_transpose else len(self.dataset)
         rt_arr = torch.randint(*self.transpose_range, (n,))-self.transpose_range[1]//2
         mask = torch.rand(rt_arr.shape) > self.transpose_p
         rt_arr[mask] = 0
         return rt_arr
 
+    def corpus_buffers(self):
+        "Contiguous token and position buffers, with the buffer offset of each item. Memory-mapped corpora are used in place"
+        items = self.dataset.x
+        if getattr(items, 'corpus', None) is not None:
+            return items.corpus.tokens, items.corpus.positions, np.asarray(items.corpus.offsets)[items.items]
+        # Same dtypes as `TokenCorpus`. Filled item by item - no int64 copy of the whole dataset
+        starts = np.cumsum(self.lengths) - self.lengths
+        tokens = np.empty(self.totalToks, dtype=np.int16)
+        positions = np.empty(self.totalToks, dtype=np.int32) if self.encode_position else None
+        for i,start in enumerate(starts):
+            item = items[i]
+            tokens[start:start+len(item.data)] = item.data
+            if self.encode_position: positions[start:start+len(item.data)] = item.position
+        return tokens, positions, starts
+
     def on_epoch_begin(self, **kwargs):
         if self.idx is None: self.allocate_buffers()
         elif self.shuffle:   
@@ -164,17 +266,15 @@ class MusicPreloader(Callback):
             self.transpose_values = self.get_random_transpose_values()
             self.bptt_len = self.bptt
         self.idx.forward = not self.backwards 
+        self.reset_rows()
 
+    def reset_rows(self):
+        "Spread the batch rows evenly over the token stream of this epoch"
+        # token stream - items in `idx` order (reversed and read back to front if backwards)
+        self.stream_items = self.idx.idx if self.idx.forward else self.idx.idx[::-1]
+        self.stream_ends = np.cumsum(self.lengths[self.stream_items])
         step = self.totalToks / self.bs
-        ln_rag, countTokens, i_rag = 0, 0, -1
-        for i in range(0,self.bs):
-            #Compute the initial values for ro and ri 
-            while ln_rag + countTokens <= int(step * i):
-                countTokens += ln_rag
-                i_rag       += 1
-                ln_rag       = self.lengths[self.idx[i_rag]]
-            self.ro[i] = i_rag
-            self.ri[i] = ( ln_rag - int(step * i - countTokens) ) if self.backwards else int(step * i - countTokens)
+        self.row_pos = (step * np.arange(self.bs)).astype(np.int64)
         
     #Training dl gets on_epoch_begin called, val_dl, on_epoch_end
     def on_epoch_end(self, **kwargs): self.on_epoch_begin()
@@ -184,39 +284,38 @@ class MusicPreloader(Callback):
         if j==0:
             if self.item is not None: return self.dataset[0]
             if self.idx is None: self.on_epoch_begin()
-                
-        self.ro[j],self.ri[j] = self.fill_row(not self.backwards, self.dataset.x, self.idx, self.batch[j][:self.bptt_len+self.y_offset], 
-                                              self.ro[j], self.ri[j], overlap=1, lengths=self.lengths)
+            self.fill_batch(self.batch[:, :self.bptt_len+self.y_offset], overlap=1)
+        if self.batch_transpose:
+            value = self.transpose_values[j] if self.transpose_values is not None else 0
+            return self.batch_x[j][:self.bptt_len], self.batch_y[j][:self.bptt_len], value
         return self.batch_x[j][:self.bptt_len], self.batch_y[j][:self.bptt_len]
 
-    def fill_row(self, forward, items, idx, row, ro, ri, overlap, lengths):
-        "Fill the row with tokens from the ragged array. --OBS-- overlap != 1 has not been implemented"
-        ibuf = n = 0 
-        ro  -= 1
-        while ibuf < row.shape[0]:  
-            ro   += 1 
-            ix    = idx[ro]
-            
-            item = items[ix]
-            if self.transpose_values is not None: 
-                item = item.transpose(self.transpose_values[ix].item())
-                
-            if self.encode_position:
-                # Positions are colomn stacked with indexes. This makes it easier to keep in sync
-                rag = np.stack([item.data, item.position], axis=1)
-            else:
-                rag = item.data
-                
-            if forward:
-                ri = 0 if ibuf else ri
-                n  = min(lengths[ix] - ri, row.shape[0] - ibuf)
-                row[ibuf:ibuf+n] = rag[ri:ri+n]
-            else:    
-                ri = lengths[ix] if ibuf else ri
-                n  = min(ri, row.size - ibuf) 
-                row[ibuf:ibuf+n] = rag[ri-n:ri][::-1]
-            ibuf += n
-        return ro, ri + ((n-overlap) if forward else -(n-overlap))
+    def fill_batch(self, batch, overlap):
+        "Fill all rows with one gather from the contiguous token buffer. --OBS-- overlap != 1 has not been implemented"
+        tokens, positions, item_starts = self.buffers
+        row_len = batch.shape[1]
+        
+        # stream position -> item -> buffer index, for every token in the batch
+        stream_pos = (self.row_pos[:,None] + np.arange(row_len)) % self.stream_ends[-1]
+        k = np.searchsorted(self.stream_ends, stream_pos, side='right')
+        ix = self.stream_items[k]
+        ri = stream_pos - (self.stream_ends[k] - self.lengths[ix])
+        if self.backwards: ri = self.lengths[ix] - 1 - ri
+        buf_idx = item_starts[ix] + ri
+        
+        x = tokens[buf_idx].astype(np.int64)
+        if self.transpose_values is not None and not self.batch_transpose:
+            # transpose notes of the whole batch at once, each token by its item's value
+            note_range = self.vocab.note_range
+            is_note = (x >= note_range[0]) & (x < note_range[1])
+            x += is_note * self.transpose_values.numpy()[ix]
+        
+        if self.encode_position:
+            # Positions are colomn stacked with indexes. This makes it easier to keep in sync
+            batch[...,0] = x
+            batch[...,1] = positions[buf_idx]
+        else: batch[:] = x
+        self.row_pos += row_len - overlap
 
 def batch_position_tfm(b):
     "Batch transform for training with positional encoding"
@@ -226,4 +325,19 @@ def batch_position_tfm(b):
         'pos': x[...,1]
     }
     return x, y[...,0]
-    
\ No newline at end of file
+
+def transpose_notes(x, values, note_range):
+    "Transpose the note tokens of each row of `x` by its value in `values` with one masked add"
+    values = values.to(x.device).view(-1, *[1]*(x.dim()-1))
+    is_note = (x >= note_range[0]) & (x < note_range[1])
+    return x + is_note.long() * values
+
+def batch_transpose_tfm(b, vocab):
+    "Batch transform for `MusicPreloader(batch_transpose=True)`. Applies the per-row transpose offsets - goes before `batch_position_tfm`"
+    x,y,values = b
+    if x.dim() == 3:
+        # positions are stacked with indexes, only transpose the indexes
+        x = torch.stack([transpose_notes(x[...,0], values, vocab.note_range), x[...,1]], dim=-1)
+        y = torch.stack([transpose_notes(y[...,0], values, vocab.note_range), y[...,1]], dim=-1)
+        return x, y
+    return transpose_notes(x, values, vocab.note_range), transpose_notes(y, values, vocab.note_range)
@@ -1,16 +1,17 @@
 from fastai.basics import *
 from fastai.text.learner import LanguageLearner, get_language_model, _model_meta
 from .model import *
-from .transform import MusicItem
+from .transform import MusicItem, iter_item_windows
 from ..numpy_encode import SAMPLE_FREQ
 from ..utils.top_k_top_p import top_k_top_p
 from ..utils.midifile import is_empty_midi
+from ..utils.quantize import quantize_model
 
 _model_meta[MusicTransformerXL] = _model_meta[TransformerXL] # copy over fastai's model metadata
 
 def music_model_learner(data:DataBunch, arch=MusicTransformerXL, config:dict=None, drop_mult:float=1.,
-                        pretrained_path:PathOrStr=None, **learn_kwargs) -> 'LanguageLearner':
-    "Create a `Learner` with a language model from `data` and `arch`."
+                        pretrained_path:PathOrStr=None, quantize:bool=False, **learn_kwargs) -> 'LanguageLearner':
+    "Create a `Learner` with a language model from `data` and `arch`. `quantize` gives a dynamic int8 model for CPU inference"
     meta = _model_meta[arch]
 
     if pretrained_path: 
@@ -22,12 +23,17 @@ def music_model_learner(data:DataBunch, arch=MusicTransformerXL, config:dict=Non
 
     if pretrained_path: 
         get_model(model).load_state_dict(state['model'], strict=False)
-        if not hasattr(learn, 'opt'): learn.create_opt(defaults.lr, learn.wd)
+        if not hasattr(learn, 'opt') and not quantize: learn.create_opt(defaults.lr, learn.wd)
         try:    learn.opt.load_state_dict(state['opt'])
         except: pass
         del state
         gc.collect()
 
+    if quantize:
+        learn.model = quantize_model(learn.model) # inference only - no optimizer state
+        learn.data.device = torch.device('cpu') # int8 kernels are CPU only
+        for dl in learn.data.dls: dl.device = learn.data.device
+
     return learn
 
 # Predictions
@@ -44,35 +50,33 @@ class MusicLearner(LanguageLearner):
             gc.collect()
         return out_path
 
-    def beam_search(self, xb:Tensor, n_words:int, top_k:int=10, beam_sz:int=10, temperature:float=1.,
-                    ):
-        "Return the `n_words` that come after `text` using beam search."
+    def export_script(self, path:PathOrStr, max_seq_len:int=1024, freeze:bool=True):
+        "Save a frozen TorchScript version of the model and the vocab to `path`. Generate with `ScriptRunner.load(path)`"
+        from .script import ScriptMusicTransformer, script_model, save_script # script.py imports this module
+        model = script_model(ScriptMusicTransformer(self.model.eval(), max_seq_len=max_seq_len), freeze=freeze, preserved_attrs=('init_state',))
+        save_script(model, path, self.data.vocab, model='music', max_seq_len=max_seq_len)
+        return path
+
+    def beam_search(self, item:MusicItem, n_words:int=128, top_k:int=10, beam_sz:int=10, temperature:float=1.,
+                    min_bars=4):
+        "Return the `n_words` that come after `item` using beam search. Beat positions are tracked per beam"
         self.model.reset()
         self.model.eval()
-        xb_length = xb.shape[-1]
-        if xb.shape[0] > 1: xb = xb[0][None]
-        yb = torch.ones_like(xb)
-
-        nodes = None
-        xb = xb.repeat(top_k, 1)
-        nodes = xb.clone()
-        scores = xb.new_zeros(1).float()
-        with torch.no_grad():
-            for k in progress_bar(range(n_words), leave=False):
-                out = F.log_softmax(self.model(xb)[0][:,-1], dim=-1)
-                values, indices = out.topk(top_k, dim=-1)
-                scores = (-values + scores[:,None]).view(-1)
-                indices_idx = torch.arange(0,nodes.size(0))[:,None].expand(nodes.size(0), top_k).contiguous().view(-1)
-                sort_idx = scores.argsort()[:beam_sz]
-                scores = scores[sort_idx]
-                nodes = torch.cat([nodes[:,None].expand(nodes.size(0),top_k,nodes.size(1)),
-                                indices[:,:,None].expand(nodes.size(0),top_k,1),], dim=2)
-                nodes = nodes.view(-1, nodes.size(2))[sort_idx]
-                self.model[0].select_hidden(indices_idx[sort_idx])
-                xb = nodes[:,-1][:,None]
-        if temperature != 1.: scores.div_(temperature)
-        node_idx = torch.multinomial(torch.exp(-scores), 1).item()
-        return [i.item() for i in nodes[node_idx][xb_length:] ]
+        vocab = self.data.vocab
+        x, pos = item.to_tensor(self.data.device), item.get_pos_tensor(self.data.device)
+        encode_position = getattr(self.model[0], 'encode_position', False)
+        def step(x, pos):
+            with torch.no_grad():
+                batch = { 'x': x, 'pos': pos } if encode_position else x
+                return self.model[1].decoder(self.model[0](batch)[1][-1][:,-1]) # head on the last position only
+
+        start_pos = pos[-1] if len(pos) else 0
+        search = BeamSearch(vocab, step, self.model[0].select_hidden, beam_sz=beam_sz, top_k=top_k, min_bars=min_bars)
+        new_idx = search(step(x[None], pos[None]), start_pos, n_words, temperature=temperature)
+
+        pred = vocab.to_music_item(np.array(new_idx))
+        full = item.append(pred)
+        return pred, full
 
     def predict(self, item:MusicItem, n_words:int=128,
                      temperatures:float=(1.0,1.0), min_bars=4,
@@ -81,7 +85,7 @@ class MusicLearner(LanguageLearner):
         self.model.reset()
         new_idx = []
         vocab = self.data.vocab
-        x, pos = item.to_tensor(), item.get_pos_tensor()
+        x, pos = item.to_tensor(self.data.device), item.get_pos_tensor(self.data.device)
         last_pos = pos[-1] if len(pos) else 0
         y = torch.tensor([0])
 
@@ -91,7 +95,7 @@ class MusicLearner(LanguageLearner):
         bar_len = SAMPLE_FREQ * 4 # assuming 4/4 time
         vocab = self.data.vocab
 
-        repeat_count = 0
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p)
         if hasattr(self.model[0], 'encode_position'):
             encode_position = self.model[0].encode_position
         else: encode_position = False
@@ -100,36 +104,16 @@ class MusicLearner(LanguageLearner):
             with torch.no_grad():
                 if encode_position:
                     batch = { 'x': x[None], 'pos': pos[None] }
-                    logits = self.model(batch)[0][-1][-1]
+                    hidden = self.model[0](batch)[1][-1][:,-1]
                 else:
-                    logits = self.model(x[None])[0][-1][-1]
+                    hidden = self.model[0](x[None])[1][-1][:,-1]
 
             prev_idx = new_idx[-1] if len(new_idx) else vocab.pad_idx
+            logits = processor.head_logits(self.model[1], hidden, [prev_idx])
 
-            # Temperature
-            # Use first temperatures value if last prediction was duration
-            temperature = temperatures[0] if vocab.is_duration_or_pad(prev_idx) else temperatures[1]
-            repeat_penalty = max(0, np.log((repeat_count+1)/4)/5) * temperature
-            temperature += repeat_penalty
-            if temperature != 1.: logits = logits / temperature
-                
-
-            # Filter
             # bar = 16 beats
-            filter_value = -float('Inf')
-            if ((last_pos - start_pos) // 16) <= min_bars: logits[vocab.bos_idx] = filter_value
-
-            logits = filter_invalid_indexes(logits, prev_idx, vocab, filter_value=filter_value)
-            logits = top_k_top_p(logits, top_k=top_k, top_p=top_p, filter_value=filter_value)
-            
-            # Sample
-            probs = F.softmax(logits, dim=-1)
-            idx = torch.multinomial(probs, 1).item()
-
-            # Update repeat count
-            num_choices = len(probs.nonzero().view(-1))
-            if num_choices <= 2: repeat_count += 1
-            else: repeat_count = repeat_count // 2
+            filter_bos = ((last_pos - start_pos) // 16) <= min_bars
+            idx = processor.sample(logits, [prev_idx], filter_bos=[filter_bos]).item()
 
             if prev_idx==vocab.sep_idx: 
                 duration = idx - vocab.dur_range[0]
@@ -152,20 +136,208 @@ class MusicLearner(LanguageLearner):
         pred = vocab.to_music_item(np.array(new_idx))
         full = item.append(pred)
         return pred, full
-    
+
+    def predict_batch(self, item:MusicItem, n_samples:int=4, n_words:int=128,
+                     temperatures:float=(1.0,1.0), min_bars=4,
+                     top_k=30, top_p=0.6):
+        "Return `n_samples` continuations of `item`, sampled as one batch. Same sampling rules as `predict`, tracked per row"
+        self.model.reset()
+        vocab = self.data.vocab
+        x, pos = item.to_tensor(self.data.device), item.get_pos_tensor(self.data.device)
+        encode_position = getattr(self.model[0], 'encode_position', False)
+        def next_hidden(x, pos):
+            with torch.no_grad():
+                batch = { 'x': x, 'pos': pos } if encode_position else x
+                return self.model[0](batch)[1][-1][:,-1]
+
+        # seed is shared - run it once, then copy its XL memory to every row
+        hidden = next_hidden(x[None], pos[None]).expand(n_samples, -1)
+        self.model[0].select_hidden(torch.zeros(n_samples, dtype=torch.long, device=x.device))
+
+        # per row state. `rows` maps the rows still generating to their sample
+        rows = torch.arange(n_samples, device=x.device)
+        new_idx = [[] for _ in range(n_samples)]
+        prev_idx = torch.full((n_samples,), vocab.pad_idx, dtype=torch.long, device=x.device)
+        start_pos = pos[-1] if len(pos) else 0
+        last_pos = torch.full((n_samples,), int(start_pos), dtype=torch.long, device=x.device)
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p)
+
+        for i in progress_bar(range(n_words), leave=True):
+            # bar = 16 beats
+            logits = processor.head_logits(self.model[1], hidden, prev_idx)
+            idx = processor.sample(logits, prev_idx, filter_bos=((last_pos - start_pos) // 16) <= min_bars)
+
+            is_sep = prev_idx == vocab.sep_idx
+            last_pos = torch.where(is_sep, last_pos + idx - vocab.dur_range[0], last_pos)
+            done = is_sep & ((last_pos // 16) % 4 == 0) if (i / n_words > 0.80) else torch.zeros_like(is_sep)
+            done = done | (idx == vocab.bos_idx)
+
+            for r,tok in zip(rows[~done].tolist(), idx[~done].tolist()): new_idx[r].append(tok)
+
+            # retire finished rows, the others keep going
+            if done.any():
+                keep = (~done).nonzero().view(-1)
+                if len(keep) == 0: break
+                self.model[0].select_hidden(keep)
+                processor.select(keep)
+                rows,idx,last_pos = rows[keep],idx[keep],last_pos[keep]
+            prev_idx = idx
+            if i == n_words-1: break
+            hidden = next_hidden(idx[:,None], last_pos[:,None])
+
+        preds = [vocab.to_music_item(np.array(idxs)) for idxs in new_idx]
+        return preds, [item.append(pred) for pred in preds]
+
 # High level prediction functions from midi file
 def predict_from_midi(learn, midi=None, n_words=400, 
                       temperatures=(1.0,1.0), top_k=30, top_p=0.6, seed_len=None, **kwargs):
     vocab = learn.data.vocab
-    seed = MusicItem.from_file(midi, vocab) if not is_empty_midi(midi) else MusicItem.empty(vocab)
-    if seed_len is not None: seed = seed.trim_to_beat(seed_len)
+    # only encodes the windows needed for the seed
+    seed = MusicItem.from_windows(iter_item_windows(midi, vocab), vocab, to_beat=seed_len) if not is_empty_midi(midi) else MusicItem.empty(vocab)
 
     pred, full = learn.predict(seed, n_words=n_words, temperatures=temperatures, top_k=top_k, top_p=top_p, **kwargs)
     return full
 
-def filter_invalid_indexes(res, prev_idx, vocab, filter_value=-float('Inf')):
-    if vocab.is_duration_or_pad(prev_idx):
-        res[list(range(*vocab.dur_range))] = filter_value
-    else:
-        res[list(range(*vocab.note_range))] = filter_value
-    return res
+class LogitsProcessor():
+    "Batched sampling chain shared by the predict methods - temperature, token filters, then top_k/top_p. Works on (batch, vocab) logits"
+    def __init__(self, vocab, temperatures=(1.0,1.0), top_k=30, top_p=0.6, filter_special=False, filter_value=-float('Inf')):
+        self.vocab,self.temperatures,self.top_k,self.top_p = vocab,temperatures,top_k,top_p
+        self.filter_special,self.filter_value = filter_special,filter_value
+        self.repeat_count = None
+        self.processors = [self.temperature, self.filter_tokens, self.filter_top_k_top_p]
+
+    def __call__(self, logits, prev_idx, filter_bos=None):
+        "Run the chain. `prev_idx` is the last token of each row, `filter_bos` bans bos for the rows where it is True"
+        prev_idx = torch.as_tensor(prev_idx, device=logits.device).view(-1)
+        if filter_bos is not None: filter_bos = torch.as_tensor(filter_bos, device=logits.device).view(-1)
+        if self.repeat_count is None: self.repeat_count = torch.zeros(logits.shape[0], dtype=torch.long, device=logits.device)
+        is_dur = self.is_dur(prev_idx)
+        for proc in self.processors: logits = proc(logits, is_dur, filter_bos)
+        return logits
+
+    def is_dur(self, prev_idx): return self.vocab.sampling_masks(prev_idx.device)['dur'][prev_idx] | (prev_idx == self.vocab.pad_idx)
+
+    def head_logits(self, head, hidden, prev_idx):
+        "Inference head. Projects `hidden` (rows, n_hid) only onto the tokens `filter_tokens` can let through, the rest get `filter_value`"
+        linear = getattr(head, 'decoder', head)
+        # (rows, 1, n_hid) draws the same `output_dp` mask the full head uses for the positions of each row
+        if hasattr(head, 'output_dp'): hidden = head.output_dp(hidden[:,None])[:,0]
+        prev_idx = torch.as_tensor(prev_idx, device=hidden.device).view(-1)
+        is_dur = self.is_dur(prev_idx)
+        if not isinstance(linear, nn.Linear): # quantized - packed weights can't be sliced
+            masks = self.vocab.sampling_masks(hidden.device)
+            banned = torch.where(is_dur[:,None], masks['dur'], masks['note'])
+            return linear(hidden).masked_fill(banned, self.filter_value)
+        logits = hidden.new_full((hidden.shape[0], linear.out_features), self.filter_value)
+        # Notes after a duration, durations after a note - both ranges are contiguous, so weight slices are views
+        for rows,(start,end) in [(is_dur, self.vocab.dur_range), (~is_dur, self.vocab.note_range)]:
+            rows = rows.nonzero().view(-1)
+            if len(rows) == 0: continue
+            h = hidden if len(rows) == len(hidden) else hidden[rows]
+            for s,e in [(0, start), (end, linear.out_features)]:
+                if e <= s: continue
+                bias = None if linear.bias is None else linear.bias[s:e]
+                logits[rows, s:e] = F.linear(h, linear.weight[s:e], bias)
+        return logits
+
+    def temperature(self, logits, is_dur, filter_bos):
+        # Use first temperatures value if last prediction was duration
+        temperature = torch.where(is_dur, is_dur.new_tensor(self.temperatures[0], dtype=torch.float64), 
+                                          is_dur.new_tensor(self.temperatures[1], dtype=torch.float64))
+        repeat_penalty = torch.log((self.repeat_count+1).double()/4).div(5).clamp(min=0) * temperature
+        return logits / (temperature + repeat_penalty).to(logits.dtype)[:,None]
+
+    def filter_tokens(self, logits, is_dur, filter_bos):
+        masks = self.vocab.sampling_masks(logits.device)
+        invalid = torch.where(is_dur[:,None], masks['dur'], masks['note'])
+        if self.filter_special: invalid = invalid | masks['special']
+        if filter_bos is not None: invalid[:, self.vocab.bos_idx] |= filter_bos
+        return logits.masked_fill(invalid, self.filter_value)
+
+    def filter_top_k_top_p(self, logits, is_dur, filter_bos):
+        return top_k_top_p(logits, top_k=self.top_k, top_p=self.top_p, filter_value=self.filter_value)
+
+    def sample(self, logits, prev_idx, filter_bos=None):
+        "Sample the next token of each row and update its repeat count"
+        probs = F.softmax(self(logits, prev_idx, filter_bos=filter_bos), dim=-1)
+        idx = torch.multinomial(probs, 1)[:,0]
+
+        # Update repeat count
+        num_choices = (probs > 0).sum(dim=-1)
+        self.repeat_count = torch.where(num_choices <= 2, self.repeat_count + 1, self.repeat_count // 2)
+        return idx
+
+    def select(self, idxs):
+        "Keep only the state of rows `idxs`"
+        if self.repeat_count is not None: self.repeat_count = self.repeat_count[idxs]
+
+class BeamSearch():
+    "Beam search for models with XL style memory. `step(x, pos)` returns the next (beam, vocab) logits, `select(idxs)` reorders the model memory"
+    def __init__(self, vocab, step, select, beam_sz=10, top_k=10, min_bars=None, max_pos=None, end_idxs=None):
+        self.vocab,self.step,self.select = vocab,step,select
+        self.beam_sz,self.top_k,self.min_bars,self.max_pos = beam_sz,max(top_k,2),min_bars,max_pos
+        self.end_idxs = ifnone(end_idxs, [vocab.bos_idx])
+
+    def __call__(self, logits, start_pos, n_words, temperature=1.):
+        "Search from the seed's last `logits` (1, vocab). Returns the tokens of the chosen hypothesis"
+        vocab,bs,top_k,dev = self.vocab,self.beam_sz,self.top_k,logits.device
+        # Every beam starts as a copy of the seed. Only the first one is live, so the first step picks distinct tokens
+        self.select(torch.zeros(bs, dtype=torch.long, device=dev))
+        logits = logits.expand(bs, -1)
+        scores = torch.full((bs,), -float('Inf'), device=dev)
+        scores[0] = 0
+        prev_idx = torch.full((bs,), vocab.pad_idx, dtype=torch.long, device=dev)
+        start_pos = int(start_pos)
+        last_pos = torch.full((bs,), start_pos, dtype=torch.long, device=dev)
+        end_idxs = torch.tensor(self.end_idxs, device=dev)
+        # token and back pointer of every beam at each step
+        tokens = torch.zeros((n_words, bs), dtype=torch.long, device=dev)
+        parents = torch.zeros((n_words, bs), dtype=torch.long, device=dev)
+        processor = LogitsProcessor(vocab, top_k=0, top_p=0.) # note/duration alternation + bos filter
+        finished = [] # (score, step, beam) of ended hypotheses
+        n_steps = 0
+
+        for i in progress_bar(range(n_words), leave=False):
+            # bar = 16 beats
+            filter_bos = None if self.min_bars is None else ((last_pos - start_pos) // 16) <= self.min_bars
+            log_probs = F.log_softmax(processor(logits, prev_idx, filter_bos=filter_bos), dim=-1)
+            cand_scores, cand_idx = (scores[:,None] + log_probs).topk(top_k, dim=-1)
+            top_scores, flat_idx = cand_scores.view(-1).topk(2*bs)
+            beam, tok = flat_idx // top_k, cand_idx.view(-1)[flat_idx]
+            pos = last_pos[beam] + torch.where(prev_idx[beam] == vocab.sep_idx, tok - vocab.dur_range[0], torch.zeros_like(tok))
+
+            # Ended candidates leave the beam. The end token itself isn't part of the prediction
+            valid = torch.isfinite(top_scores)
+            done = (tok[:,None] == end_idxs).any(dim=-1)
+            if self.max_pos is not None: done = done | (pos > self.max_pos)
+            finished += [(s, i-1, b) for s,b in zip(top_scores[done & valid].tolist(), beam[done & valid].tolist())]
+
+            # Keep the `bs` best live candidates
+            live = valid & ~done
+            keep = torch.argsort((~live).long(), stable=True)[:bs]
+            scores = top_scores[keep].masked_fill(~live[keep], -float('Inf'))
+            beam,tok,pos = beam[keep],tok[keep],pos[keep]
+            tokens[i],parents[i] = tok,beam
+            n_steps = i+1
+
+            if not live.any(): break
+            # Early finish - live scores only go down, so none can beat the best ended hypothesis
+            if finished and max(finished)[0] >= scores.max().item(): break
+            if i == n_words-1: break
+            self.select(beam)
+            prev_idx,last_pos = tok,pos
+            logits = self.step(tok[:,None], pos[:,None])
+
+        hyps = finished + [(s, n_steps-1, b) for b,s in enumerate(scores.tolist()) if s > -float('Inf')]
+        if not hyps: return []
+        hyp_scores = torch.tensor([h[0] for h in hyps])
+        choice = torch.multinomial(F.softmax(hyp_scores / temperature, dim=-1), 1).item()
+        return self.trace(tokens.cpu(), parents.cpu(), *hyps[choice][1:])
+
+    def trace(self, tokens, parents, step, beam):
+        "Follow the back pointers from `beam` at `step` to the first token"
+        out = []
+        for s in range(step, -1, -1):
+            out.append(tokens[s,beam].item())
+            beam = parents[s,beam].item()
+        return out[::-1]
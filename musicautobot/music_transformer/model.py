@@ -1,6 +1,6 @@
 from fastai.basics import *
 from fastai.text.models.transformer import TransformerXL
-from ..utils.attention_mask import rand_window_mask
+from ..utils.attention_mask import rand_window_mask, cached_relative_enc
 
 class MusicTransformerXL(TransformerXL):
     "Exactly like fastai's TransformerXL, but with more aggressive attention mask: see `rand_window_mask`"
@@ -32,12 +32,11 @@ class MusicTransformerXL(TransformerXL):
         m_len = self.hidden[0].size(1) if hasattr(self, 'hidden') and len(self.hidden[0].size()) > 1 else 0
         seq_len = m_len + x_len
         
+        # window_mask already lets the first index see itself. Masks can be shared (cached), so no in place edits
         mask = rand_window_mask(x_len, m_len, inp.device, max_size=self.mask_steps, is_eval=not self.training) if self.mask else None
-        if m_len == 0: mask[...,0,0] = 0
         #[None,:,:None] for einsum implementation of attention
         hids = []
-        pos = torch.arange(seq_len-1, -1, -1, device=inp.device, dtype=inp.dtype)
-        pos_enc = self.pos_enc(pos)
+        pos_enc = cached_relative_enc(self.pos_enc, seq_len, inp.device, inp.dtype)
         hids.append(inp)
         for i, layer in enumerate(self.layers):
             mem = self.hidden[i] if self.mem_len > 0 else None
@@ -47,6 +46,10 @@ class MusicTransformerXL(TransformerXL):
         if self.mem_len > 0 : self._update_mems(hids)
         return (self.hidden if self.mem_len > 0 else [core_out]),[core_out]
 
+    def select_hidden(self, idxs): 
+        "Reorder the memory along the batch - beam search/batched generation"
+        self.hidden = [h.index_select(0, idxs) for h in self.hidden]
+
 
  # Beat encoder
 class BeatPositionEncoder(nn.Module):
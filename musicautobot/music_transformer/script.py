@@ -0,0 +1,120 @@
+"TorchScript export of `MusicTransformerXL` and a generation loop that runs against the exported file"
+from fastai.basics import *
+from torch import Tensor
+from typing import List, Tuple
+from ..utils.jit import *
+from ..vocab import MusicVocab
+from .transform import MusicItem
+from .model import BeatPositionEncoder
+from .learner import LogitsProcessor
+
+class ScriptBeatEncoder(nn.Module):
+    "`BeatPositionEncoder` without in place edits"
+    def __init__(self, beat_enc:BeatPositionEncoder):
+        super().__init__()
+        self.beat_enc,self.bar_enc = beat_enc.beat_enc,beat_enc.bar_enc
+        self.beat_len,self.max_bar_len = beat_enc.beat_len,beat_enc.max_bar_len
+
+    def forward(self, pos:Tensor)->Tensor:
+        bar_pos = (pos // self.beat_len % self.max_bar_len).clamp(max=self.max_bar_len-1)
+        return self.beat_enc(pos % self.beat_len) + self.bar_enc(bar_pos)
+
+class ScriptDecoderLayer(nn.Module):
+    "fastai's `DecoderLayer` - relative attention with memory, then feed forward"
+    def __init__(self, layer:nn.Module, freq:Tensor, mem_len:int, max_seq_len:int):
+        super().__init__()
+        mhra = layer.mhra
+        self.attn = ScriptSelfAttention(mhra.attention, RelativeProjection(mhra.r_attn, freq, max_seq_len), mhra.ln, mhra.out,
+                                        mhra.n_heads, mhra.d_head, mem_len)
+        self.ff = ScriptFeedForward(layer.ff)
+
+    def forward(self, x:Tensor, u:Tensor, v:Tensor, k_mem:Tensor, v_mem:Tensor)->Tuple[Tensor,Tensor,Tensor]:
+        x,k_mem,v_mem = self.attn(x, u, v, k_mem, v_mem)
+        return self.ff(x),k_mem,v_mem
+
+class ScriptMusicTransformer(nn.Module):
+    "Inference-only `MusicTransformerXL` + head. The XL memory (projected keys/values per layer) is passed in and returned"
+    def __init__(self, model:nn.Module, max_seq_len:int=1024):
+        super().__init__()
+        xl,head = model[0],model[1]
+        self.embed = xl.encoder
+        self.encode_position = xl.encode_position
+        # Models without position encoding still need a (never called) beat encoder to compile
+        self.beat_enc = ScriptBeatEncoder(xl.beat_enc if xl.encode_position else BeatPositionEncoder(xl.d_model))
+        self.u,self.v = xl.u,xl.v
+        self.n_hid = xl.u.shape[0] * xl.u.shape[2]
+        self.layers = nn.ModuleList([ScriptDecoderLayer(l, xl.pos_enc.freq, xl.mem_len, max_seq_len) for l in xl.layers])
+        self.head = head.decoder
+
+    @torch.jit.export
+    def init_state(self, bs:int)->Tuple[List[Tensor],List[Tensor]]:
+        "Empty memory for `bs` rows"
+        k_mem = [self.u.new_zeros(bs, 0, self.n_hid) for _ in range(len(self.layers))]
+        v_mem = [self.u.new_zeros(bs, 0, self.n_hid) for _ in range(len(self.layers))]
+        return k_mem,v_mem
+
+    def forward(self, x:Tensor, pos:Tensor, k_mem:List[Tensor], v_mem:List[Tensor])->Tuple[Tensor,List[Tensor],List[Tensor]]:
+        "Logits of the last step of `x` (bs,x_len) and the updated memory"
+        inp = self.embed(x) + self.beat_enc(pos) if self.encode_position else self.embed(x)
+        new_k,new_v = [],[]
+        for i,layer in enumerate(self.layers):
+            inp,k,v = layer(inp, self.u, self.v, k_mem[i], v_mem[i])
+            new_k.append(k)
+            new_v.append(v)
+        return self.head(inp[:, -1]),new_k,new_v
+
+def script_model(module:nn.Module, freeze:bool=True, preserved_attrs:Collection[str]=('init_state',)):
+    "`torch.jit.script` an inference module, frozen unless `freeze=False`"
+    scripted = torch.jit.script(module.eval())
+    return torch.jit.freeze(scripted, preserved_attrs=list(preserved_attrs)) if freeze else scripted
+
+class ScriptRunner():
+    "Generation loop against a model saved with `export_script` - no model code or checkpoint needed"
+    def __init__(self, model:torch.jit.ScriptModule, vocab:MusicVocab, meta:dict=None, device='cpu'):
+        self.model,self.vocab,self.meta,self.device = model,vocab,ifnone(meta, {}),torch.device(device)
+
+    @classmethod
+    def load(cls, path:PathOrStr, map_location='cpu'):
+        module,itos,meta = load_script(path, map_location=map_location)
+        return cls(module, MusicVocab(itos), meta, device=map_location)
+
+    def predict(self, item:MusicItem, n_words:int=128,
+                temperatures:float=(1.0,1.0), min_bars=4,
+                top_k=30, top_p=0.6):
+        "Return the `n_words` that come after `item`. Same sampling as `MusicLearner.predict`"
+        vocab = self.vocab
+        new_idx = []
+        x, pos = item.to_tensor(self.device), item.get_pos_tensor(self.device)
+        last_pos = pos[-1] if len(pos) else 0
+        start_pos = last_pos
+        processor = LogitsProcessor(vocab, temperatures=temperatures, top_k=top_k, top_p=top_p)
+        k_mem, v_mem = self.model.init_state(1)
+
+        for i in progress_bar(range(n_words), leave=True):
+            with torch.no_grad():
+                logits, k_mem, v_mem = self.model(x[None], pos[None], k_mem, v_mem)
+
+            prev_idx = new_idx[-1] if len(new_idx) else vocab.pad_idx
+
+            # bar = 16 beats
+            filter_bos = ((last_pos - start_pos) // 16) <= min_bars
+            idx = processor.sample(logits, [prev_idx], filter_bos=[filter_bos]).item()
+
+            if prev_idx==vocab.sep_idx:
+                duration = idx - vocab.dur_range[0]
+                last_pos = last_pos + duration
+
+                abs_bar = last_pos // 16
+                if (i / n_words > 0.80) and (abs_bar % 4 == 0): break
+
+            if idx==vocab.bos_idx:
+                print('Predicted BOS token. Returning prediction...')
+                break
+
+            new_idx.append(idx)
+            x = x.new_tensor([idx])
+            pos = pos.new_tensor([last_pos])
+
+        pred = vocab.to_music_item(np.array(new_idx))
+        full = item.append(pred)
+        return pred, full
@@ -19,9 +19,26 @@ class MusicItem():
     def __len__(self): return len(self.data)
 
     @classmethod
-    def from_file(cls, midi_file, vocab): 
+    def from_file(cls, midi_file, vocab, fast=False): 
+        if fast: return cls.from_npenc(midi2npenc_fast(midi_file), vocab) # skips music21.Stream
         return cls.from_stream(file2stream(midi_file), vocab)
     @classmethod
+    def from_windows(cls, windows, vocab, to_beat=None):
+        "Joins MusicItem windows (see `iter_item_windows`). Stops reading windows once `to_beat` is reached"
+        data,pos = [],[]
+        for w in windows:
+            wdata,wpos = w.data,w.position
+            # join rest that was split at the window boundary
+            if data and data[-1][-2] == vocab.sep_idx and len(wdata) >= 2 and wdata[0] == vocab.sep_idx:
+                data[-1] = data[-1].copy()
+                data[-1][-1] += wdata[1] - vocab.dur_range[0]
+                wdata,wpos = wdata[2:],wpos[2:]
+            if len(wdata): data.append(wdata); pos.append(wpos)
+            if to_beat is not None and len(w.position) and w.position[-1] >= to_beat*SAMPLE_FREQ: break
+        if not data: return cls.empty(vocab)
+        item = MusicItem(np.concatenate(data), vocab, position=np.concatenate(pos))
+        return item if to_beat is None else item.trim_to_beat(to_beat)
+    @classmethod
     def from_stream(cls, stream, vocab):
         if not isinstance(stream, music21.stream.Score): stream = stream.voicesToParts()
         chordarr = stream2chordarr(stream) # 2.
@@ -48,6 +65,9 @@ class MusicItem():
     def to_stream(self, bpm=120):
         return idxenc2stream(self.data, self.vocab, bpm=bpm)
 
+    def to_midi_bytes(self, bpm=120, separate_chords=False):
+        return idxenc2midi_bytes(self.data, self.vocab, bpm=bpm, separate_chords=separate_chords)
+
     def to_tensor(self, device=None):
         return to_tensor(self.data, device)
     
@@ -114,7 +134,7 @@ def pad_seq(seq, bptt, value):
 def to_tensor(t, device=None):
     t = t if isinstance(t, torch.Tensor) else torch.tensor(t)
     if device is None and torch.cuda.is_available(): t = t.cuda()
-    else: t.to(device)
+    else: t = t.to(device)
     return t.long()
     
 def midi2idxenc(midi_file, vocab):
@@ -122,11 +142,22 @@ def midi2idxenc(midi_file, vocab):
     npenc = midi2npenc(midi_file) # 3.
     return npenc2idxenc(npenc, vocab)
 
+def iter_item_windows(midi_file, vocab, bars_per_window=16, skip_last_rest=True):
+    "Yields MusicItem windows of a midi file (see `iter_npenc_windows`). Only the first window has the sequence prefix. Positions are absolute"
+    for idx,(start,npenc) in enumerate(iter_npenc_windows(midi_file, bars_per_window, skip_last_rest=skip_last_rest)):
+        idxenc = npenc2idxenc(npenc, vocab, seq_type=SEQType.Sentence if idx == 0 else SEQType.Empty)
+        yield MusicItem(idxenc, vocab, position=position_enc(idxenc, vocab) + start)
+
 def idxenc2stream(arr, vocab, bpm=120):
     "Converts index encoding to music21 stream"
     npenc = idxenc2npenc(arr, vocab)
     return npenc2stream(npenc, bpm=bpm)
 
+def idxenc2midi_bytes(arr, vocab, bpm=120, separate_chords=False):
+    "Converts index encoding to midi file bytes"
+    npenc = idxenc2npenc(arr, vocab)
+    return npenc2midi_bytes(npenc, bpm=bpm, separate_chords=separate_chords)
+
 # single stream instead of note,dur
 def npenc2idxenc(t, vocab, seq_type=SEQType.Sentence, add_eos=False):
     "Transforms numpy array from 2 column (note, duration) matrix to a single column"
@@ -3,6 +3,7 @@
 # import re
 import music21
 import numpy as np
+from .utils.midifile import file2mf, mf2notes, notes2midi_bytes, TICKS_PER_QUARTER
 # from pathlib import Path
 
 BPB = 4 # beats per bar
@@ -26,6 +27,41 @@ def midi2npenc(midi_file, skip_last_rest=True):
     chordarr = stream2chordarr(stream) # 2.
     return chordarr2npenc(chordarr, skip_last_rest=skip_last_rest) # 3.
 
+# Fast encoding process - same output as midi2npenc, but reads notes straight from the midi events
+# 1. midi -> List[Part][(pitch, offset, duration)]
+# 2. notes -> numpy chord array (timestep X instrument X noterange)
+# 3. numpy array -> List[Timestep][NoteEnc]
+def midi2npenc_fast(midi_file, skip_last_rest=True):
+    "Converts midi file to numpy encoding for language model without building a music21.Stream"
+    chordarr = midi2chordarr(midi_file) # 1. 2.
+    return chordarr2npenc(chordarr, skip_last_rest=skip_last_rest) # 3.
+
+def midi2chordarr(midi_file):
+    "Reads midi notes straight into a sparse chord array"
+    mf = midi_file if isinstance(midi_file, music21.midi.MidiFile) else file2mf(midi_file)
+    parts = mf2notes(mf) # 1.
+    if parts is None: return stream2chordarr(file2stream(mf)) # overlapping notes need music21 voices
+    return notes2chordarr(parts) # 2.
+
+# Windowed encoding - the npenc of long files is built a few bars at a time
+# Not streaming: all note events are read into the (compact) sparse chord array before the first window.
+# SMF stores tracks one after another, so the first bar of the last track is only known at the end of the file
+def iter_npenc_windows(midi_file, bars_per_window=16, skip_last_rest=True, note_range=PIANO_RANGE):
+    "Yields (start timestep, npenc) for consecutive windows of `bars_per_window` bars. Npenc timesteps are relative to the window start"
+    chordarr = midi2chordarr(midi_file)
+    hits = chordarr.onsets()
+    hits = hits[(hits['pitch'] >= note_range[0]) & (hits['pitch'] < note_range[1])]
+    window = bars_per_window*BPB*SAMPLE_FREQ
+    num_steps = len(chordarr)
+    end = (hits['onset'][-1]+1 if len(hits) else 0) if skip_last_rest else num_steps
+    for start in range(0, end, window):
+        lo,hi = np.searchsorted(hits['onset'], [start, start+window])
+        h = hits[lo:hi]
+        # windows end with a rest up to the next window. Only the last window can skip it
+        is_last = start+window >= end
+        yield start, hits2npenc(h['onset']-start, h['part'], h['pitch'], h['dur'], min(window, num_steps-start), 
+                                skip_last_rest=skip_last_rest and is_last)
+
 # Decoding process
 # 1. NoteEnc -> numpy chord array
 # 2. numpy array -> music21.Stream
@@ -34,6 +70,21 @@ def npenc2stream(arr, bpm=120):
     chordarr = npenc2chordarr(np.array(arr)) # 1.
     return chordarr2stream(chordarr, bpm=bpm) # 2.
 
+# Decoding straight to midi - no music21 objects or temp files
+# 1. NoteEnc -> note records (onset, part, pitch, dur)
+# 2. note records -> midi file bytes
+def npenc2midi_bytes(arr, bpm=120, separate_chords=False):
+    "Converts numpy encoding to midi file bytes. `separate_chords` writes notes and chords to separate tracks like `separate_melody_chord`"
+    hits = npenc2hits(np.array(arr)) # 1.
+    if separate_chords: hits = separate_hits_melody_chord(hits)
+    return hits2midi_bytes(hits, num_parts=2 if separate_chords else None, bpm=bpm) # 2.
+
+def npenc_parts2midi_bytes(parts, bpm=120):
+    "Converts numpy encoding of each part to midi file bytes with one track per part"
+    hits = [npenc2hits(np.array(p)) for p in parts] # 1.
+    for idx,h in enumerate(hits): h['part'] = idx
+    return hits2midi_bytes(np.concatenate(hits), num_parts=len(parts), bpm=bpm) # 2.
+
 ##### ENCODING ######
 
 # 1. File To STream
@@ -51,13 +102,12 @@ def stream2chordarr(s, note_size=NOTE_SIZE, sample_freq=SAMPLE_FREQ, max_note_du
     
     # (AS) TODO: need to order by instruments most played and filter out percussion or include the channel
     highest_time = max(s.flat.getElementsByClass('Note').highestTime, s.flat.getElementsByClass('Chord').highestTime)
-    maxTimeStep = round(highest_time * sample_freq)+1
-    score_arr = np.zeros((maxTimeStep, len(s.parts), NOTE_SIZE))
 
     def note_data(pitch, note):
-        return (pitch.midi, int(round(note.offset*sample_freq)), int(round(note.duration.quarterLength*sample_freq)))
+        return (pitch.midi, note.offset, note.duration.quarterLength)
 
-    for idx,part in enumerate(s.parts):
+    parts = []
+    for part in s.parts:
         notes=[]
         for elem in part.flat:
             if isinstance(elem, music21.note.Note):
@@ -65,82 +115,220 @@ def stream2chordarr(s, note_size=NOTE_SIZE, sample_freq=SAMPLE_FREQ, max_note_du
             if isinstance(elem, music21.chord.Chord):
                 for p in elem.pitches:
                     notes.append(note_data(p, elem))
-                
-        # sort notes by offset (1), duration (2) so that hits are not overwritten and longer notes have priority
-        notes_sorted = sorted(notes, key=lambda x: (x[1], x[2])) 
-        for n in notes_sorted:
-            if n is None: continue
-            pitch,offset,duration = n
-            if max_note_dur is not None and duration > max_note_dur: duration = max_note_dur
+        parts.append(notes)
+    return notes2chordarr(parts, highest_time, note_size=note_size, sample_freq=sample_freq, max_note_dur=max_note_dur)
+
+# 2b.
+def notes2chordarr(parts, highest_time=None, note_size=NOTE_SIZE, sample_freq=SAMPLE_FREQ, max_note_dur=MAX_NOTE_DUR):
+    "Converts (pitch, offset, duration) notes for each part to a sparse chord array. Offsets and durations are in quarter lengths"
+    if highest_time is None: highest_time = max([o+d for notes in parts for _,o,d in notes], default=0)
+    maxTimeStep = round(highest_time * sample_freq)+1
+    notes = np.array([(o, i, p, d) for i,part_notes in enumerate(parts) for p,o,d in part_notes], dtype=float).reshape(-1, 4)
+    onset,dur = (np.rint(notes[:,c]*sample_freq).astype(np.int64) for c in (0,3)) # rint rounds half to even, like round
+    part,pitch = notes[:,1],notes[:,2]
+    # sort notes by part, offset (1), duration (2) so that hits are not overwritten and longer notes have priority
+    order = np.lexsort((dur, onset, part))
+    if max_note_dur is not None: dur = np.minimum(dur, max_note_dur)
+    return SparseChordArr.from_arrays(onset[order], part[order], pitch[order], dur[order], (maxTimeStep, len(parts), note_size))
+
+CHORD_DTYPE = np.dtype([('onset', np.int32), ('part', np.int16), ('pitch', np.int8), ('dur', np.int32)])
+
+class SparseChordArr():
+    "Chord array (timestep X instrument X noterange) stored as (onset, part, pitch, dur) records in write order"
+    def __init__(self, notes, shape):
+        self.notes = notes
+        self.shape = tuple(shape)
+
+    @classmethod
+    def from_arrays(cls, onset, part, pitch, dur, shape):
+        notes = np.empty(len(onset), dtype=CHORD_DTYPE)
+        notes['onset'],notes['part'],notes['pitch'],notes['dur'] = onset,part,pitch,dur
+        return cls(notes, shape)
+
+    def __len__(self): return self.shape[0]
+    def __repr__(self): return f'{self.__class__.__name__}(shape={self.shape}, notes={len(self.notes)})'
+
+    def todense(self, dtype=float):
+        "Builds the equivalent dense numpy chord array"
+        score_arr = np.zeros(self.shape, dtype=dtype)
+        for offset,idx,pitch,duration in self.notes.tolist():
             score_arr[offset, idx, pitch] = duration
             score_arr[offset+1:offset+duration, idx, pitch] = VALTCONT      # Continue holding note
-    return score_arr
-
-def chordarr2npenc(chordarr, skip_last_rest=True):
-    # combine instruments
-    result = []
-    wait_count = 0
-    for idx,timestep in enumerate(chordarr):
-        flat_time = timestep2npenc(timestep)
-        if len(flat_time) == 0:
-            wait_count += 1
-        else:
-            # pitch, octave, duration, instrument
-            if wait_count > 0: result.append([VALTSEP, wait_count])
-            result.extend(flat_time)
-            wait_count = 1
-    if wait_count > 0 and not skip_last_rest: result.append([VALTSEP, wait_count])
-    return np.array(result, dtype=int).reshape(-1, 2) # reshaping. Just in case result is empty
+        return score_arr
+
+    def part(self, idx):
+        "Chord array of a single part - shape (timestep, 1, noterange)"
+        notes = self.notes[self.notes['part'] == idx].copy()
+        notes['part'] = 0
+        return SparseChordArr(notes, (self.shape[0], 1, self.shape[2]))
+
+    def onsets(self):
+        "Note hits left after overwrites (positive values of the dense array), sorted by timestep, pitch (high to low), part"
+        n = self.last_writes()
+        n = n[n['dur'] > 0]
+        return n[np.lexsort((n['part'], -n['pitch'].astype(int), n['onset']))]
+
+    def active_steps(self):
+        "Boolean mask of timesteps that are not all zero"
+        n,T = self.notes,self.shape[0]
+        held = n[n['dur'] > 0]
+        count = np.zeros(T+1, dtype=int)
+        np.add.at(count, held['onset'], 1)
+        np.add.at(count, np.minimum(held['onset'].astype(int) + held['dur'], T), -1)
+        count = count.cumsum()[:T]
+        # grace notes (zero duration) write 0 over notes still holding on the same pitch
+        graces = n[n['dur'] == 0]
+        hits = self.onsets() if len(graces) else None
+        for onset,part,pitch,_ in graces.tolist():
+            if ((hits['onset'] == onset) & (hits['part'] == part) & (hits['pitch'] == pitch)).any(): continue
+            count[onset] -= ((held['part'] == part) & (held['pitch'] == pitch) & 
+                             (held['onset'] < onset) & (held['onset'] + held['dur'] > onset)).sum()
+        return count > 0
+
+    def last_writes(self):
+        "Records left after overwrites - a record is only overwritten by a later one with the same part, pitch and onset"
+        return last_writes(self.notes)
+
+    def remap_steps(self, step_map, num_steps):
+        "Moves timestep t to step_map[t]. Records mapped to -1 are dropped"
+        new_onset = step_map[self.notes['onset']]
+        notes = self.notes[new_onset >= 0].copy()
+        notes['onset'] = new_onset[new_onset >= 0]
+        return SparseChordArr(notes, (num_steps,)+self.shape[1:])
+
+def last_writes(notes):
+    "Drops records overwritten by a later record with the same part, pitch and onset"
+    order = np.lexsort((np.arange(len(notes)), notes['onset'], notes['pitch'], notes['part']))
+    n = notes[order]
+    last = np.ones(len(n), dtype=bool)
+    last[:-1] = (n['part'][1:] != n['part'][:-1]) | (n['pitch'][1:] != n['pitch'][:-1]) | (n['onset'][1:] != n['onset'][:-1])
+    return n[last]
+
+def chordarr2npenc(chordarr, skip_last_rest=True, enc_type=None, note_range=PIANO_RANGE):
+    "Converts chord array (dense or sparse) to numpy encoding. Notes are ordered by timestep, then pitch (highest to lowest)"
+    if isinstance(chordarr, SparseChordArr):
+        hits = chordarr.onsets()
+        time,part,pitch,dur = hits['onset'],hits['part'],hits['pitch'],hits['dur']
+    else:
+        flat_idx = np.flatnonzero(chordarr > 0) # holds (VALTCONT) are negative
+        time,part,pitch = np.unravel_index(flat_idx, chordarr.shape)
+        dur = chordarr.reshape(-1)[flat_idx]
+        order = np.lexsort((part, -pitch, time))
+        time,part,pitch,dur = time[order],part[order],pitch[order],dur[order]
+    # only supporting short duration encoding for now. Notes must be within midi range
+    keep = (dur > 0) & (pitch >= note_range[0]) & (pitch < note_range[1])
+    return hits2npenc(time[keep], part[keep], pitch[keep], dur[keep], len(chordarr), skip_last_rest=skip_last_rest, enc_type=enc_type)
+
+def hits2npenc(time, part, pitch, dur, num_steps, skip_last_rest=True, enc_type=None):
+    "Encodes note hits sorted by timestep. Timesteps are separated by [VALTSEP, wait] rows"
+    pitch,dur,part = (np.asarray(x).astype(int) for x in (pitch,dur,part))
+    if enc_type is None: notes = [pitch, dur] # note, duration
+    elif enc_type == 'parts': notes = [pitch, dur, part] # note, duration, part
+    elif enc_type == 'full': notes = [pitch%12, dur, pitch//12, part] # note_class, duration, octave, instrument
+    else: raise ValueError(f'Unknown enc_type: {enc_type}')
+    notes = np.stack(notes, axis=1)
+
+    is_first = np.ones(len(time), dtype=bool) # first note of each timestep
+    is_first[1:] = time[1:] != time[:-1]
+    steps = time[is_first].astype(int)
+    waits = np.diff(steps, prepend=0) # run length of empty timesteps since previous note timestep
+    has_wait = waits > 0
+    wait_count = num_steps - (steps[-1] if len(steps) else 0)
+    has_last = wait_count > 0 and not skip_last_rest
+
+    # every note moves down by the number of wait rows inserted before it
+    row_shift = np.cumsum(has_wait)
+    note_rows = np.arange(len(time)) + row_shift[np.cumsum(is_first)-1]
+    result = np.zeros((len(time)+has_wait.sum()+has_last, notes.shape[1]), dtype=int)
+    result[note_rows] = notes
+    result[(note_rows[is_first]-1)[has_wait], :2] = np.stack([np.full(has_wait.sum(), VALTSEP), waits[has_wait]], axis=1)
+    if has_last: result[-1, :2] = [VALTSEP, wait_count]
+    return result
 
 # Note: not worrying about overlaps - as notes will still play. just look tied
 # http://web.mit.edu/music21/doc/moduleReference/moduleStream.html#music21.stream.Stream.getOverlaps
 def timestep2npenc(timestep, note_range=PIANO_RANGE, enc_type=None):
-    # inst x pitch
-    notes = []
-    for i,n in zip(*timestep.nonzero()):
-        d = timestep[i,n]
-        if d < 0: continue # only supporting short duration encoding for now
-        if n < note_range[0] or n >= note_range[1]: continue # must be within midi range
-        notes.append([n,d,i])
-        
-    notes = sorted(notes, key=lambda x: x[0], reverse=True) # sort by note (highest to lowest)
-    
-    if enc_type is None: 
-        # note, duration
-        return [n[:2] for n in notes] 
-    if enc_type == 'parts':
-        # note, duration, part
-        return [n for n in notes]
-    if enc_type == 'full':
-        # note_class, duration, octave, instrument
-        return [[n%12, d, n//12, i] for n,d,i in notes] 
+    "Encodes notes of a single (inst x pitch) timestep, highest to lowest"
+    return chordarr2npenc(timestep[None], note_range=note_range, enc_type=enc_type).tolist()
 
 ##### DECODING #####
 
 # 1.
 def npenc2chordarr(npenc, note_size=NOTE_SIZE):
-    num_instruments = 1 if len(npenc.shape) <= 2 else npenc.max(axis=0)[-1]
-    
-    max_len = npenc_len(npenc)
+    "Converts numpy encoding to chord array. A list of npencs is decoded in one pass and returns a list of chord arrays"
+    if isinstance(npenc, (list, tuple)): return npencs2chordarrs(npenc, note_size=note_size)
+    return npencs2chordarrs([npenc], note_size=note_size)[0]
+
+def npencs2chordarrs(npencs, note_size=NOTE_SIZE):
+    "Decodes numpy encodings of different lengths with a single scatter into one (sum(steps), inst, note) array"
+    if len(npencs) == 0: return []
+    npencs = [as_npenc(t) for t in npencs]
+    lens = npenc_len(npencs)
+    flat = np.concatenate(npencs)
+    n,d = flat[:,0],flat[:,1]
+    i = flat[:,2] if flat.shape[1] > 2 else np.zeros_like(n)
+    num_instruments = int(i.max())+1 if flat.shape[1] > 2 and len(flat) else 1
+
+    # time index of every token - running sum of separator durations within its npenc
+    seq = np.repeat(np.arange(len(npencs)), [len(t) for t in npencs])
+    csum = np.cumsum(np.where(n == VALTSEP, d, 0))
+    seq_start = np.concatenate([[0], csum])[np.cumsum([0]+[len(t) for t in npencs])[:-1]]
+    time = csum - seq_start[seq] + (np.cumsum(lens) - lens)[seq]
+
+    is_note = n > VALTSEP # skip special tokens
     # score_arr = (steps, inst, note)
-    score_arr = np.zeros((max_len, num_instruments, note_size))
-    
-    idx = 0
-    for step in npenc:
-        n,d,i = (step.tolist()+[0])[:3] # or n,d,i
-        if n < VALTSEP: continue # special token
-        if n == VALTSEP:
-            idx += d
-            continue
-        score_arr[idx,i,n] = d
-    return score_arr
+    score_arr = np.zeros((lens.sum(), num_instruments, note_size))
+    flat_idx = np.ravel_multi_index((time[is_note], i[is_note], n[is_note]), score_arr.shape)
+    # later notes overwrite earlier ones
+    _,last = np.unique(flat_idx[::-1], return_index=True)
+    last = len(flat_idx) - 1 - last
+    score_arr.reshape(-1)[flat_idx[last]] = d[is_note][last]
+    return np.split(score_arr, np.cumsum(lens)[:-1])
 
 def npenc_len(npenc):
-    duration = 0
-    for t in npenc:
-        if t[0] == VALTSEP: duration += t[1]
-    return duration + 1
-
+    "Number of timesteps in numpy encoding. Returns an array of lengths for a list of npencs"
+    if isinstance(npenc, (list, tuple)):
+        if len(npenc) == 0: return np.zeros(0, dtype=int)
+        seq = np.repeat(np.arange(len(npenc)), [len(t) for t in npenc])
+        flat = np.concatenate([as_npenc(t)[:,:2] for t in npenc])
+        sep_dur = np.where(flat[:,0] == VALTSEP, flat[:,1], 0)
+        return np.bincount(seq, weights=sep_dur, minlength=len(npenc)).astype(int) + 1
+    npenc = as_npenc(npenc)
+    return int(np.where(npenc[:,0] == VALTSEP, npenc[:,1], 0).sum()) + 1
+
+def as_npenc(t):
+    "2d (tokens, columns) view of a numpy encoding"
+    t = np.asarray(t)
+    return t.reshape(-1, t.shape[-1]) if t.ndim > 1 else t.reshape(-1, 2)
+
+# 1b.
+def npenc2hits(npenc, note_size=NOTE_SIZE):
+    "Note records (onset, part, pitch, dur) with a positive duration. Later notes overwrite earlier ones, same as npenc2chordarr"
+    npenc = as_npenc(npenc)
+    n,d = npenc[:,0],npenc[:,1]
+    i = npenc[:,2] if npenc.shape[1] > 2 else np.zeros_like(n)
+    time = np.cumsum(np.where(n == VALTSEP, d, 0))
+    is_note = (n > VALTSEP) & (n < note_size) # skip special tokens
+    hits = last_writes(SparseChordArr.from_arrays(time[is_note], i[is_note], n[is_note], d[is_note], ()).notes)
+    return hits[hits['dur'] > 0]
+
+def separate_hits_melody_chord(hits):
+    "Moves single notes to part 0 and chords (notes sharing onset and duration) to part 1"
+    hits = hits.copy()
+    keys = np.stack([hits['part'], hits['onset'], hits['dur']], axis=1)
+    _,group,counts = np.unique(keys, axis=0, return_inverse=True, return_counts=True)
+    hits['part'] = counts[group.reshape(-1)] > 1
+    return hits
+
+def hits2midi_bytes(hits, num_parts=None, bpm=120, sample_freq=SAMPLE_FREQ, tpq=TICKS_PER_QUARTER):
+    "Writes note records as a midi file with one track per part"
+    if num_parts is None: num_parts = int(hits['part'].max())+1 if len(hits) else 1
+    step_ticks = tpq // sample_freq
+    tracks = []
+    for idx in range(num_parts):
+        h = hits[hits['part'] == idx]
+        tracks.append((h['onset'].astype(int)*step_ticks, h['pitch'], h['dur'].astype(int)*step_ticks))
+    return notes2midi_bytes(tracks, bpm=bpm, time_sig=(BPB, 4), tpq=tpq)
 
 # 2.
 def chordarr2stream(arr, sample_freq=SAMPLE_FREQ, bpm=120):
@@ -150,7 +338,7 @@ def chordarr2stream(arr, sample_freq=SAMPLE_FREQ, bpm=120):
     stream.append(music21.tempo.MetronomeMark(number=bpm))
     stream.append(music21.key.KeySignature(0))
     for inst in range(arr.shape[1]):
-        p = partarr2stream(arr[:,inst,:], duration)
+        p = partarr2stream(arr.part(inst) if isinstance(arr, SparseChordArr) else arr[:,inst,:], duration)
         stream.append(p)
     stream = stream.transpose(0)
     return stream
@@ -166,13 +354,11 @@ def partarr2stream(partarr, duration):
 
 def part_append_duration_notes(partarr, duration, stream):
     "convert instrument part to music21 chords"
-    for tidx,t in enumerate(partarr):
-        note_idxs = np.where(t > 0)[0] # filter out any negative values (continuous mode)
-        if len(note_idxs) == 0: continue
+    for tidx,note_idxs,note_durs in partarr_steps(partarr):
         notes = []
-        for nidx in note_idxs:
+        for nidx,d in zip(note_idxs,note_durs):
             note = music21.note.Note(nidx)
-            note.duration = music21.duration.Duration(partarr[tidx,nidx]*duration.quarterLength)
+            note.duration = music21.duration.Duration(d*duration.quarterLength)
             notes.append(note)
         for g in group_notes_by_duration(notes):
             if len(g) == 1:
@@ -182,6 +368,20 @@ def part_append_duration_notes(partarr, duration, stream):
                 stream.insert(tidx*duration.quarterLength, chord)
     return stream
 
+def partarr_steps(partarr):
+    "yields timestep, pitches (low to high) and durations of every timestep with notes"
+    if isinstance(partarr, SparseChordArr):
+        hits = partarr.onsets()
+        hits = hits[np.lexsort((hits['pitch'], hits['onset']))]
+        steps,starts = np.unique(hits['onset'], return_index=True)
+        for tidx,n in zip(steps.tolist(), np.split(hits, starts[1:])):
+            yield tidx, n['pitch'].tolist(), n['dur'].tolist()
+        return
+    for tidx,t in enumerate(partarr):
+        note_idxs = np.where(t > 0)[0] # filter out any negative values (continuous mode)
+        if len(note_idxs) == 0: continue
+        yield tidx, note_idxs, t[note_idxs]
+
 from itertools import groupby
 #  combining notes with different durations into a single chord may overwrite conflicting durations. Example: aylictal/still-waters-run-deep
 def group_notes_by_duration(notes):
@@ -235,40 +435,90 @@ def compress_chordarr(chordarr):
 def trim_chordarr_rests(arr, max_rests=4, sample_freq=SAMPLE_FREQ):
     # max rests is in quarter notes
     # max 1 bar between song start and end
-    start_idx = 0
-    max_sample = max_rests*sample_freq
-    for idx,t in enumerate(arr):
-        if (t != 0).any(): break
-        start_idx = idx+1
-        
-    end_idx = 0
-    for idx,t in enumerate(reversed(arr)):
-        if (t != 0).any(): break
-        end_idx = idx+1
-    start_idx = start_idx - start_idx % max_sample
-    end_idx = end_idx - end_idx % max_sample
-#     if start_idx > 0 or end_idx > 0: print('Trimming rests. Start, end:', start_idx, len(arr)-end_idx, end_idx)
-    return arr[start_idx:(len(arr)-end_idx)]
+    step_map,num_steps = trim_rests_step_map(chordarr_active_steps(arr), max_rests*sample_freq)
+    if isinstance(arr, SparseChordArr): return arr.remap_steps(step_map, num_steps)
+    start_idx = (step_map >= 0).argmax()
+    return arr[start_idx:start_idx+num_steps]
 
 def shorten_chordarr_rests(arr, max_rests=8, sample_freq=SAMPLE_FREQ):
     # max rests is in quarter notes
     # max 2 bar pause
-    rest_count = 0
-    result = []
-    max_sample = max_rests*sample_freq
-    for timestep in arr:
-        if (timestep==0).all(): 
-            rest_count += 1
-        else:
-            if rest_count > max_sample:
-#                 old_count = rest_count
-                rest_count = (rest_count % sample_freq) + max_sample
-#                 print(f'Compressing rests: {old_count} -> {rest_count}')
-            for i in range(rest_count): result.append(np.zeros(timestep.shape))
-            rest_count = 0
-            result.append(timestep)
-    for i in range(rest_count): result.append(np.zeros(timestep.shape))
-    return np.array(result)
+    active = chordarr_active_steps(arr)
+    step_map,num_steps = shorten_rests_step_map(active, max_rests*sample_freq, sample_freq)
+    if isinstance(arr, SparseChordArr): return arr.remap_steps(step_map, num_steps)
+    result = np.zeros((num_steps,)+arr.shape[1:], dtype=arr.dtype)
+    result[step_map[active]] = arr[active]
+    return result
+
+def chordarr_active_steps(arr):
+    "Boolean mask of timesteps that are not all zero"
+    if isinstance(arr, SparseChordArr): return arr.active_steps()
+    return (arr != 0).reshape(len(arr), -1).any(axis=1)
+
+def trim_rests_step_map(active, max_sample):
+    "Drops leading and trailing rests in multiples of max_sample. Returns new timestep of every timestep (-1 if dropped) and new length"
+    num_steps = len(active)
+    if not active.any(): start_idx = end_idx = num_steps
+    else: start_idx,end_idx = active.argmax(),active[::-1].argmax()
+    start_idx = start_idx - start_idx % max_sample
+    end_idx = end_idx - end_idx % max_sample
+    new_len = max(num_steps-end_idx-start_idx, 0)
+    step_map = np.arange(num_steps) - start_idx
+    step_map[(step_map < 0) | (step_map >= new_len)] = -1
+    return step_map, new_len
+
+def shorten_rests_step_map(active, max_sample, sample_freq):
+    "Shortens rests longer than max_sample to max_sample (+ remainder of a beat). Returns new timestep of every timestep (-1 if dropped) and new length"
+    num_steps = len(active)
+    steps = active.nonzero()[0]
+    if len(steps) == 0: return np.arange(num_steps), num_steps
+    rests = np.diff(steps, prepend=-1) - 1
+    new_rests = np.where(rests > max_sample, (rests % sample_freq) + max_sample, rests)
+    new_steps = np.cumsum(new_rests + 1) - 1
+    # shortened rests keep their first new_rests timesteps
+    step_map = np.full(num_steps, -1)
+    idx = np.arange(num_steps)
+    k = np.searchsorted(steps, idx) # next active timestep
+    trailing = k == len(steps)
+    k = np.minimum(k, len(steps)-1)
+    rest_pos = idx - (steps - rests)[k]
+    kept = ~trailing & (rest_pos < new_rests[k])
+    step_map[kept] = (new_steps - new_rests)[k[kept]] + rest_pos[kept]
+    step_map[steps] = new_steps
+    step_map[trailing] = idx[trailing] - steps[-1] + new_steps[-1]
+    return step_map, num_steps - steps[-1] + new_steps[-1]
+
+# Same rest compression, directly on numpy encoding. A timestep is a rest if no note is held over it
+def compress_npenc(npenc):
+    return shorten_npenc_rests(trim_npenc_rests(npenc))
+
+def trim_npenc_rests(npenc, max_rests=4, sample_freq=SAMPLE_FREQ):
+    time,active = npenc_active_steps(npenc)
+    return remap_npenc_steps(npenc, time, *trim_rests_step_map(active, max_rests*sample_freq))
+
+def shorten_npenc_rests(npenc, max_rests=8, sample_freq=SAMPLE_FREQ):
+    time,active = npenc_active_steps(npenc)
+    return remap_npenc_steps(npenc, time, *shorten_rests_step_map(active, max_rests*sample_freq, sample_freq))
+
+def npenc_active_steps(npenc):
+    "Timestep of every token and boolean mask of timesteps with a note held over them"
+    npenc = as_npenc(npenc)
+    n,d = npenc[:,0],npenc[:,1]
+    time = np.cumsum(np.where(n == VALTSEP, d, 0))
+    is_note = (n > VALTSEP) & (d > 0)
+    num_steps = max(npenc_len(npenc)-1, (time[is_note] + d[is_note]).max(initial=0))
+    held = np.zeros(num_steps+1, dtype=int)
+    np.add.at(held, time[is_note], 1)
+    np.add.at(held, time[is_note] + d[is_note], -1)
+    return time, held.cumsum()[:num_steps] > 0
+
+def remap_npenc_steps(npenc, time, step_map, num_steps):
+    "Moves tokens to new timesteps and rewrites VALTSEP durations. Dropped timesteps collapse into the next kept one"
+    npenc = as_npenc(npenc).copy()
+    new_pos = np.concatenate([[0], np.cumsum(step_map >= 0)]) # new timestep of every old timestep boundary
+    is_sep = npenc[:,0] == VALTSEP
+    npenc[is_sep,1] = new_pos[time[is_sep]] - new_pos[time[is_sep] - npenc[is_sep,1]]
+    return npenc[~is_sep | (npenc[:,1] > 0)]
 
 # sequence 2 sequence convenience functions
 
@@ -280,16 +530,29 @@ def stream2npenc_parts(stream, sort_pitch=True):
 
 def chordarr_combine_parts(parts):
     max_ts = max([p.shape[0] for p in parts])
+    if all(isinstance(p, SparseChordArr) for p in parts): return sparse_combine_parts(parts, max_ts)
+    parts = [p.todense() if isinstance(p, SparseChordArr) else p for p in parts]
     parts_padded = [pad_part_to(p, max_ts) for p in parts]
     chordarr_comb = np.concatenate(parts_padded, axis=1)
     return chordarr_comb
 
+def sparse_combine_parts(parts, max_ts):
+    part_offsets = np.cumsum([0]+[p.shape[1] for p in parts])
+    notes = []
+    for p,offset in zip(parts, part_offsets):
+        n = p.notes.copy()
+        n['part'] += offset
+        notes.append(n)
+    notes = np.concatenate(notes)
+    notes = notes[np.argsort(notes['part'], kind='stable')]
+    return SparseChordArr(notes, (max_ts, part_offsets[-1], parts[0].shape[2]))
+
 def pad_part_to(p, target_size):
     pad_width = ((0,target_size-p.shape[0]),(0,0),(0,0))
     return np.pad(p, pad_width, 'constant')
 
 def part_enc(chordarr, part):
-    partarr = chordarr[:,part:part+1,:]
+    partarr = chordarr.part(part) if isinstance(chordarr, SparseChordArr) else chordarr[:,part:part+1,:]
     npenc = chordarr2npenc(partarr)
     return npenc
 
@@ -1,5 +1,6 @@
 import numpy as np
 import torch
+from functools import lru_cache
 
 def window_mask(x_len, device, m_len=0, size=(1,1)):
     win_size,k = size
@@ -10,12 +11,39 @@ def window_mask(x_len, device, m_len=0, size=(1,1)):
     mask = torch.cat((mem_mask, window_mask), dim=1)[None,None]
     return mask.bool() if hasattr(mask, 'bool') else mask.byte()
     
+@lru_cache(maxsize=64)
+def _cached_window_mask(x_len, m_len, size, device): return window_mask(x_len, device, m_len, size=size)
+
+def cached_window_mask(x_len, device, m_len=0, size=(1,1)):
+    "`window_mask` built once per shape and device. Shared between calls - don't modify it in place"
+    return _cached_window_mask(x_len, m_len, tuple(size), torch.device(device))
+    
 def rand_window_mask(x_len,m_len,device,max_size:int=None,p:float=0.2,is_eval:bool=False):
     if is_eval or np.random.rand() >= p or max_size is None: 
         win_size,k = (1,1)
     else: win_size,k = (np.random.randint(0,max_size)+1,0)
-    return window_mask(x_len, device, m_len, size=(win_size,k))
+    # Randomized training windows are drawn fresh, the default causal mask comes from the cache
+    mask_func = cached_window_mask if (win_size,k) == (1,1) else window_mask
+    return mask_func(x_len, device, m_len, size=(win_size,k))
+
+def cached_relative_enc(pos_enc, seq_len, device, dtype):
+    "Backwards (txl) relative encoding `pos_enc(arange(seq_len-1..0))`. Built once per device/dtype and sliced - shorter encodings are suffixes of longer ones"
+    cache = pos_enc.__dict__.setdefault('relative_enc_cache', {})
+    key = (torch.device(device), dtype)
+    if key not in cache or cache[key].shape[0] < seq_len:
+        pos = torch.arange(seq_len-1, -1, -1, device=device, dtype=dtype)
+        cache[key] = pos_enc(pos)
+    return cache[key][-seq_len:]
 
 def lm_mask(x_len, device):
     mask = torch.triu(torch.ones((x_len, x_len), device=device), diagonal=1)[None,None]
     return mask.bool() if hasattr(mask, 'bool') else mask.byte()
+
+def segment_mask(q_seg, k_seg, mask=None):
+    "Block diagonal mask for packed rows - queries only see keys of their own segment. Combined with `mask` if given"
+    same_seg = q_seg[:,None,:,None] == k_seg[:,None,None,:]
+    seg_mask = ~same_seg if mask is None else ~same_seg | mask[...,-k_seg.shape[1]:]
+    # Always allowing the first index of each segment to see. Otherwise you'll get NaN loss
+    seg_start = torch.ones_like(k_seg, dtype=torch.bool)
+    seg_start[:,1:] = k_seg[:,1:] != k_seg[:,:-1]
+    return seg_mask & ~(same_seg & seg_start[:,None,None,:])
@@ -0,0 +1,106 @@
+"Inference-only building blocks that compile with `torch.jit.script` - no dict inputs, no python side memory, no numpy masks"
+import json
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+from torch import Tensor
+from typing import List, Optional, Tuple
+
+def line_shift(x:Tensor, mask:bool=False)->Tensor:
+    "Shift the line i of `x` by p-i elements to the left, if `mask` puts 0s on the diagonal (same as fastai's `_line_shift`)"
+    bs,nh,n,p = x.size(0),x.size(1),x.size(2),x.size(3)
+    x_pad = torch.cat([x.new_zeros(bs,nh,n,1), x], dim=3)
+    x_shift = x_pad.view(bs,nh,p + 1,n)[:,:,1:].view_as(x)
+    if mask: x_shift = x_shift * torch.tril(x.new_ones(n,p), p-n)[None,None]
+    return x_shift
+
+def relative_enc(freq:Tensor, seq_len:int)->Tensor:
+    "Backwards (txl) sinusoid encoding of `seq_len-1..0` - `PositionalEncoding` with its `freq` buffer"
+    pos = torch.arange(seq_len-1, -1, -1, device=freq.device, dtype=freq.dtype)
+    inp = pos[:,None] * freq[None]
+    return torch.cat([inp.sin(), inp.cos()], dim=-1)
+
+def causal_mask(x_len:int, m_len:int, device:torch.device)->Tensor:
+    "Every new step sees the memory and the steps before it. Same as `window_mask` at eval"
+    return torch.triu(torch.ones(x_len, m_len + x_len, device=device), diagonal=1+m_len)[None,None] > 0
+
+def rel_attention(wq:Tensor, wk:Tensor, wv:Tensor, wkr:Tensor, u:Tensor, v:Tensor, mask:Optional[Tensor],
+                  n_heads:int, d_head:int, r_mask:bool)->Tensor:
+    "Relative multi-head attention on projected queries (bs,x_len,n), keys/values (bs,seq_len,n) and relative keys (seq_len,n)"
+    bs,x_len,seq_len = wq.size(0),wq.size(1),wk.size(1)
+    wq = wq.view(bs, x_len, n_heads, d_head).permute(0, 2, 1, 3)
+    wk = wk.view(bs, seq_len, n_heads, d_head).permute(0, 2, 3, 1)
+    wv = wv.view(bs, seq_len, n_heads, d_head).permute(0, 2, 1, 3)
+    wkr = wkr.view(seq_len, n_heads, d_head).permute(1, 2, 0)
+    AC = torch.matmul(wq+u, wk)
+    BD = line_shift(torch.matmul(wq+v, wkr), mask=r_mask)
+    attn_score = (AC + BD).mul_(1/(d_head ** 0.5))
+    if mask is not None: attn_score = attn_score.float().masked_fill(mask, -float('inf')).type_as(attn_score)
+    attn_vec = torch.matmul(F.softmax(attn_score, dim=-1), wv)
+    return attn_vec.permute(0, 2, 1, 3).contiguous().view(bs, x_len, -1)
+
+class RelativeProjection(nn.Module):
+    "`r_attn` of the relative encoding, projected once up to `max_seq_len` and sliced. Longer sequences are projected on the fly"
+    def __init__(self, r_attn:nn.Module, freq:Tensor, max_seq_len:int):
+        super().__init__()
+        self.r_attn = r_attn
+        self.register_buffer('freq', freq.detach().clone())
+        with torch.no_grad(): self.register_buffer('r_proj', r_attn(relative_enc(self.freq, max_seq_len)))
+
+    def forward(self, seq_len:int)->Tensor:
+        if seq_len <= self.r_proj.size(0): return self.r_proj[self.r_proj.size(0)-seq_len:]
+        return self.r_attn(relative_enc(self.freq, seq_len))
+
+class ScriptSelfAttention(nn.Module):
+    "Relative self attention with one fused q/k/v projection. The projected keys/values of the last `mem_len` steps are passed in and returned"
+    def __init__(self, qkv:nn.Module, r_proj:RelativeProjection, ln:nn.Module, out:Optional[nn.Module],
+                 n_heads:int, d_head:int, mem_len:int, r_mask:bool=False, causal:bool=True):
+        super().__init__()
+        self.qkv,self.r_proj,self.ln = qkv,r_proj,ln
+        self.out = nn.Identity() if out is None else out
+        self.n_heads,self.d_head,self.mem_len,self.r_mask,self.causal = n_heads,d_head,mem_len,r_mask,causal
+
+    def forward(self, x:Tensor, u:Tensor, v:Tensor, k_mem:Tensor, v_mem:Tensor)->Tuple[Tensor,Tensor,Tensor]:
+        x_len,n = x.size(1),self.n_heads * self.d_head
+        wq,wk,wv = self.qkv(x).split(n, dim=-1)
+        m_len = k_mem.size(1)
+        if m_len > 0: wk,wv = torch.cat([k_mem, wk], dim=1),torch.cat([v_mem, wv], dim=1)
+        mask = causal_mask(x_len, m_len, x.device) if self.causal and x_len > 1 else None
+        attn = rel_attention(wq, wk, wv, self.r_proj(wk.size(1)), u, v, mask, self.n_heads, self.d_head, self.r_mask)
+        keep = max(wk.size(1) - self.mem_len, 0)
+        return self.ln(x + self.out(attn)),wk[:, keep:],wv[:, keep:]
+
+class ScriptCrossAttention(nn.Module):
+    "Relative attention over a fixed (encoder) output. Its keys/values are projected once with `project_kv`"
+    def __init__(self, q_wgt:nn.Module, k_wgt:nn.Module, v_wgt:nn.Module, r_proj:RelativeProjection, ln:nn.Module,
+                 n_heads:int, d_head:int, r_mask:bool=True):
+        super().__init__()
+        self.q_wgt,self.k_wgt,self.v_wgt,self.r_proj,self.ln = q_wgt,k_wgt,v_wgt,r_proj,ln
+        self.n_heads,self.d_head,self.r_mask = n_heads,d_head,r_mask
+
+    @torch.jit.export
+    def project_kv(self, enc:Tensor)->Tuple[Tensor,Tensor]: return self.k_wgt(enc),self.v_wgt(enc)
+
+    def forward(self, x:Tensor, u:Tensor, v:Tensor, wk:Tensor, wv:Tensor)->Tensor:
+        attn = rel_attention(self.q_wgt(x), wk, wv, self.r_proj(wk.size(1)), u, v, None, self.n_heads, self.d_head, self.r_mask)
+        return self.ln(x + attn)
+
+class ScriptFeedForward(nn.Module):
+    "fastai's `feed_forward` without dropout - `ln(x + lin2(act(lin1(x))))`"
+    def __init__(self, ff:nn.Module):
+        super().__init__()
+        layers = ff.layers # Linear, act, [Dropout], Linear, Dropout, MergeLayer, LayerNorm
+        self.lin1,self.act,self.lin2,self.ln = layers[0],layers[1],layers[-4],layers[-1]
+
+    def forward(self, x:Tensor)->Tensor: return self.ln(self.lin2(self.act(self.lin1(x))) + x)
+
+def save_script(module:torch.jit.ScriptModule, path, vocab, **meta):
+    "Save a scripted (frozen) model with its vocab and `meta` - everything a runner needs, no musicautobot model code"
+    extra_files = { 'itos.json': json.dumps(list(vocab.itos)), 'meta.json': json.dumps(meta) }
+    torch.jit.save(module, str(path), _extra_files=extra_files)
+
+def load_script(path, map_location='cpu'):
+    "Load a model saved with `save_script`. Returns the module, vocab tokens and meta"
+    extra_files = { 'itos.json': '', 'meta.json': '' }
+    module = torch.jit.load(str(path), map_location=map_location, _extra_files=extra_files)
+    return module.eval(),json.loads(extra_files['itos.json']),json.loads(extra_files['meta.json'])
@@ -104,4 +104,188 @@ def change_track_instrument(t, value):
 def print_music21_instruments():
     for i in range(200):
         try: print(i, music21.instrument.instrumentFromMidiProgram(i))
-        except: pass
\ No newline at end of file
+        except: pass
+
+# Reading notes straight from midi events. Mirrors music21.midi.translate.midiFileToStream,
+# but skips building the music21.Stream (the slowest part of encoding)
+from music21.common import opFrac, nearestMultiple
+from music21.midi import MetaEvents
+from music21.midi.translate import getTimeForEvents, getNotesFromEvents
+
+QUANTIZE_DIVISORS = (4, 3) # music21 default - 16th notes and 8th note triplets
+PERC_CHANNEL = 10
+
+def mf2notes(mf, divisors=QUANTIZE_DIVISORS):
+    "Returns quantized (pitch, offset, duration) notes for each track containing notes. Offsets and durations are in quarter lengths."
+    "Returns None if overlapping notes need to be separated into voices - that is only handled by music21"
+    tpq = mf.ticksPerQuarterNote
+    conductor_ts = []
+    parts = []
+    for t in mf.tracks:
+        events = getTimeForEvents(t)
+        track_ts = [(quantize_ql(tick/tpq, divisors), ts_bar_len(e)) for tick,e in events if e.type == MetaEvents.TIME_SIGNATURE]
+        if not t.hasNotes():
+            conductor_ts.extend(track_ts)
+            continue
+        elems = track_elements(getNotesFromEvents(events), tpq, divisors)
+        if elems is None: return None
+        elems = quantize_elements(elems, divisors)
+        bars = bar_lengths(conductor_ts if conductor_ts else track_ts)
+        parts.append([(p, o, d) for pitches,o,d in split_at_bars(elems, bars) for p in pitches])
+    return parts
+
+def track_elements(notes, tpq, divisors):
+    "Groups note on/off pairs into notes and chords - same as music21's `midiTrackToStream`. Returns None if voices are required"
+    tolerance = tpq / max(divisors)
+    elems = []
+    gathered = set()
+    for i,(on,off) in enumerate(notes):
+        if i in gathered: continue
+        group = [notes[i]]
+        for j in range(i+1, len(notes)):
+            (t_sub,_),(t_off_sub,_) = notes[j]
+            if abs(t_sub - on[0]) >= tolerance: break
+            if abs(t_off_sub - off[0]) > tolerance: return None # different end time - music21 moves these to a new voice
+            group.append(notes[j])
+            gathered.add(j)
+        # chords use the onset of the first note and the duration of the last
+        (t_on,_),(t_off,_) = group[-1]
+        is_perc = any(e.channel == PERC_CHANNEL for (_,e),_ in group) # percussion is not encoded
+        pitches = [] if is_perc else [e.pitch for (_,e),_ in group]
+        elems.append((pitches, opFrac(on[0]/tpq), opFrac(float(t_off-t_on)/tpq)))
+    return elems
+
+def quantize_elements(elems, divisors):
+    "Snaps offsets and durations to the nearest divisor multiple - same as `music21.stream.Stream.quantize`"
+    result = []
+    for i,(pitches,o,ql) in enumerate(elems):
+        o = quantize_ql(o, divisors)
+        if ql == 0: # zero length midi notes are grace notes
+            result.append((pitches, o, 0))
+            continue
+        d,_ = best_match(ql, divisors)
+        if i+1 < len(elems):
+            # avoid gaps smaller than the quantization unit before the next note
+            next_o,next_div = best_match(elems[i+1][1], divisors)
+            if 0 < next_o - (o + d) < 1/max(divisors): d,_ = best_match(ql, (next_div,))
+        if d == 0: d = 1/max(divisors)
+        result.append((pitches, o, opFrac(d)))
+    return result
+
+def best_match(ql, divisors):
+    found = []
+    for div in divisors:
+        match, error, _ = nearestMultiple(float(ql), 1/div)
+        found.append((error, 1/div, match, div))
+    _,_,match,div = sorted(found)[0]
+    return match, div
+
+def quantize_ql(ql, divisors=QUANTIZE_DIVISORS): return opFrac(best_match(ql, divisors)[0])
+
+def ts_bar_len(e):
+    num, denom = e.data[0], 2**e.data[1]
+    return opFrac(num * 4 / denom)
+
+def bar_lengths(time_sigs):
+    "Time signature changes as sorted (offset, bar length). Defaults to 4/4 at the start"
+    time_sigs = sorted(time_sigs, key=lambda x: x[0])
+    if not time_sigs or time_sigs[0][0] > 0: time_sigs = [(0.0, 4.0)] + time_sigs
+    return time_sigs
+
+def bar_len_at(bars, offset):
+    bar_len = bars[0][1]
+    for o,l in bars:
+        if o > offset: break
+        bar_len = l
+    return bar_len
+
+def split_at_bars(elems, bars):
+    "Splits notes that cross a bar line into tied notes - same as music21's `makeMeasures`, `makeTies` and `makeRests`"
+    max_end = max([o+d for _,o,d in elems], default=0)
+    bar_starts = [opFrac(0.0)]
+    while bar_starts[-1] <= max_end: # the last bar starts after every note ends - tied remainders always have a next measure
+        bar_starts.append(opFrac(bar_starts[-1] + bar_len_at(bars, bar_starts[-1])))
+
+    measures = [[] for _ in bar_starts]
+    b = 0
+    for pitches,o,d in sorted(elems, key=lambda x: x[1]):
+        while bar_starts[b+1] <= o: b += 1
+        measures[b].append((pitches, opFrac(o - bar_starts[b]), d))
+
+    result = []
+    m_start = opFrac(0.0)
+    for b,measure in enumerate(measures):
+        bar_len = opFrac(bar_starts[b+1] - bar_starts[b]) if b+1 < len(bar_starts) else bar_len_at(bars, bar_starts[b])
+        m_len = bar_len
+        split_chord, split_note = False, False
+        for pitches,o,d in measure:
+            if opFrac(o + d) > bar_len:
+                if len(pitches) > 1: split_chord = True
+                else: split_note = True
+                first = opFrac(bar_len - o)
+                measures[b+1].insert(0, (pitches, 0.0, opFrac(d - first)))
+                d = first
+            result.append((pitches, opFrac(m_start + o), d))
+        # music21 repositions measures by their highest time, which is not updated after splitting a chord
+        # unless a rest is added to the measure. Following measures are shifted by the chord overhang.
+        if split_chord and not split_note and not has_gaps(measure, bar_len): 
+            m_len = max(bar_len, max([opFrac(o + d) for _,o,d in measure]))
+        m_start = opFrac(m_start + m_len)
+    return result
+
+def has_gaps(measure, bar_len):
+    end = 0
+    for _,o,d in sorted(measure, key=lambda x: x[1]):
+        if o > end: return True
+        end = max(end, opFrac(o + d))
+    return end < bar_len
+
+# Writing standard midi files straight from note arrays - no music21 objects
+import struct
+import numpy as np
+
+TICKS_PER_QUARTER = 1024 # same resolution music21 writes
+DEFAULT_VELOCITY = 90
+
+def notes2midi_bytes(tracks, bpm=120, time_sig=(4, 4), tpq=TICKS_PER_QUARTER, velocity=DEFAULT_VELOCITY, programs=None):
+    "Writes format 1 midi file bytes. `tracks` is a list of (start_tick, pitch, duration_tick) arrays, one midi track per part"
+    tempo = int(round(60_000_000 / bpm))
+    conductor = [(0, b'\xff\x51\x03' + tempo.to_bytes(3, 'big')),
+                 (0, bytes([0xff, 0x58, 0x04, time_sig[0], int(np.log2(time_sig[1])), 24, 8])),
+                 (0, b'\xff\x59\x02\x00\x00')] # C major
+    chunks = [track_chunk(conductor)]
+    for idx,(start,pitch,dur) in enumerate(tracks):
+        channel = idx if idx < PERC_CHANNEL-1 else idx+1 # skip percussion channel
+        program = 0 if programs is None else programs[idx]
+        chunks.append(track_chunk([(0, bytes([0xc0 | channel, program]))] + note_events(start, pitch, dur, channel, velocity)))
+    header = b'MThd' + struct.pack('>IHHH', 6, 1, len(chunks), tpq)
+    return header + b''.join(chunks)
+
+def note_events(start, pitch, dur, channel, velocity):
+    "(tick, message) note on/off events sorted by tick. Note offs come before note ons on the same tick"
+    start,pitch,dur = (np.asarray(x, dtype=int).reshape(-1) for x in (start,pitch,dur))
+    ticks = np.concatenate([start+dur, start])
+    is_on = np.repeat([0, 1], len(start))
+    pitches = np.concatenate([pitch, pitch])
+    order = np.lexsort((pitches, is_on, ticks))
+    status = [0x80 | channel, 0x90 | channel]
+    return [(t, bytes([status[on], p, velocity if on else 0])) for t,on,p in zip(ticks[order].tolist(), is_on[order].tolist(), pitches[order].tolist())]
+
+def track_chunk(events):
+    "Encodes absolute (tick, message) events into an MTrk chunk"
+    data = bytearray()
+    prev = 0
+    for tick,msg in events:
+        data += varlen(tick - prev) + msg
+        prev = tick
+    data += b'\x00\xff\x2f\x00' # end of track
+    return b'MTrk' + struct.pack('>I', len(data)) + bytes(data)
+
+def varlen(value):
+    "Midi variable length quantity"
+    result = [value & 0x7f]
+    value >>= 7
+    while value:
+        result.append((value & 0x7f) | 0x80)
+        value >>= 7
+    return bytes(reversed(result))
@@ -0,0 +1,14 @@
+import copy
+import torch
+import torch.nn as nn
+try: from torch.ao.quantization import quantize_dynamic
+except ImportError: from torch.quantization import quantize_dynamic # torch < 1.10
+
+def quantize_model(model:nn.Module, dtype=torch.qint8)->nn.Module:
+    "Copy of `model` with dynamic int8 `nn.Linear` layers (attention projections, `r_attn`, feed-forward, head). CPU inference only"
+    model = copy.deepcopy(model).cpu().eval()
+    # Memory and cached projections hold fp32 activations - don't copy them over
+    for m in model.modules():
+        if hasattr(m, 'reset'): m.reset()
+        if hasattr(m, 'r_cache'): m.r_cache = None
+    return quantize_dynamic(model, {nn.Linear}, dtype=dtype)
@@ -1,6 +1,7 @@
 "Dataloader wrapper that can combine and handle multiple dataloaders for multitask training"
 from fastai.callback import Callback
 from typing import Callable
+from torch.utils.data.distributed import DistributedSampler
 
 __all__ = ['StackedDataBunch']
 
@@ -66,5 +67,11 @@ class StackedDataloader():
 
     def new(self, **kwargs):
         "Create a new copy of `self` with `kwargs` replacing current values."
-        new_dls = [dl.new(**kwargs) for dl in self.dls]
+        sampler = kwargs.get('sampler')
+        new_dls = []
+        for dl in self.dls:
+            # `DistributedTrainer` builds its sampler over the stacked dataset. Each dataloader needs one over its own
+            if isinstance(sampler, DistributedSampler): 
+                kwargs['sampler'] = sampler.__class__(dl.dataset, num_replicas=sampler.num_replicas, rank=sampler.rank, shuffle=sampler.shuffle)
+            new_dls.append(dl.new(**kwargs))
         return StackedDataloader(new_dls, self.num_it)
@@ -8,20 +8,16 @@ __all__ = ['top_k_top_p']
 def top_k_top_p(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
     """ Filter a distribution of logits using top-k and/or nucleus (top-p) filtering
         Args:
-            logits: logits distribution shape (vocabulary size)
+            logits: logits distribution shape (vocabulary size) or (batch size, vocabulary size)
             top_k >0: keep only top k tokens with highest probability (top-k filtering).
             top_p >0.0: keep the top tokens with cumulative probability >= top_p (nucleus filtering).
     """
-    logits = logits.clone()
-    assert logits.dim() == 1  # batch size 1 for now - could be updated for more but the code would be less clear
-    top_k = min(top_k, logits.size(-1))  # Safety check
-    if top_k > 0:
-        # Remove all tokens with a probability less than the last token of the top-k
-        indices_to_remove = logits < torch.topk(logits, top_k)[0][..., -1, None]
-        logits[indices_to_remove] = filter_value
+    if top_k <= 0 and top_p <= 0.0: return logits.clone()
+    top_k = min(top_k, logits.size(-1)) if top_k > 0 else logits.size(-1)  # Safety check
+    # Only the top-k slice is sorted. Everything outside of it is removed
+    sorted_logits, sorted_indices = torch.topk(logits, top_k)
 
     if top_p > 0.0:
-        sorted_logits, sorted_indices = torch.sort(logits, descending=True)
         cumulative_probs = torch.cumsum(F.softmax(sorted_logits, dim=-1), dim=-1)
 
         # Remove tokens with cumulative probability above the threshold
@@ -29,7 +25,5 @@ def top_k_top_p(logits, top_k=0, top_p=0.0, filter_value=-float('Inf')):
         # Shift the indices to the right to keep also the first token above the threshold
         sorted_indices_to_remove[..., 1:] = sorted_indices_to_remove[..., :-1].clone()
         sorted_indices_to_remove[..., 0] = 0
-
-        indices_to_remove = sorted_indices[sorted_indices_to_remove]
-        logits[indices_to_remove] = filter_value
-    return logits
+        sorted_logits = sorted_logits.masked_fill(sorted_indices_to_remove, filter_value)
+    return torch.full_like(logits, filter_value).scatter(-1, sorted_indices, sorted_logits)
@@ -64,6 +64,20 @@ class MusicVocab():
         return idx >= self.dur_range[0] and idx < self.dur_range[1]
     def is_duration_or_pad(self, idx):
         return idx == self.pad_idx or self.is_duration(idx)
+    
+    def sampling_masks(self, device=None):
+        "Boolean masks over the vocab used while sampling - notes, durations and special tokens (bos, sep, eos). Built once per device"
+        if not hasattr(self, '_sampling_masks'): self._sampling_masks = {}
+        if str(device) not in self._sampling_masks:
+            idxs = torch.arange(len(self.itos), device=device)
+            special = torch.zeros(len(self.itos), dtype=torch.bool, device=device)
+            special[[self.bos_idx, self.sep_idx, self.stoi[EOS]]] = True
+            self._sampling_masks[str(device)] = {
+                'note': (idxs >= self.note_range[0]) & (idxs < self.note_range[1]),
+                'dur': (idxs >= self.dur_range[0]) & (idxs < self.dur_range[1]),
+                'special': special,
+            }
+        return self._sampling_masks[str(device)]
         
     def __getstate__(self):
         return {'itos':self.itos}
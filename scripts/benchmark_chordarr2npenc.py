@@ -0,0 +1,84 @@
+"Checks that vectorized chordarr2npenc matches the per-timestep loop for every enc_type and compares their speed"
+import time
+import warnings
+import numpy as np
+from pathlib import Path
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.numpy_encode import *
+from musicautobot.utils.midifile import file2mf, mf2notes
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, default='../data/midi/', help='folder of midi files (searched recursively)')
+parser.add_argument('--repeat', type=int, default=5, help='timing runs per file')
+parser.add_argument('--tile', type=int, default=8, help='repeat each song this many times to get multi-minute pieces')
+args = parser.parse_args()
+warnings.filterwarnings('ignore')
+
+# Original implementation - one python iteration per timestep
+def loop_timestep2npenc(timestep, note_range=PIANO_RANGE, enc_type=None):
+    notes = []
+    for i,n in zip(*timestep.nonzero()):
+        d = timestep[i,n]
+        if d < 0: continue
+        if n < note_range[0] or n >= note_range[1]: continue
+        notes.append([n,d,i])
+    notes = sorted(notes, key=lambda x: x[0], reverse=True)
+    if enc_type is None: return [n[:2] for n in notes]
+    if enc_type == 'parts': return [n for n in notes]
+    if enc_type == 'full': return [[n%12, d, n//12, i] for n,d,i in notes]
+
+def loop_chordarr2npenc(chordarr, skip_last_rest=True, enc_type=None):
+    width = {None: 2, 'parts': 3, 'full': 4}[enc_type]
+    sep = lambda wait: [VALTSEP, wait] + [0]*(width-2)
+    result = []
+    wait_count = 0
+    for idx,timestep in enumerate(chordarr):
+        flat_time = loop_timestep2npenc(timestep, enc_type=enc_type)
+        if len(flat_time) == 0:
+            wait_count += 1
+        else:
+            if wait_count > 0: result.append(sep(wait_count))
+            result.extend(flat_time)
+            wait_count = 1
+    if wait_count > 0 and not skip_last_rest: result.append(sep(wait_count))
+    return np.array(result, dtype=int).reshape(-1, width)
+
+def timeit(func, *fargs, repeat=1, **kwargs):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*fargs, **kwargs)
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+files = sorted([f for f in Path(args.path).rglob('*') if f.suffix.lower() in ('.mid', '.midi')])
+mismatches = []
+totals = np.zeros(3)
+for f in files:
+    parts = mf2notes(file2mf(f))
+    if parts is None: continue
+    song_len = max([o+d for notes in parts for _,o,d in notes], default=0)
+    parts = [[(p, o+song_len*k, d) for k in range(args.tile) for p,o,d in notes] for notes in parts]
+    sparse = notes2chordarr(parts)
+    dense = sparse.todense()
+    for enc_type in (None, 'parts', 'full'):
+        for skip_last_rest in (True, False):
+            kwargs = dict(skip_last_rest=skip_last_rest, enc_type=enc_type)
+            repeat = args.repeat if enc_type is None and skip_last_rest else 1
+            loop, t_loop = timeit(loop_chordarr2npenc, dense, repeat=repeat, **kwargs)
+            vec, t_vec = timeit(chordarr2npenc, dense, repeat=repeat, **kwargs)
+            vec_sparse, t_sparse = timeit(chordarr2npenc, sparse, repeat=repeat, **kwargs)
+            if not (np.array_equal(loop, vec) and np.array_equal(loop, vec_sparse)): mismatches.append((f.name, enc_type, skip_last_rest))
+            if enc_type is None and skip_last_rest: times = np.array([t_loop, t_vec, t_sparse])
+    totals += times
+    print(f'{len(dense):6d} steps {times[0]*1000:8.1f}ms loop {times[1]*1000:7.2f}ms dense {times[2]*1000:7.2f}ms sparse  {f.name}')
+
+print(f'\nloop: {totals[0]:.3f}s, vectorized dense: {totals[1]:.3f}s ({totals[0]/totals[1]:.1f}x), vectorized sparse: {totals[2]:.3f}s ({totals[0]/totals[2]:.1f}x)')
+if mismatches:
+    print('Encodings differ:', mismatches)
+    sys.exit(1)
+print('All encodings match')
@@ -0,0 +1,57 @@
+"Measures per-token decode latency (one token per forward, XL memory) of MusicTransformerXL and the MultiTransformer decoder at different context lengths"
+import time
+import numpy as np
+import torch
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.music_transformer import *
+from musicautobot.multitask_transformer import *
+from musicautobot.config import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='music', choices=['music', 'multitask'])
+parser.add_argument('--pretrained', type=str, default=None, help='saved model (random weights with the default config otherwise)')
+parser.add_argument('--contexts', type=int, nargs='+', default=[1, 64, 256, 512])
+parser.add_argument('--n_tokens', type=int, default=50, help='decode steps timed per context')
+parser.add_argument('--threads', type=int, default=4)
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+torch.set_num_threads(args.threads)
+
+data = MusicDataBunch.empty('.')
+vocab = data.vocab
+if args.model == 'music':
+    learn = music_model_learner(data, config=None if args.pretrained else default_config(), pretrained_path=args.pretrained)
+    def step(x, pos): return learn.model({ 'x': x, 'pos': pos })
+else:
+    learn = multitask_model_learner(data, config=None if args.pretrained else multitask_config(), pretrained_path=args.pretrained)
+    def step(x, pos): return learn.model.head(learn.model.decoder(x, pos))
+model = learn.model.eval()
+device = torch.device('cuda' if args.cuda else 'cpu')
+model.to(device)
+
+max_len = max(args.contexts) + args.n_tokens
+x = torch.randint(vocab.note_range[0], vocab.note_range[1], (1, max_len), device=device)
+pos = torch.arange(max_len, device=device)[None]
+
+def sync():
+    if args.cuda: torch.cuda.synchronize()
+
+with torch.no_grad():
+    model.reset()
+    step(x[:, :1], pos[:, :1]) # warm up
+    for ctx in args.contexts:
+        model.reset()
+        step(x[:, :ctx], pos[:, :ctx])
+        times = []
+        for i in range(ctx, ctx+args.n_tokens):
+            sync()
+            start = time.perf_counter()
+            step(x[:, i:i+1], pos[:, i:i+1])
+            sync()
+            times.append(time.perf_counter() - start)
+        times = np.array(times) * 1000
+        print(f'context {ctx:5d}: {np.median(times):7.2f} ms/token median, {np.percentile(times, 90):7.2f} ms p90')
@@ -0,0 +1,44 @@
+"Checks that the fast midi encoder matches the music21 encoder and compares their speed"
+import time
+import warnings
+import numpy as np
+from pathlib import Path
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.numpy_encode import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, default='../data/midi/', help='folder of midi files (searched recursively)')
+parser.add_argument('--repeat', type=int, default=3, help='timing runs per file')
+args = parser.parse_args()
+warnings.filterwarnings('ignore')
+
+def timeit(func, *fargs, repeat=1):
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        out = func(*fargs)
+        times.append(time.perf_counter() - start)
+    return out, min(times)
+
+files = sorted([f for f in Path(args.path).rglob('*') if f.suffix.lower() in ('.mid', '.midi')])
+mismatches = []
+total_slow, total_fast = 0., 0.
+for f in files:
+    midi = f.read_bytes()
+    for skip_last_rest in (True, False):
+        slow, t_slow = timeit(midi2npenc, midi, skip_last_rest, repeat=args.repeat if skip_last_rest else 1)
+        fast, t_fast = timeit(midi2npenc_fast, midi, skip_last_rest, repeat=args.repeat if skip_last_rest else 1)
+        if not np.array_equal(slow, fast): mismatches.append((f.name, skip_last_rest))
+    total_slow += t_slow
+    total_fast += t_fast
+    print(f'{t_slow*1000:9.1f}ms {t_fast*1000:9.1f}ms {t_slow/t_fast:6.1f}x  {f.name}')
+
+print(f'\n{len(files)} files. music21: {total_slow:.2f}s, fast: {total_fast:.2f}s, speedup: {total_slow/max(total_fast, 1e-9):.1f}x')
+if mismatches:
+    print('Encodings differ:', mismatches)
+    sys.exit(1)
+print('All encodings match')
@@ -0,0 +1,79 @@
+"Compares separate vs fused q/k/v projections of the self attention layer (mha1) for training steps and one-token decoding"
+import time
+import numpy as np
+import torch
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.multitask_transformer import *
+from musicautobot.config import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--bs', type=int, default=4)
+parser.add_argument('--bptt', type=int, default=128)
+parser.add_argument('--context', type=int, default=256, help='decode context length')
+parser.add_argument('--n_tokens', type=int, default=50, help='decode steps')
+parser.add_argument('--repeat', type=int, default=5, help='training steps')
+parser.add_argument('--threads', type=int, default=4)
+parser.add_argument('--cuda', action='store_true')
+args = parser.parse_args()
+torch.set_num_threads(args.threads)
+device = torch.device('cuda' if args.cuda else 'cpu')
+
+config = multitask_config()
+d_model,n_heads,d_head,mem_len = config['d_model'],config['n_heads'],config['d_head'],config['mem_len']
+def attn_layer(fused_qkv):
+    return MemMultiHeadRelativeAttentionKV(n_heads, d_model, d_head, mem_len=mem_len, r_mask=False, fused_qkv=fused_qkv).to(device)
+separate = attn_layer(False)
+fused = attn_layer(True)
+fused.load_state_dict(separate.state_dict()) # old checkpoint layout -> fused weights
+u,v = [torch.randn(n_heads, 1, d_head, device=device) * 0.02 for _ in range(2)]
+pos_enc = PositionalEncoding(d_model).to(device)
+
+def sync():
+    if args.cuda: torch.cuda.synchronize()
+
+def run(layer, x):
+    r = cached_relative_enc(pos_enc, x.shape[1] + mem_len, device, x.dtype)
+    mask = cached_window_mask(x.shape[1], device, mem_len)
+    return layer(x, x, x, r, u, v, mask=mask)
+
+torch.manual_seed(0)
+x_train = torch.randn(args.bs, args.bptt, d_model, device=device, requires_grad=True)
+x_decode = torch.randn(1, args.context + args.n_tokens, d_model, device=device)
+
+def train_time(layer):
+    layer.train()
+    x = x_train
+    layer.reset()
+    times = []
+    for i in range(args.repeat+1):
+        sync()
+        start = time.perf_counter()
+        run(layer, x).sum().backward()
+        sync()
+        times.append(time.perf_counter() - start)
+    return np.median(times[1:]) * 1000 # first step has no memory
+
+def decode_time(layer):
+    layer.eval()
+    x = x_decode
+    outs, times = [], []
+    with torch.no_grad():
+        layer.reset()
+        run(layer, x[:, :args.context])
+        for i in range(args.context, args.context + args.n_tokens):
+            sync()
+            start = time.perf_counter()
+            outs.append(run(layer, x[:, i:i+1]))
+            sync()
+            times.append(time.perf_counter() - start)
+    return np.median(times) * 1000, torch.cat(outs, dim=1)
+
+t_sep, t_fused = train_time(separate), train_time(fused)
+print(f'training step (bs {args.bs}, bptt {args.bptt}): separate {t_sep:.2f}ms, fused {t_fused:.2f}ms ({t_sep/t_fused:.2f}x)')
+(d_sep, out_sep), (d_fused, out_fused) = decode_time(separate), decode_time(fused)
+print(f'decode step (context {args.context}): separate {d_sep:.3f}ms, fused {d_fused:.3f}ms ({d_sep/d_fused:.2f}x)')
+print(f'max abs difference of decoded outputs: {(out_sep - out_fused).abs().max().item():.2e}')
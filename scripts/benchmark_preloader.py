@@ -0,0 +1,35 @@
+"Measures tokens/sec of the MusicPreloader training input pipeline over one epoch of a TokenCorpus"
+import time
+import numpy as np
+from pathlib import Path
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.music_transformer import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--corpus', type=str, default='../data/numpy/musicitem_corpus', help='TokenCorpus folder (see build_corpus.py)')
+parser.add_argument('--bs', type=int, default=16)
+parser.add_argument('--bptt', type=int, default=512)
+parser.add_argument('--transpose_range', type=int, nargs=2, default=(0, 12))
+parser.add_argument('--no_position', action='store_true', help='disable positional encoding')
+parser.add_argument('--backwards', action='store_true')
+parser.add_argument('--epochs', type=int, default=1)
+args = parser.parse_args()
+
+data = MusicDataBunch.from_corpus(args.corpus, bs=args.bs, bptt=args.bptt, num_workers=0,
+                                  transpose_range=args.transpose_range, encode_position=not args.no_position, backwards=args.backwards)
+preloader = data.train_dl.dl.dataset
+print(data.train_ds.x.corpus)
+
+for epoch in range(args.epochs):
+    preloader.on_epoch_begin()
+    ntoks = 0
+    start = time.perf_counter()
+    for k in range(len(preloader)):
+        x,y = preloader[k]
+        ntoks += len(x)
+    elapsed = time.perf_counter() - start
+    print(f'epoch {epoch}: {len(preloader)//preloader.bs} batches, {ntoks} tokens in {elapsed:.2f}s - {ntoks/elapsed:,.0f} tokens/sec')
@@ -0,0 +1,42 @@
+"Reports real (non padding) tokens per seq2seq batch for padded, bucketed and packed S2SPreloader batches"
+import time
+import numpy as np
+from pathlib import Path
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.multitask_transformer import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, default='../data/numpy/')
+parser.add_argument('--data_file', type=str, default='s2s_encode/musicitem_data_save.pkl')
+parser.add_argument('--bs', type=int, default=8)
+parser.add_argument('--bptt', type=int, default=1024)
+parser.add_argument('--epochs', type=int, default=1)
+args = parser.parse_args()
+
+modes = {
+    'padded':   dict(dl_tfms=melody_chord_tfm),
+    'bucketed': dict(dl_tfms=melody_chord_tfm, bucket=True),
+    'packed':   dict(dl_tfms=packed_melody_chord_tfm, pack=True),
+}
+
+results = {}
+for name,kwargs in modes.items():
+    data = load_data(args.path, args.data_file, bs=args.bs, bptt=args.bptt, preloader_cls=S2SPreloader, num_workers=0, **kwargs)
+    vocab = data.vocab
+    nbatches, real, slots = 0, 0, 0
+    start = time.perf_counter()
+    for epoch in range(args.epochs):
+        data.train_dl.dataset.on_epoch_begin()
+        for x,y in data.train_dl:
+            nbatches += 1
+            real += (y['c2m'] != vocab.pad_idx).sum().item() + (y['m2c'] != vocab.pad_idx).sum().item()
+            slots += y['c2m'].numel() + y['m2c'].numel()
+    elapsed = time.perf_counter() - start
+    results[name] = real/slots
+    print(f'{name:9s} {nbatches:6d} batches, {real/max(nbatches,1):9.1f} real tokens/batch of {slots/max(nbatches,1):9.1f} ({real/max(slots,1):.1%}), {elapsed:.1f}s')
+
+print(f'\nreal token fraction - packed: {results["packed"]:.1%}, bucketed: {results["bucketed"]:.1%}, padded: {results["padded"]:.1%}')
@@ -0,0 +1,84 @@
+"Exports a model with TorchScript and compares per-token decode latency and full generation time against eager mode"
+import time
+import numpy as np
+import torch
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.music_transformer import *
+from musicautobot.multitask_transformer import *
+from musicautobot.config import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='music', choices=['music', 'multitask'])
+parser.add_argument('--pretrained', type=str, default=None, help='saved model (random weights with the default config otherwise)')
+parser.add_argument('--out', type=str, default='model_script.pt', help='exported TorchScript file')
+parser.add_argument('--max_seq_len', type=int, default=1024, help='relative encodings projected at export')
+parser.add_argument('--contexts', type=int, nargs='+', default=[1, 64, 256, 512])
+parser.add_argument('--n_tokens', type=int, default=50, help='decode steps timed per context')
+parser.add_argument('--midi', type=str, default=None, help='seed for the generation comparison (skipped if not given)')
+parser.add_argument('--n_words', type=int, default=200)
+parser.add_argument('--threads', type=int, default=4)
+args = parser.parse_args()
+torch.set_num_threads(args.threads)
+
+data = MusicDataBunch.empty('.')
+vocab = data.vocab
+if args.model == 'music':
+    learn = music_model_learner(data, config=None if args.pretrained else default_config(), pretrained_path=args.pretrained)
+    def eager_step(x, pos): return learn.model({ 'x': x, 'pos': pos })[0][:, -1]
+    runner_cls, generate = ScriptRunner, 'predict'
+else:
+    learn = multitask_model_learner(data, config=None if args.pretrained else multitask_config(), pretrained_path=args.pretrained)
+    def eager_step(x, pos): return learn.model.head(learn.model.decoder(x, pos))[:, -1]
+    runner_cls, generate = MultitaskScriptRunner, 'predict_nw'
+learn.model.cpu().eval()
+
+start = time.perf_counter()
+learn.export_script(args.out, max_seq_len=args.max_seq_len)
+print(f'exported {args.out} in {time.perf_counter()-start:.1f}s')
+runner = runner_cls.load(args.out)
+scripted = runner.model
+
+max_len = max(args.contexts) + args.n_tokens
+x = torch.randint(vocab.note_range[0], vocab.note_range[1], (1, max_len))
+pos = torch.arange(max_len)[None]
+
+def decode_times(prefix, step):
+    "Median/p90 ms per token after a `prefix` of each context"
+    results = {}
+    for ctx in args.contexts:
+        state = prefix(x[:, :ctx], pos[:, :ctx])
+        times = []
+        for i in range(ctx, ctx+args.n_tokens):
+            start = time.perf_counter()
+            state = step(x[:, i:i+1], pos[:, i:i+1], state)
+            times.append(time.perf_counter() - start)
+        times = np.array(times) * 1000
+        results[ctx] = (np.median(times), np.percentile(times, 90))
+    return results
+
+def eager_prefix(x, pos):
+    learn.model.reset()
+    eager_step(x, pos)
+def scripted_prefix(x, pos):
+    k_mem, v_mem = scripted.init_state(1)
+    return scripted(x, pos, k_mem, v_mem)[1:]
+
+with torch.no_grad():
+    for _ in range(3): scripted_prefix(x[:, :8], pos[:, :8]) # profiling runs of the TorchScript executor
+    eager = decode_times(eager_prefix, lambda x,pos,state: eager_step(x, pos))
+    script = decode_times(scripted_prefix, lambda x,pos,state: scripted(x, pos, *state)[1:])
+for ctx in args.contexts:
+    (e_med,e_p90),(s_med,s_p90) = eager[ctx],script[ctx]
+    print(f'context {ctx:5d}: eager {e_med:7.2f} ms/token (p90 {e_p90:7.2f}), scripted {s_med:7.2f} ms/token (p90 {s_p90:7.2f}) - {e_med/s_med:.2f}x')
+
+if args.midi:
+    item = MusicItem.from_file(args.midi, vocab)
+    for name,model in [('eager', learn), ('scripted', runner)]:
+        torch.manual_seed(0)
+        start = time.perf_counter()
+        pred = getattr(model, generate)(item, n_words=args.n_words)[0]
+        print(f'{name:8s} generation: {len(pred.data)} tokens in {time.perf_counter()-start:.2f}s')
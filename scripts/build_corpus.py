@@ -0,0 +1,28 @@
+"Converts a saved MusicItemList databunch (musicitem_data_save.pkl) to a memory-mapped TokenCorpus"
+import numpy as np
+from pathlib import Path
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.music_transformer import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--path', type=str, default='../data/numpy/')
+parser.add_argument('--data_file', type=str, default='musicitem_data_save.pkl')
+parser.add_argument('--out', type=str, default='musicitem_corpus', help='corpus folder, relative to path')
+args = parser.parse_args()
+
+path = Path(args.path)
+data = load_data(path, args.data_file, num_workers=0)
+
+def idx_pos(items):
+    for i in range(len(items.items)):
+        item = items.get(i)
+        yield item.data, item.position
+
+train,valid = data.train_ds.x,data.valid_ds.x
+valid_idx = np.arange(len(train.items), len(train.items)+len(valid.items))
+corpus = TokenCorpus.create(path/args.out, (o for items in (train, valid) for o in idx_pos(items)), valid_idx=valid_idx)
+print(corpus)
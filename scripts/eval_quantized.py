@@ -0,0 +1,81 @@
+"Compares a dynamic int8 quantized model against fp32 - next-token accuracy on the validation set and per-token decode latency (CPU)"
+import io
+import time
+import numpy as np
+import torch
+
+import sys
+sys.path.insert(0, '..')
+
+from musicautobot.music_transformer import *
+from musicautobot.multitask_transformer import *
+from musicautobot.utils.quantize import quantize_model
+from musicautobot.config import *
+
+import argparse
+parser = argparse.ArgumentParser()
+parser.add_argument('--model', type=str, default='music', choices=['music', 'multitask'])
+parser.add_argument('--pretrained', type=str, default=None, help='saved model (random weights with the default config otherwise)')
+parser.add_argument('--path', type=str, default='../data/numpy/')
+parser.add_argument('--data_file', type=str, default=None, help='saved MusicDataBunch for next-token accuracy (skipped if not given)')
+parser.add_argument('--bs', type=int, default=4)
+parser.add_argument('--bptt', type=int, default=512)
+parser.add_argument('--n_batches', type=int, default=20, help='validation batches to evaluate')
+parser.add_argument('--context', type=int, default=256, help='decode context length')
+parser.add_argument('--n_tokens', type=int, default=50, help='decode steps timed')
+parser.add_argument('--threads', type=int, default=4)
+args = parser.parse_args()
+torch.set_num_threads(args.threads)
+
+if args.data_file: data = load_data(args.path, args.data_file, bs=args.bs, bptt=args.bptt, dl_tfms=batch_position_tfm, num_workers=0)
+else: data = MusicDataBunch.empty(args.path)
+vocab = data.vocab
+
+if args.model == 'music':
+    learn = music_model_learner(data, config=None if args.pretrained else default_config(), pretrained_path=args.pretrained)
+    def step(model, x, pos): return model({ 'x': x, 'pos': pos })[0]
+else:
+    learn = multitask_model_learner(data, config=None if args.pretrained else multitask_config(), pretrained_path=args.pretrained)
+    def step(model, x, pos): return model.head(model.decoder(x, pos))
+models = { 'fp32': learn.model.cpu().eval() }
+models['int8'] = quantize_model(models['fp32'])
+
+def size_mb(model):
+    "Serialized state dict size"
+    buf = io.BytesIO()
+    torch.save(model.state_dict(), buf)
+    return buf.tell() / 2**20
+
+for name,model in models.items(): print(f'{name}: {size_mb(model):.1f}MB')
+
+if args.data_file:
+    correct = { name: 0 for name in models }
+    agree, total = 0, 0
+    for model in models.values(): model.reset()
+    with torch.no_grad():
+        for i,(xb,yb) in enumerate(data.valid_dl):
+            if i == args.n_batches: break
+            x,pos,yb = xb['x'].cpu(),xb['pos'].cpu(),yb.cpu()
+            keep = yb != vocab.pad_idx
+            preds = { name: step(model, x, pos).argmax(-1) for name,model in models.items() }
+            for name,pred in preds.items(): correct[name] += (pred == yb)[keep].sum().item()
+            agree += (preds['fp32'] == preds['int8'])[keep].sum().item()
+            total += keep.sum().item()
+    for name in models: print(f'{name} next-token accuracy: {correct[name]/max(total,1):.4f}')
+    print(f'int8 top-1 agreement with fp32: {agree/max(total,1):.4f} ({total} tokens)')
+
+x = torch.randint(vocab.note_range[0], vocab.note_range[1], (1, args.context + args.n_tokens))
+pos = torch.arange(x.shape[1])[None]
+latency = {}
+with torch.no_grad():
+    for name,model in models.items():
+        model.reset()
+        step(model, x[:, :args.context], pos[:, :args.context])
+        times = []
+        for i in range(args.context, args.context + args.n_tokens):
+            start = time.perf_counter()
+            step(model, x[:, i:i+1], pos[:, i:i+1])
+            times.append(time.perf_counter() - start)
+        latency[name] = np.median(times) * 1000
+        print(f'{name} decode (context {args.context}): {latency[name]:.2f} ms/token median')
+print(f'int8 speedup: {latency["fp32"]/latency["int8"]:.2f}x')
@@ -35,6 +35,9 @@ parser.add_argument('--div_factor', type=int, default=10, help='learning rate di
 parser.add_argument('--save_every', action='store_true', help='Save every epoch')
 parser.add_argument('--config', type=str, default='multitask_config', help='serve.py config name')
 parser.add_argument('--no_transpose', action='store_true', help='No transpose data augmentation')
+parser.add_argument('--bucket', action='store_true', help='Batch s2s pairs of similar length and pad to the batch max instead of bptt')
+parser.add_argument('--pack', action='store_true', help='Pack several s2s pairs into each row with segment masks')
+parser.add_argument('--batch_transpose', action='store_true', help='Transpose on the batch tensor (training device) instead of in the preloader')
 parser.add_argument('--data_parallel', action='store_true', help='DataParallel instead of DDP')
 parser.add_argument('--mask_steps', type=int, default=1, help='Attention mask - max number of random steps. Basically teacher forcing')
 parser.add_argument('--mask_pitchdur', action='store_true', help='Mask either pitch or duration')
@@ -66,13 +69,16 @@ transpose_range = None if args.no_transpose else (0,12)
 mlm_tfm = mask_lm_tfm_pitchdur if args.mask_pitchdur else partial(mask_lm_tfm_default, mask_p=0.4)
 data = load_data(args.path, Path('piano_duet')/args.data_file, 
                  bs=args.batch_size, bptt=args.bptt, transpose_range=transpose_range,
-                 dl_tfms=mlm_tfm, num_workers=args.num_workers)
+                 dl_tfms=[batch_transpose_tfm, mlm_tfm] if args.batch_transpose else mlm_tfm, 
+                 batch_transpose=args.batch_transpose, num_workers=args.num_workers)
 
 datasets.append(data)
 
+s2s_tfm = packed_melody_chord_tfm if args.pack else melody_chord_tfm
 s2s_data = load_data(args.path, Path('s2s_encode')/args.data_file, 
                     bs=args.batch_size//4, bptt=args.bptt, transpose_range=transpose_range,
-                     preloader_cls=S2SPreloader, dl_tfms=melody_chord_tfm, num_workers=args.num_workers)
+                     preloader_cls=S2SPreloader, dl_tfms=[s2s_transpose_tfm, s2s_tfm] if args.batch_transpose else s2s_tfm, 
+                     batch_transpose=args.batch_transpose, bucket=args.bucket, pack=args.pack, num_workers=args.num_workers)
 
 datasets.append(s2s_data)
 
@@ -20,6 +20,7 @@ import argparse
 parser = argparse.ArgumentParser()
 parser.add_argument('--path', type=str, default='../data/numpy/')
 parser.add_argument('--data_file', type=str, default='musicitem_data_save.pkl')
+parser.add_argument('--corpus', type=str, default=None, help='memory-mapped corpus folder (see build_corpus.py). Used instead of data_file')
 parser.add_argument('--save', type=str, default='first_run')
 parser.add_argument('--load', type=str, default=None)
 parser.add_argument("--local_rank", type=int, default=0)
@@ -35,6 +36,7 @@ parser.add_argument('--lr', type=float, default=1e-3, help='learning rate')
 parser.add_argument('--div_factor', type=int, default=10, help='learning rate div factor')
 parser.add_argument('--config', type=str, default='default_config', help='serve.py config name')
 parser.add_argument('--no_transpose', action='store_true', help='No transpose data augmentation')
+parser.add_argument('--batch_transpose', action='store_true', help='Transpose on the batch tensor (training device) instead of in the preloader')
 parser.add_argument('--parallel', action='store_true', help='Run in dataparallel')
 parser.add_argument('--mask_steps', type=int, default=1, help='Attention mask - max number of random steps. Basically teacher forcing')
 
@@ -57,8 +59,11 @@ config['encode_position'] = True
 config['mask_steps'] = args.mask_steps
 
 transpose_range = None if args.no_transpose else (0,12)
-data = load_data(path, args.data_file, encode_position=config['encode_position'], dl_tfms=[batch_position_tfm],
-                    bs=args.batch_size, bptt=args.bptt, transpose_range=transpose_range, num_workers=args.num_workers)
+dl_tfms = [batch_transpose_tfm, batch_position_tfm] if args.batch_transpose else [batch_position_tfm]
+data_kwargs = dict(encode_position=config['encode_position'], dl_tfms=dl_tfms, batch_transpose=args.batch_transpose,
+                   bs=args.batch_size, bptt=args.bptt, transpose_range=transpose_range, num_workers=args.num_workers)
+if args.corpus: data = MusicDataBunch.from_corpus(path/args.corpus, path=path, **data_kwargs)
+else: data = load_data(path, args.data_file, **data_kwargs)
 
 eps = 1e-2 if args.half else 1e-6
 opt_func = partial(FusedAdam, betas=(0.9,0.99), eps=eps)
@@ -16,6 +16,7 @@ class Config(object):
     DATA_SAVE_NAME = 'musicitem_data_save.pkl'
     MULTITASK_MODEL_PATH = DATA_PATH/'pretrained/MultitaskSmallKeyC.pth'
     MUSIC_MODEL_PATH = DATA_PATH/'pretrained/MusicTransformerKeyC.pth'
+    QUANTIZE = False # dynamic int8 linear layers - CPU only
 
 app.config.from_object('api.config.Config')
 app.config.from_pyfile('api.cfg')
@@ -13,9 +13,9 @@ import traceback
 torch.set_num_threads(4)
 
 data = load_data(app.config['DATA_PATH'], app.config['DATA_SAVE_NAME'], num_workers=1)
-learn = music_model_learner(data, pretrained_path=app.config['MUSIC_MODEL_PATH'])
+learn = music_model_learner(data, pretrained_path=app.config['MUSIC_MODEL_PATH'], quantize=app.config['QUANTIZE'])
 
-if torch.cuda.is_available(): learn.model.cuda()
+if torch.cuda.is_available() and not app.config['QUANTIZE']: learn.model.cuda()
 # learn.to_fp16(loss_scale=512) # fp16 not supported for cpu - https://github.com/pytorch/pytorch/issues/17699
 
 @app.route('/predict/midi', methods=['POST'])
@@ -55,9 +55,7 @@ def predict_midi():
     # Main logic
     try:
         full = predict_from_midi(learn, midi=midi, n_words=n_words, seed_len=seed_len, temperatures=temperatures)
-        stream = separate_melody_chord(full.to_stream(bpm=bpm))
-        midi_out = Path(stream.write("midi"))
-        print('Wrote to temporary file:', midi_out)
+        midi_out = full.to_midi_bytes(bpm=bpm, separate_chords=True)
     except Exception as e:
         traceback.print_exc()
         return jsonify({'error': f'Failed to predict: {e}'})
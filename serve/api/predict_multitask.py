@@ -14,9 +14,9 @@ import traceback
 torch.set_num_threads(4)
 
 data = load_data(app.config['DATA_PATH'], app.config['DATA_SAVE_NAME'], num_workers=1)
-learn = multitask_model_learner(data, pretrained_path=app.config['MULTITASK_MODEL_PATH'])
+learn = multitask_model_learner(data, pretrained_path=app.config['MULTITASK_MODEL_PATH'], quantize=app.config['QUANTIZE'])
 
-if torch.cuda.is_available(): learn.model.cuda()
+if torch.cuda.is_available() and not app.config['QUANTIZE']: learn.model.cuda()
 
 
 @app.route('/predict/midi', methods=['POST'])
@@ -46,16 +46,14 @@ def predict_midi():
     try:
         if prediction_type == 'next':
             full = nw_predict_from_midi(learn, midi=midi, n_words=n_words, seed_len=seed_len, temperatures=temperatures, top_k=top_k, top_p=top_p)
-            stream = separate_melody_chord(full.to_stream(bpm=bpm))
+            midi_out = full.to_midi_bytes(bpm=bpm, separate_chords=True)
         elif prediction_type in ['melody', 'chords']:
             full = s2s_predict_from_midi(learn, midi=midi, n_words=n_words, temperatures=temperatures, seed_len=seed_len, 
                                          pred_melody=(prediction_type == 'melody'), use_memory=True, top_k=top_k, top_p=top_p)
-            stream = full.to_stream(bpm=bpm)
+            midi_out = full.to_midi_bytes(bpm=bpm)
         elif prediction_type in ['pitch', 'rhythm']:
             full = mask_predict_from_midi(learn, midi=midi, temperatures=temperatures, predict_notes=(prediction_type == 'pitch'), section=(mask_start, mask_end), top_k=top_k, top_p=top_p)
-            stream = separate_melody_chord(full.to_stream(bpm=bpm))
-        midi_out = Path(stream.write("midi"))
-        print('Wrote to temporary file:', midi_out)
+            midi_out = full.to_midi_bytes(bpm=bpm, separate_chords=True)
     except Exception as e:
         traceback.print_exc()
         return jsonify({'error': f'Failed to predict: {e}'})
@@ -67,6 +65,10 @@ def predict_midi():
     return jsonify(result)
     # return send_from_directory(midi_out.parent, midi_out.name, mimetype='audio/midi')
 
+@app.route('/predict/cache', methods=['GET'])
+def cache_stats():
+    return jsonify(s2s_encoder_cache.stats) # encoder outputs reused by melody/chords predictions
+
 @app.route('/midi/convert', methods=['POST'])
 def convert_midi():
     args = request.form.to_dict()
@@ -14,23 +14,13 @@ def to_s3(file, args):
     s3_file = base_dir + s3_id + '.mid'
     s3_json = base_dir + s3_id + '.json'
     
-    if not isinstance(file, (str, Path)):
-        tmp_midi = '/tmp/' + s3_id + '.mid'
-        with open(tmp_midi, 'wb') as f:
-            f.write(file)
-    else: 
-        tmp_midi = file
-
-    if not isinstance(args, (str, Path)):
-        tmp_json = '/tmp/' + s3_id + '.json'
-        with open(tmp_json, 'w') as f:
-            json.dump(args, f)
-    else: tmp_json = args
-    
     # Uploads the given file using a managed uploader, which will split up large
-    # files automatically and upload parts in parallel.
-    s3.upload_file(str(tmp_midi), bucket, s3_file)
-    s3.upload_file(str(tmp_json), bucket, s3_json)
+    # files automatically and upload parts in parallel. Bytes are uploaded from memory
+    if isinstance(file, (str, Path)): s3.upload_file(str(file), bucket, s3_file)
+    else: s3.put_object(Bucket=bucket, Key=s3_file, Body=file)
+
+    if isinstance(args, (str, Path)): s3.upload_file(str(args), bucket, s3_json)
+    else: s3.put_object(Bucket=bucket, Key=s3_json, Body=json.dumps(args))
     print('Saved IDS:', s3_id, s3_id[::-1])
     return s3_id[::-1]
 
@@ -0,0 +1,24 @@
+import sys
+from pathlib import Path
+sys.path.insert(0, str(Path(__file__).parent.parent))
+
+import warnings
+warnings.filterwarnings('ignore')
+
+import pytest
+from fastai.text.data import LMLabelList
+from musicautobot.multitask_transformer import S2SItemList, Midi2MultitrackProcessor
+from musicautobot.vocab import MusicVocab
+
+DATA = Path(__file__).parent.parent/'data'/'midi'
+EXAMPLES = sorted((DATA/'examples').glob('*.mid'))
+NOTEBOOK_EXAMPLE = DATA/'notebook_examples'/'example.mid'
+
+@pytest.fixture(scope='session')
+def vocab(): return MusicVocab.create()
+
+@pytest.fixture(scope='session')
+def s2s_src(vocab, tmp_path_factory):
+    "Melody/chord pairs of the example midis"
+    src = S2SItemList(EXAMPLES, path=tmp_path_factory.mktemp('s2s'), vocab=vocab, processor=[Midi2MultitrackProcessor()])
+    return src.split_by_rand_pct(0.2, seed=6).label_const(label_cls=LMLabelList)
@@ -0,0 +1,59 @@
+import pytest
+import numpy as np
+from fastai.distributed import OurDistributedSampler
+from musicautobot.music_transformer import MusicItemList, Midi2ItemProcessor
+from musicautobot.multitask_transformer import S2SPreloader
+from musicautobot.utils.stacked_dataloader import StackedDataloader
+import musicautobot.multitask_transformer.dataloader as s2s_dataloader
+from conftest import EXAMPLES
+
+def s2s_bunch(src, **kwargs):
+    return src.databunch(bs=3, bptt=1024, preloader_cls=S2SPreloader, transpose_range=None, **kwargs)
+
+def pad_lens(dl):
+    "Padded length of every batch. Collating fails if a batch mixes lengths"
+    return [b[0].shape[1] for b in dl]
+
+def test_bucket_one_pad_len_per_batch(s2s_src):
+    data = s2s_bunch(s2s_src, val_bs=2, bucket=True, shuffle_dl=True)
+    for dl,bs in [(data.train_dl, 3), (data.valid_dl, 2)]:
+        ds = dl.dataset
+        ds.on_epoch_begin()
+        lens = pad_lens(dl)
+        assert len(lens) == -(-len(ds.dataset) // bs)
+        assert max(lens) <= 1025 and sorted(set(lens)) == sorted(set(ds.pad_lens))
+
+def test_bucket_batch_size_setter(s2s_src):
+    data = s2s_bunch(s2s_src, bucket=True)
+    data.train_dl.batch_size = 2
+    assert data.train_dl.dataset.bs == 2
+    assert len(pad_lens(data.train_dl)) == -(-len(data.train_ds) // 2)
+
+@pytest.mark.parametrize('n_replicas', [1, 2, 3])
+def test_bucket_dl_new_distributed_sampler(s2s_src, monkeypatch, n_replicas):
+    monkeypatch.setattr(s2s_dataloader, 'num_distrib', lambda: n_replicas)
+    data = s2s_bunch(s2s_src, bucket=True)
+    ds = data.train_dl.dataset
+    assert len(ds) % n_replicas == 0
+    ranks = []
+    for rank in range(n_replicas):
+        sampler = OurDistributedSampler(ds, num_replicas=n_replicas, rank=rank, shuffle=False)
+        ranks.append([(b[0].shape[0], b[0].shape[1]) for b in data.train_dl.new(shuffle=False, sampler=sampler)])
+    # every rank reads an equal share of the same global batches
+    assert all(shapes == ranks[0] for shapes in ranks)
+    assert sum(n for shapes in ranks for n,_ in shapes) == len(ds) >= len(data.train_ds)
+    assert len(set(l for _,l in ranks[0])) > 1
+
+def test_stacked_dl_new_distributed_sampler(s2s_src, monkeypatch):
+    monkeypatch.setattr(s2s_dataloader, 'num_distrib', lambda: 2)
+    bucketed,padded = s2s_bunch(s2s_src, bucket=True),s2s_bunch(s2s_src)
+    stacked = StackedDataloader([bucketed.train_dl, padded.train_dl])
+    for rank in range(2):
+        new_dl = stacked.new(shuffle=False, sampler=OurDistributedSampler(stacked.dataset, num_replicas=2, rank=rank, shuffle=False))
+        n_items = sum(b[0].shape[0] for b in new_dl)
+        assert n_items == sum(OurDistributedSampler(dl.dataset, num_replicas=2, rank=rank).num_samples for dl in stacked.dls)
+
+def test_midi2item_processor_fast_matches_music21(vocab):
+    items = [MusicItemList(EXAMPLES, vocab=vocab, processor=[Midi2ItemProcessor(fast=fast)]).process().items for fast in (False, True)]
+    for (idx,pos),(fast_idx,fast_pos) in zip(*items):
+        assert np.array_equal(idx, fast_idx) and np.array_equal(pos, fast_pos)
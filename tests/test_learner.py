@@ -0,0 +1,63 @@
+import pytest
+import torch
+from fastai.text.models.awd_lstm import LinearDecoder
+from musicautobot.music_transformer import MusicDataBunch, MusicItem
+from musicautobot.music_transformer.learner import LogitsProcessor
+from musicautobot.multitask_transformer import multitask_model_learner
+from musicautobot.multitask_transformer.model import MTLinearDecoder
+from musicautobot.config import multitask_config
+from conftest import NOTEBOOK_EXAMPLE
+
+N_HID = 32
+
+def prev_tokens(vocab):
+    "Previous token of each row - pad, notes, durations and a special token"
+    return torch.tensor([vocab.pad_idx, vocab.note_range[0]+3, vocab.dur_range[0]+2, vocab.sep_idx, vocab.note_range[1]-1, vocab.bos_idx])
+
+@pytest.mark.parametrize('train', [False, True], ids=['eval', 'train'])
+@pytest.mark.parametrize('head_cls', [LinearDecoder, MTLinearDecoder])
+def test_head_logits_matches_masked_full_head(vocab, head_cls, train):
+    n_out = len(vocab.itos)
+    head = LinearDecoder(n_out, N_HID, output_p=0.5) if head_cls is LinearDecoder else MTLinearDecoder(N_HID, n_out, output_p=0.5)
+    head.train(train)
+    prev_idx = prev_tokens(vocab)
+    hidden = torch.randn(len(prev_idx), 5, N_HID)
+    processor = LogitsProcessor(vocab)
+
+    torch.manual_seed(0)
+    full = head(([hidden], [hidden]))[0] if head_cls is LinearDecoder else head(hidden)
+    full = full[:,-1]
+    masks = vocab.sampling_masks(full.device)
+    full = full.masked_fill(torch.where(processor.is_dur(prev_idx)[:,None], masks['dur'], masks['note']), processor.filter_value)
+    torch.manual_seed(0)
+    restricted = processor.head_logits(head, hidden[:,-1].contiguous(), prev_idx)
+
+    assert torch.equal(torch.isinf(full), torch.isinf(restricted))
+    allowed = ~torch.isinf(full)
+    assert torch.allclose(full[allowed], restricted[allowed], atol=1e-6)
+
+@pytest.fixture(scope='module')
+def mt_learn(tmp_path_factory):
+    config = multitask_config()
+    config.update(d_model=N_HID, d_inner=64, n_heads=2, d_head=16, mem_len=16, enc_layers=1, dec_layers=1)
+    torch.manual_seed(0)
+    return multitask_model_learner(MusicDataBunch.empty(tmp_path_factory.mktemp('mt')), config=config)
+
+@pytest.fixture(scope='module')
+def masked_items(mt_learn):
+    item = MusicItem.from_file(NOTEBOOK_EXAMPLE, mt_learn.data.vocab).trim_to_beat(64)
+    # all notes, all durations, fewer masks than iterations and no masks
+    return [item.mask_pitch(), item.mask_duration(), item.mask_pitch((2, 3)), item]
+
+@pytest.mark.parametrize('iterations', [None, 1, 2, 4, 1000])
+def test_predict_mask_fills_every_mask(mt_learn, masked_items, iterations):
+    vocab = mt_learn.data.vocab
+    for item in masked_items:
+        torch.manual_seed(0)
+        pred = mt_learn.predict_mask(item, iterations=iterations)
+        assert len(pred.data) == len(item.data)
+        assert not (pred.data == vocab.mask_idx).any()
+
+@pytest.mark.parametrize('iterations', [0, -1])
+def test_mask_predict_needs_an_iteration(mt_learn, masked_items, iterations):
+    with pytest.raises(ValueError): mt_learn.predict_mask(masked_items[0], iterations=iterations)
@@ -0,0 +1,30 @@
+import pytest
+import music21
+import numpy as np
+from musicautobot.numpy_encode import midi2npenc, midi2npenc_fast
+from musicautobot.utils.midifile import file2mf, mf2notes
+from conftest import EXAMPLES, NOTEBOOK_EXAMPLE
+
+def notes2midi(notes):
+    "Single track midi bytes of (pitch, offset, duration) notes, written by music21"
+    s = music21.stream.Stream()
+    for pitch,offset,dur in notes: s.insert(offset, music21.note.Note(pitch, quarterLength=dur))
+    return music21.midi.translate.streamToMidiFile(s).writestr()
+
+# Same onset, different end times - music21 splits these into voices
+VOICES = notes2midi([(60, 0, 1), (64, 0, 2), (67, 2, 1), (48, 3, 4), (55, 3, 2.5)])
+# Overlapping notes with different onsets - one voice, read by the fast path
+OVERLAPS = notes2midi([(60, 0, 4), (64, 1, 1), (67, 1.5, 1), (72, 2, 0.5), (65, 5.75, 3)])
+
+@pytest.mark.parametrize('skip_last_rest', [True, False])
+@pytest.mark.parametrize('midi', EXAMPLES + [NOTEBOOK_EXAMPLE], ids=lambda f: f.stem)
+def test_fast_matches_music21(midi, skip_last_rest):
+    assert np.array_equal(midi2npenc_fast(midi, skip_last_rest), midi2npenc(midi, skip_last_rest))
+
+def test_voices_fall_back_to_music21():
+    assert mf2notes(file2mf(VOICES)) is None
+    assert np.array_equal(midi2npenc_fast(VOICES), midi2npenc(VOICES))
+
+def test_overlapping_notes():
+    assert mf2notes(file2mf(OVERLAPS)) is not None
+    assert np.array_equal(midi2npenc_fast(OVERLAPS), midi2npenc(OVERLAPS))